@@ -28,619 +28,655 @@
 
 #### PACKAGE IMPORTS ####
 
-# Run this cell first to import all required packages. Do not make any imports elsewhere in the notebook
+# Run this cell first to import all required packages. Do not make any imports elsewhere in the notebook.
+# The graded functions live in the shakespeare_lm package, so this file can be imported (e.g. by
+# `python -m shakespeare_lm`) without running the notebook; TensorFlow and matplotlib are only
+# loaded when it is run as a script or in Jupyter
 
-import tensorflow as tf
-import numpy as np
 import json
-import matplotlib.pyplot as plt
-get_ipython().run_line_magic('matplotlib', 'inline')
 
-# If you would like to make further imports from tensorflow, add them here
+import numpy as np
 
-from tensorflow.keras.preprocessing.text import Tokenizer
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Embedding, GRU, Bidirectional, Dense
+from shakespeare_lm.preprocessing import (create_character_tokenizer, strings_to_sequences, make_padded_dataset,
+                                          create_inputs_and_targets, make_Dataset)
+from shakespeare_lm.model import get_model, get_logits, sample_token
+from shakespeare_lm.corpus import iter_text_chunks, sample_chunks
+from shakespeare_lm.codec import CharacterCodec
+from shakespeare_lm.cache import load_or_build_cache
+from shakespeare_lm.examples import sliding_window_examples
+from shakespeare_lm.stateful import stateful_order
+from shakespeare_lm.prefix_cache import PrefixStateCache
+from shakespeare_lm.numpy_engine import convert_model
+from shakespeare_lm.plotting import plot_history
 
+if __name__ == '__main__':
+    import tensorflow as tf
 
-# ![Shakespeare image](data/shakespeare.png)
-# 
-# #### The Shakespeare dataset
-# 
-# In this assignment, you will use a subset of the [Shakespeare dataset](http://shakespeare.mit.edu). It consists of a single text file with several excerpts concatenated together. The data is in raw text form, and so far has not yet had any preprocessing. 
-# 
-# Your goal is to construct an unsupervised character-level sequence model that can generate text according to a distribution learned from the dataset.
+    # If you would like to make further imports from tensorflow, add them here
 
-# #### Load and inspect the dataset
+    from shakespeare_lm.pipeline import make_pipeline_dataset
+    from shakespeare_lm.tbptt import make_tbptt_datasets
+    from shakespeare_lm.bucketing import ResetStatesCallback, make_bucketed_splits
+    from shakespeare_lm.inference import StepDecoder
+    from shakespeare_lm.sampling import Sampler
+    from shakespeare_lm.beam_search import BeamSearchDecoder
+    from shakespeare_lm.training import BestCheckpoint, CompiledTrainer, set_mixed_precision
+    from shakespeare_lm.checkpointing import CheckpointManager
+    from shakespeare_lm.export import export_tflite, compare_models
+    from shakespeare_lm.batch_generation import generate_batch
+    from shakespeare_lm import instrumentation
 
-# In[4]:
+    # Set to True to time each preprocessing, training and generation stage; the timings are
+    # written to ./models/metrics.json at the end of the notebook
+    enable_instrumentation = False
+    if enable_instrumentation:
+        instrumentation.enable()
 
+    try:
+        get_ipython().run_line_magic('matplotlib', 'inline')
+    except NameError:   # not running in IPython
+        pass
 
-# Load the text file into a string
 
-with open('data/Shakespeare.txt', 'r', encoding='utf-8') as file:
-    text = file.read()
+    # ![Shakespeare image](data/shakespeare.png)
+    # 
+    # #### The Shakespeare dataset
+    # 
+    # In this assignment, you will use a subset of the [Shakespeare dataset](http://shakespeare.mit.edu). It consists of a single text file with several excerpts concatenated together. The data is in raw text form, and so far has not yet had any preprocessing. 
+    # 
+    # Your goal is to construct an unsupervised character-level sequence model that can generate text according to a distribution learned from the dataset.
 
+    # #### Load and inspect the dataset
 
-# In[5]:
+    # In[4]:
 
 
-# Create a list of chunks of text
+    # Stream the text file in fixed-size blocks rather than reading it into one string
 
-text_chunks = text.split('.')
+    text_path = 'data/Shakespeare.txt'
 
 
-# To give you a feel for what the text looks like, we will print a few chunks from the list.
+    # In[5]:
 
-# In[6]:
 
+    # Create a lazy stream of chunks of text. Each call returns a fresh generator that yields
+    # the same chunks as text.split('.'), without holding the whole corpus in memory
 
-# Display some randomly selected text samples
+    def text_chunks():
+        return iter_text_chunks(text_path, delimiter='.')
 
-num_samples = 5
-inx = np.random.choice(len(text_chunks), num_samples, replace=False)
-for chunk in np.array(text_chunks)[inx]:
-    print(chunk)
 
+    # To give you a feel for what the text looks like, we will print a few chunks from the stream.
 
-# #### Create a character-level tokenizer
+    # In[6]:
 
-# You should now write a function that returns a `Tokenizer` object. The function takes a list of strings as an argument, and should create a `Tokenizer` according to the following specification:
-# 
-# * The number of tokens should be unlimited (there should be as many as required by the dataset).
-# * Tokens should be created at the character level (not at the word level, which is the default behaviour).
-# * No characters should be filtered out or ignored.
-# * The original capitalization should be retained (do not convert the text to lower case)
-# 
-# The `Tokenizer` should be fit to the `list_of_strings` argument and returned by the function. 
-# 
-# **Hint:** you may need to refer to the [documentation](https://www.tensorflow.org/api_docs/python/tf/keras/preprocessing/text/Tokenizer) for the `Tokenizer`.
 
-# In[7]:
+    # Display some randomly selected text samples
 
+    num_samples = 5
+    for chunk in sample_chunks(text_chunks(), num_samples):
+        print(chunk)
 
-#### GRADED CELL ####
 
-# Complete the following function.
-# Make sure not to change the function name or arguments.
+    # #### Create a character-level tokenizer
 
-def create_character_tokenizer(list_of_strings):
-    """
-    This function takes a list of strings as its argument. It should create 
-    and return a Tokenizer according to the above specifications. 
-    """
-    
-    tokenizer = Tokenizer(num_words=None, filters='', lower=False, split='', char_level=True)
-    tokenizer.fit_on_texts(list_of_strings)
-    
-    return tokenizer
+    # You should now write a function that returns a `Tokenizer` object. The function takes a list of strings as an argument, and should create a `Tokenizer` according to the following specification:
+    # 
+    # * The number of tokens should be unlimited (there should be as many as required by the dataset).
+    # * Tokens should be created at the character level (not at the word level, which is the default behaviour).
+    # * No characters should be filtered out or ignored.
+    # * The original capitalization should be retained (do not convert the text to lower case)
+    # 
+    # The `Tokenizer` should be fit to the `list_of_strings` argument and returned by the function. 
+    # 
+    # **Hint:** you may need to refer to the [documentation](https://www.tensorflow.org/api_docs/python/tf/keras/preprocessing/text/Tokenizer) for the `Tokenizer`.
 
+    # In[7]:
 
-# In[8]:
 
+    # The graded `create_character_tokenizer` function is defined in shakespeare_lm/preprocessing.py
 
-# Get the tokenizer
 
-tokenizer = create_character_tokenizer(text_chunks)
+    # In[8]:
 
 
-# #### Tokenize the text
-# 
-# You should now write a function to use the tokenizer to map each string in `text_chunks` to its corresponding encoded sequence. The following function takes a fitted `Tokenizer` object in the first argument (as returned by `create_character_tokenizer`) and a list of strings in the second argument. The function should return a list of lists, where each sublist is a sequence of integer tokens encoding the text sequences according to the mapping stored in the tokenizer.
-# 
-# **Hint:** you may need to refer to the [documentation](https://www.tensorflow.org/api_docs/python/tf/keras/preprocessing/text/Tokenizer) for the `Tokenizer`.
+    # Get the tokenizer. The vectorized CharacterCodec has the same API and assigns the same
+    # ids as the Keras Tokenizer, but encodes to numpy arrays without a per-character loop
 
-# In[9]:
+    use_character_codec = True
 
+    # Optionally encode the corpus once into a memory-mapped cache under ./cache/ and reuse it
+    # on later runs. The cache is rebuilt automatically when the text file changes
 
-#### GRADED CELL ####
+    use_corpus_cache = True
 
-# Complete the following function.
-# Make sure not to change the function name or arguments.
+    # The cells below that work on the cached token stream (sliding windows, TBPTT, bucketing,
+    # TFLite export) open the cache with this function, so they also run with
+    # use_corpus_cache = False: the cache is then built the first time one of them needs it
 
-def strings_to_sequences(tokenizer, list_of_strings):
-    """
-    This function takes a tokenizer object and a list of strings as its arguments.
-    It should use the tokenizer to map the text chunks to sequences of tokens and
-    then return this list of encoded sequences.
-    """
-    sentence_seq = tokenizer.texts_to_sequences(list_of_strings)
-    return sentence_seq
-    
+    def open_corpus_cache():
+        return load_or_build_cache(text_path, cache_dir='cache', delimiter='.')
 
+    if use_corpus_cache:
+        corpus_cache = open_corpus_cache()
+        tokenizer = corpus_cache.codec
+    elif use_character_codec:
+        tokenizer = CharacterCodec.from_texts(text_chunks())
+    else:
+        tokenizer = create_character_tokenizer(text_chunks())
 
-# In[10]:
 
+    # #### Tokenize the text
+    # 
+    # You should now write a function to use the tokenizer to map each string in `text_chunks` to its corresponding encoded sequence. The following function takes a fitted `Tokenizer` object in the first argument (as returned by `create_character_tokenizer`) and a list of strings in the second argument. The function should return a list of lists, where each sublist is a sequence of integer tokens encoding the text sequences according to the mapping stored in the tokenizer.
+    # 
+    # **Hint:** you may need to refer to the [documentation](https://www.tensorflow.org/api_docs/python/tf/keras/preprocessing/text/Tokenizer) for the `Tokenizer`.
 
-# Encode the text chunks into tokens
+    # In[9]:
 
-seq_chunks = strings_to_sequences(tokenizer, text_chunks)
 
+    # The graded `strings_to_sequences` function is defined in shakespeare_lm/preprocessing.py
 
-# #### Pad the encoded sequences and store them in a numpy array
 
-# Since not all of the text chunks are the same length, you will need to pad them in order to train on batches. You should now complete the following function, which takes the list of lists of tokens, and creates a single numpy array with the token sequences in the rows, according to the following specification:
-# 
-# * The longest allowed sequence should be 500 tokens. Any sequence that is longer should be shortened by truncating the beginning of the sequence.
-# * Use zeros for padding the sequences. The zero padding should be placed before the sequences as required.
-# 
-# The function should then return the resulting numpy array.
-# 
-# **Hint:** you may want to refer to the [documentation](https://www.tensorflow.org/api_docs/python/tf/keras/preprocessing/sequence/pad_sequences) for the `pad_sequences` function.
+    # In[10]:
 
-# In[11]:
 
+    # Encode the text chunks into tokens
 
-#### GRADED CELL ####
+    if use_corpus_cache:
+        seq_chunks = corpus_cache.sequences()
+    else:
+        seq_chunks = strings_to_sequences(tokenizer, text_chunks())
 
-# Complete the following function.
-# Make sure not to change the function name or arguments.
 
-def make_padded_dataset(sequence_chunks):
-    """
-    This function takes a list of lists of tokenized sequences, and transforms
-    them into a 2D numpy array, padding the sequences as necessary according to
-    the above specification. The function should then return the numpy array.
-    """
-    padded_seq_chunks = pad_sequences(sequence_chunks, maxlen=500, dtype='int32',
-                                      padding='pre', truncating='pre', value=0.0)
-    return padded_seq_chunks
-    
+    # #### Pad the encoded sequences and store them in a numpy array
 
+    # Since not all of the text chunks are the same length, you will need to pad them in order to train on batches. You should now complete the following function, which takes the list of lists of tokens, and creates a single numpy array with the token sequences in the rows, according to the following specification:
+    # 
+    # * The longest allowed sequence should be 500 tokens. Any sequence that is longer should be shortened by truncating the beginning of the sequence.
+    # * Use zeros for padding the sequences. The zero padding should be placed before the sequences as required.
+    # 
+    # The function should then return the resulting numpy array.
+    # 
+    # **Hint:** you may want to refer to the [documentation](https://www.tensorflow.org/api_docs/python/tf/keras/preprocessing/sequence/pad_sequences) for the `pad_sequences` function.
 
-# In[12]:
+    # In[11]:
 
 
-# Pad the token sequence chunks and get the numpy array
+    # The graded `make_padded_dataset` function is defined in shakespeare_lm/preprocessing.py
 
-padded_sequences = make_padded_dataset(seq_chunks)
 
+    # In[12]:
 
-# #### Create model inputs and targets
-# 
-# Now you are ready to build your RNN model. The model will receive a sequence of characters and predict the next character in the sequence. At training time, the model can be passed an input sequence, with the target sequence is shifted by one.
-# 
-# For example, the expression `To be or not to be` appears in Shakespeare's play 'Hamlet'. Given input `To be or not to b`, the correct prediction is `o be or not to be`. Notice that the prediction is the same length as the input!
-# 
-# ![sequence_prediction_example](data/rnn_example.png)
-# 
-# You should now write the following function to create an input and target array from the current `padded_sequences` array. The function has a single argument that is a 2D numpy array of shape `(num_examples, max_seq_len)`. It should fulfil the following specification:
-# 
-# * The function should return an input array and an output array, both of size `(num_examples, max_seq_len - 1)`.
-# * The input array should contain the first `max_seq_len - 1` tokens of each sequence. 
-# * The output array should contain the last `max_seq_len - 1` tokens of each sequence. 
-# 
-# The function should then return the tuple `(input_array, output_array)`. Note that it is possible to complete this function using numpy indexing alone!
 
-# In[13]:
+    # Pad the token sequence chunks and get the numpy array
 
+    if use_corpus_cache:
+        padded_sequences = corpus_cache.padded(maxlen=500)
+    else:
+        padded_sequences = make_padded_dataset(seq_chunks)
 
-#### GRADED CELL ####
 
-# Complete the following function.
-# Make sure not to change the function name or arguments.
+    # #### Create model inputs and targets
+    # 
+    # Now you are ready to build your RNN model. The model will receive a sequence of characters and predict the next character in the sequence. At training time, the model can be passed an input sequence, with the target sequence is shifted by one.
+    # 
+    # For example, the expression `To be or not to be` appears in Shakespeare's play 'Hamlet'. Given input `To be or not to b`, the correct prediction is `o be or not to be`. Notice that the prediction is the same length as the input!
+    # 
+    # ![sequence_prediction_example](data/rnn_example.png)
+    # 
+    # You should now write the following function to create an input and target array from the current `padded_sequences` array. The function has a single argument that is a 2D numpy array of shape `(num_examples, max_seq_len)`. It should fulfil the following specification:
+    # 
+    # * The function should return an input array and an output array, both of size `(num_examples, max_seq_len - 1)`.
+    # * The input array should contain the first `max_seq_len - 1` tokens of each sequence. 
+    # * The output array should contain the last `max_seq_len - 1` tokens of each sequence. 
+    # 
+    # The function should then return the tuple `(input_array, output_array)`. Note that it is possible to complete this function using numpy indexing alone!
 
-def create_inputs_and_targets(array_of_sequences):
-    """
-    This function takes a 2D numpy array of token sequences, and returns a tuple of two
-    elements: the first element is the input array and the second element is the output
-    array, which are defined according to the above specification.
-    """   
-    max_seq_len = max(len(seq) for seq in array_of_sequences)
-    in_arr = np.array([seq[:max_seq_len - 1] for seq in array_of_sequences])
-    ou_arr = np.array([seq[1:max_seq_len]    for seq in array_of_sequences])
-    return in_arr, ou_arr
-    
+    # In[13]:
 
 
-# In[14]:
+    # The graded `create_inputs_and_targets` function is defined in shakespeare_lm/preprocessing.py
 
 
-# Create the input and output arrays
+    # In[14]:
 
-input_seq, target_seq = create_inputs_and_targets(padded_sequences)
 
+    # Create the input and output arrays. Alternatively, cut aligned windows straight out of the
+    # cached token stream: no padding, and the arrays are strided views with no copy at all
 
-# #### Preprocess sequence array for stateful RNN
-# 
-# We will build our RNN language model to be stateful, so that the internal state of the RNN will be maintained across batches. For this to be effective, we need to make sure that each element of every batch follows on from the corresponding element of the preceding batch (you may want to look back at the "Stateful RNNs" reading notebook earlier in the week).
-# 
-# The following code processes the input and output sequence arrays so that they are ready to be split into batches for training a stateful RNN, by re-ordering the sequence examples (the rows) according to a specified batch size. 
+    use_sliding_windows = False
 
-# In[15]:
+    if use_sliding_windows:
+        corpus_cache = open_corpus_cache()
+        input_seq, target_seq = sliding_window_examples(corpus_cache.tokens, seq_len=499)
+    else:
+        input_seq, target_seq = create_inputs_and_targets(padded_sequences)
 
 
-# Fix the batch size for training
+    # #### Preprocess sequence array for stateful RNN
+    # 
+    # We will build our RNN language model to be stateful, so that the internal state of the RNN will be maintained across batches. For this to be effective, we need to make sure that each element of every batch follows on from the corresponding element of the preceding batch (you may want to look back at the "Stateful RNNs" reading notebook earlier in the week).
+    # 
+    # The following code processes the input and output sequence arrays so that they are ready to be split into batches for training a stateful RNN, by re-ordering the sequence examples (the rows) according to a specified batch size. 
 
-batch_size = 32
+    # In[15]:
 
 
-# In[16]:
+    # Fix the batch size for training
 
+    batch_size = 32
 
-# Prepare input and output arrays for training the stateful RNN
 
-num_examples = input_seq.shape[0]
+    # In[16]:
 
-num_processed_examples = num_examples - (num_examples % batch_size)
 
-input_seq = input_seq[:num_processed_examples]
-target_seq = target_seq[:num_processed_examples]
+    # Prepare input and output arrays for training the stateful RNN
 
-steps = int(num_processed_examples / 32)  # steps per epoch
+    num_examples = input_seq.shape[0]
 
-inx = np.empty((0,), dtype=np.int32)
-for i in range(steps):
-    inx = np.concatenate((inx, i + np.arange(0, num_processed_examples, steps)))
+    inx = stateful_order(num_examples, batch_size)
 
-input_seq_stateful = input_seq[inx]
-target_seq_stateful = target_seq[inx]
+    num_processed_examples = len(inx)
+    steps = num_processed_examples // batch_size  # steps per epoch
 
 
-# #### Split the data into training and validation sets
-# 
-# We will set aside approximately 20% of the data for validation.
+    # #### Split the data into training and validation sets
+    # 
+    # We will set aside approximately 20% of the data for validation.
 
-# In[17]:
+    # In[17]:
 
 
-# Create the training and validation splits
+    # Create the training and validation splits
 
-num_train_examples = int(batch_size * ((0.8 * num_processed_examples) // batch_size))
+    num_train_examples = int(batch_size * ((0.8 * num_processed_examples) // batch_size))
 
-input_train  = input_seq_stateful[ :num_train_examples]
-target_train = target_seq_stateful[:num_train_examples]
+    inx_train = inx[:num_train_examples]
+    inx_valid = inx[num_train_examples:]
 
-input_valid  = input_seq_stateful[ num_train_examples:]
-target_valid = target_seq_stateful[num_train_examples:]
 
+    # #### Create training and validation Dataset objects
+    # 
+    # You should now write a function to take the training and validation input and target arrays, and create training and validation `tf.data.Dataset` objects. The function takes an input array and target array in the first two arguments, and the batch size in the third argument. Your function should do the following:
+    # 
+    # * Create a `Dataset` using the `from_tensor_slices` static method, passing in a tuple of the input and output numpy arrays.
+    # * Batch the `Dataset` using the `batch_size` argument, setting `drop_remainder` to `True`. 
+    # 
+    # The function should then return the `Dataset` object.
 
-# #### Create training and validation Dataset objects
-# 
-# You should now write a function to take the training and validation input and target arrays, and create training and validation `tf.data.Dataset` objects. The function takes an input array and target array in the first two arguments, and the batch size in the third argument. Your function should do the following:
-# 
-# * Create a `Dataset` using the `from_tensor_slices` static method, passing in a tuple of the input and output numpy arrays.
-# * Batch the `Dataset` using the `batch_size` argument, setting `drop_remainder` to `True`. 
-# 
-# The function should then return the `Dataset` object.
+    # In[18]:
 
-# In[18]:
 
+    # The graded `make_Dataset` function is defined in shakespeare_lm/preprocessing.py
 
-#### GRADED CELL ####
 
-# Complete the following function.
-# Make sure not to change the function name or arguments.
+    # In[19]:
 
-def make_Dataset(input_array, target_array, batch_size):
-    """
-    This function takes two 2D numpy arrays in the first two arguments, and an integer
-    batch_size in the third argument. It should create and return a Dataset object 
-    using the two numpy arrays and batch size according to the above specification.
-    """
-    len_ = len(input_array)
-    dat = tf.data.Dataset.from_tensor_slices((input_array, target_array))
-    k = len_ // batch_size
-    dat = dat.batch(k)
-    return dat
 
+    # Create the training and validation Datasets. The production pipeline applies the stateful
+    # ordering batch by batch inside tf.data, instead of copying both arrays through `inx`, and
+    # gathers, caches and prefetches batches in parallel with the training step
 
-# In[19]:
+    use_production_pipeline = True
 
+    if use_production_pipeline:
+        train_data = make_pipeline_dataset(input_seq, target_seq, inx_train, batch_size)
+        valid_data = make_pipeline_dataset(input_seq, target_seq, inx_valid, batch_size)
+    else:
+        train_data = make_Dataset(input_seq[inx_train], target_seq[inx_train], batch_size)
+        valid_data = make_Dataset(input_seq[inx_valid], target_seq[inx_valid], batch_size)
 
-# Create the training and validation Datasets
 
-train_data = make_Dataset(input_train, target_train, batch_size)
-valid_data = make_Dataset(input_valid, target_valid, batch_size)
+    # Alternatively, train with truncated backpropagation through time: the cached token stream is
+    # laid out as `batch_size` contiguous tracks and walked in windows of 100 tokens, carrying the
+    # GRU state from one window to the next. No time step is spent on padding
 
+    use_tbptt = False
 
-# #### Build the recurrent neural network model
+    if use_tbptt:
+        corpus_cache = open_corpus_cache()
+        train_data, valid_data = make_tbptt_datasets(corpus_cache.tokens, batch_size, window=100)
 
-# You are now ready to build your RNN character-level language model. You should write the following function to build the model; the function takes arguments for the batch size and vocabulary size (number of tokens). Using the Sequential API, your function should build your model according to the following specifications:
-# 
-# * The first layer should be an Embedding layer with an embedding dimension of 256 and set the vocabulary size to `vocab_size` from the function argument.
-# * The Embedding layer should also mask the zero padding in the input sequences.
-# * The Embedding layer should also set the `batch_input_shape` to `(batch_size, None)` (a fixed batch size is required for stateful RNNs).
-# * The next layer should be a (uni-directional) GRU layer with 1024 units, set to be a stateful RNN layer.
-# * The GRU layer should return the full sequence, instead of just the output state at the final time step.
-# * The final layer should be a Dense layer with `vocab_size` units and no activation function.
-# 
-# In total, the network should have 3 layers.
 
-# In[20]:
+    # Or group chunks of similar length into buckets and pad each batch only to its own longest
+    # chunk, instead of padding every chunk to 500 tokens. Batches no longer continue each other,
+    # so the GRU state is then reset before every batch (reset_every=1 in CompiledTrainer, or a
+    # ResetStatesCallback with model.fit)
 
+    use_bucketing = False
 
-#### GRADED CELL ####
+    if use_bucketing:
+        corpus_cache = open_corpus_cache()
+        train_data, valid_data = make_bucketed_splits(corpus_cache, batch_size)
 
-# Complete the following function.
-# Make sure not to change the function name or arguments.
 
-def get_model(vocab_size, batch_size):
-    """
-    This function takes a vocabulary size and batch size, and builds and returns a 
-    Sequential model according to the above specification.
-    """
-    model = Sequential([
-        Embedding(input_dim=vocab_size, output_dim=256, mask_zero=True, batch_input_shape=(batch_size, None)),
-        GRU(units=1024, stateful=True, return_sequences=True, name='myGRU'),
-        Dense(units=vocab_size)
-    ])
-    return model
-    
+    # #### Build the recurrent neural network model
 
+    # You are now ready to build your RNN character-level language model. You should write the following function to build the model; the function takes arguments for the batch size and vocabulary size (number of tokens). Using the Sequential API, your function should build your model according to the following specifications:
+    # 
+    # * The first layer should be an Embedding layer with an embedding dimension of 256 and set the vocabulary size to `vocab_size` from the function argument.
+    # * The Embedding layer should also mask the zero padding in the input sequences.
+    # * The Embedding layer should also set the `batch_input_shape` to `(batch_size, None)` (a fixed batch size is required for stateful RNNs).
+    # * The next layer should be a (uni-directional) GRU layer with 1024 units, set to be a stateful RNN layer.
+    # * The GRU layer should return the full sequence, instead of just the output state at the final time step.
+    # * The final layer should be a Dense layer with `vocab_size` units and no activation function.
+    # 
+    # In total, the network should have 3 layers.
 
-# In[21]:
+    # In[20]:
 
 
-# Build the model and print the model summary
+    # The graded `get_model` function is defined in shakespeare_lm/model.py
 
-model = get_model(len(tokenizer.word_index) + 1, batch_size)
-model.summary()
 
+    # In[21]:
 
-# #### Compile and train the model
-# 
-# You are now ready to compile and train the model. For this model and dataset, the training time is very long. Therefore for this assignment it is not a requirement to train the model. We have pre-trained a model for you (using the code below) and saved the model weights, which can be loaded to get the model predictions. 
-# 
-# It is recommended to use accelerator hardware (e.g. using Colab) when training this model. It would also be beneficial to increase the size of the model, e.g. by stacking extra recurrent layers.
 
-# In[22]:
+    # Build the model and print the model summary. With mixed precision, the layers compute in
+    # bfloat16 while the weights are kept in float32
 
+    use_mixed_precision = False
 
-# Choose whether to train a new model or load the pre-trained model
+    set_mixed_precision(use_mixed_precision)
+    model = get_model(len(tokenizer.word_index) + 1, batch_size)
+    model.summary()
 
-skip_training = True
 
+    # #### Compile and train the model
+    # 
+    # You are now ready to compile and train the model. For this model and dataset, the training time is very long. Therefore for this assignment it is not a requirement to train the model. We have pre-trained a model for you (using the code below) and saved the model weights, which can be loaded to get the model predictions. 
+    # 
+    # It is recommended to use accelerator hardware (e.g. using Colab) when training this model. It would also be beneficial to increase the size of the model, e.g. by stacking extra recurrent layers.
 
-# In[23]:
+    # In[22]:
 
 
-# Compile and train the model, or load pre-trained weights
+    # Choose whether to train a new model or load the pre-trained model
 
-if not skip_training:
-    checkpoint_callback=tf.keras.callbacks.ModelCheckpoint(filepath='./models/ckpt',
-                                                           save_weights_only=True,
-                                                           save_best_only=True)
-    model.compile(optimizer='adam', loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-                  metrics=['sparse_categorical_accuracy'])
-    history = model.fit(train_data, epochs=15, validation_data=valid_data, 
-                        validation_steps=50, callbacks=[checkpoint_callback])
+    skip_training = True
 
+    # Choose whether to train with the compiled custom training loop instead of model.fit. Gradients
+    # can be accumulated over several stateful batches to increase the effective batch size
 
-# In[24]:
+    use_compiled_trainer = True
+    accumulation_steps = 1
 
+    # The compiled loop also checkpoints the full training state (weights, optimizer, GRU states and
+    # position in the epoch) in the background every `checkpoint_every` steps, keeps the last three,
+    # and writes models/history.json after every epoch. Re-running the training cell after an
+    # interruption resumes from the latest checkpoint
 
-# Save model history as a json file, or load it if using pre-trained weights
+    checkpoint_every = 500
 
-if not skip_training:
-    history_dict = dict()
-    for k, v in history.history.items():
-        history_dict[k] = [float(val) for val in history.history[k]]
-    with open('models/history.json', 'w+') as json_file:
-        json.dump(history_dict, json_file, sort_keys=True, indent=4)
-else:
-    with open('models/history.json', 'r') as json_file:
-        history_dict = json.load(json_file)
 
+    # In[23]:
 
-# #### Plot the learning curves
 
-# In[25]:
+    # Compile and train the model, or load pre-trained weights
 
+    if not skip_training and use_compiled_trainer:
+        trainer = CompiledTrainer(model, accumulation_steps=accumulation_steps,
+                                  reset_every=1 if use_bucketing else None)
+        checkpoint_manager = CheckpointManager(trainer, './models/checkpoints', every_steps=checkpoint_every,
+                                               max_to_keep=3)
+        history = trainer.fit(train_data, epochs=15, validation_data=valid_data, validation_steps=50,
+                              callbacks=[BestCheckpoint(model, './models/ckpt')], checkpoint=checkpoint_manager)
+        checkpoint_manager.close()
+    elif not skip_training:
+        checkpoint_callback=tf.keras.callbacks.ModelCheckpoint(filepath='./models/ckpt',
+                                                               save_weights_only=True,
+                                                               save_best_only=True)
+        model.compile(optimizer='adam', loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                      metrics=['sparse_categorical_accuracy'])
+        fit_callbacks = [checkpoint_callback] + ([ResetStatesCallback()] if use_bucketing else [])
+        history = model.fit(train_data, epochs=15, validation_data=valid_data, 
+                            validation_steps=50, callbacks=fit_callbacks).history
+    set_mixed_precision(False)
 
-# Run this cell to plot accuracy vs epoch and loss vs epoch
 
-plt.figure(figsize=(15,5))
-plt.subplot(121)
-plt.plot(history_dict['sparse_categorical_accuracy'])
-plt.plot(history_dict['val_sparse_categorical_accuracy'])
-plt.title('Accuracy vs. epochs')
-plt.ylabel('Accuracy')
-plt.xlabel('Epoch')
-plt.xticks(np.arange(len(history_dict['sparse_categorical_accuracy'])))
-ax = plt.gca()
-ax.set_xticklabels(1 + np.arange(len(history_dict['sparse_categorical_accuracy'])))
-plt.legend(['Training', 'Validation'], loc='lower right')
+    # In[24]:
 
-plt.subplot(122)
-plt.plot(history_dict['loss'])
-plt.plot(history_dict['val_loss'])
-plt.title('Loss vs. epochs')
-plt.ylabel('Loss')
-plt.xlabel('Epoch')
-plt.xticks(np.arange(len(history_dict['sparse_categorical_accuracy'])))
-ax = plt.gca()
-ax.set_xticklabels(1 + np.arange(len(history_dict['sparse_categorical_accuracy'])))
-plt.legend(['Training', 'Validation'], loc='upper right')
-plt.show() 
 
+    # Save model history as a json file, or load it if using pre-trained weights
 
-# #### Write a text generation algorithm
-# 
-# You can now use the model to generate text! In order to generate a single text sequence, the model needs to be rebuilt with a batch size of 1.
+    if not skip_training:
+        history_dict = dict()
+        for k, v in history.items():
+            history_dict[k] = [float(val) for val in history[k]]
+        with open('models/history.json', 'w+') as json_file:
+            json.dump(history_dict, json_file, sort_keys=True, indent=4)
+    else:
+        with open('models/history.json', 'r') as json_file:
+            history_dict = json.load(json_file)
 
-# In[26]:
 
+    # #### Plot the learning curves
 
-# Re-build the model and load the saved weights
+    # In[25]:
 
-model = get_model(len(tokenizer.word_index) + 1, batch_size=1)
-model.load_weights(tf.train.latest_checkpoint('./models/'))
-model.summary()
 
+    # Run this cell to plot accuracy vs epoch and loss vs epoch
 
-# An algorithm to generate text is as follows:
-# 
-# 1. Specify a seed string (e.g. `'ROMEO:'`) to get the network started, and a define number of characters for the model to generate, `num_generation_steps`.
-# 2. Tokenize this sentence to obtain a list containing one list of the integer tokens.
-# 3. Reset the initial state of the network. 
-# 4. Convert the token list into a Tensor (or numpy array) and pass it to your model as a batch of size one.
-# 5. Get the model prediction (logits) for the last time step and extract the state of the recurrent layer.
-# 6. Use the logits to construct a categorical distribution and sample a token from it.
-# 7. Repeat the following for `num_generation_steps - 1` steps:
-# 
-#     1. Use the saved state of the recurrent layer and the last sampled token to get new logit predictions
-#     2. Use the logits to construct a new categorical distribution and sample a token from it.
-#     3. Save the updated state of the recurrent layer.    
-# 
-# 8. Take the final list of tokens and convert to text using the Tokenizer.
-# 
-# Note that the internal state of the recurrent layer can be accessed using the `states` property. For the GRU layer, it is a list of one variable:
+    plot_history(history_dict)
 
-# In[27]:
 
+    # #### Write a text generation algorithm
+    # 
+    # You can now use the model to generate text! In order to generate a single text sequence, the model needs to be rebuilt with a batch size of 1.
 
-# Inspect the model's current recurrent state
+    # In[26]:
 
-model.layers[1].states
 
+    # Re-build the model and load the saved weights
 
-# We will break the algorithm down into two steps. First, you should now complete the following function that takes a sequence of tokens of any length and returns the model's prediction (the logits) for the last time step. The specification is as follows:
-# 
-# * The token sequence will be a python list, containing one list of integer tokens, e.g. `[[1, 2, 3, 4]]`
-# * The function should convert the list into a 2D Tensor or numpy array
-# * If the function argument `initial_state` is `None`, then the function should reset the state of the recurrent layer to zeros.
-# * Otherwise, if the function argument `initial_state` is a 2D Tensor or numpy array, assign the value of the internal state of the GRU layer to this argument.
-# * Get the model's prediction (logits) for the last time step only.
-# 
-# The function should then return the logits as a 2D numpy array, where the first dimension is equal to 1 (batch size).
-# 
-# **Hint:** the internal state of the recurrent can be reset to zeros using the `reset_states` method.
+    model = get_model(len(tokenizer.word_index) + 1, batch_size=1)
+    model.load_weights(tf.train.latest_checkpoint('./models/'))
+    model.summary()
 
-# In[28]:
 
+    # Optionally export one decoding step as a TFLite model with int8 weights, and compare its
+    # perplexity on held-out text, its latency and its size with the float model
 
-#### GRADED CELL ####
+    export_quantized_model = False
 
-# Complete the following function.
-# Make sure not to change the function name or arguments.
+    if export_quantized_model:
+        corpus_cache = open_corpus_cache()
+        export_tflite(model, './models/step_decoder_int8.tflite')
+        print(compare_models(model, './models/step_decoder_int8.tflite', corpus_cache.tokens[-2000:]))
 
-def get_logits(model, token_sequence, initial_state=None):
-    """
-    This function takes a model object, a token sequence and an optional initial
-    state for the recurrent layer. The function should return the logits prediction
-    for the final time step as a 2D numpy array.
-    """
-    arr2d = np.array(token_sequence)
-    print("arr2d=", arr2d.shape, "  len(initial_state.shape)=", len(initial_state.shape))
-    if initial_state is not None:
-        # initial_state 2D -> internal state of GRU
-        if len(initial_state.shape) == 2:
-            model.layers[1].reset_states(states=initial_state)
-    else:
-        # set state of the recurrent layer -> 0
-        model.reset_states()
-    pred = model.predict(arr2d, batch_size=1)      # <---- shape = (1, n)
-    return pred
-    
-    
 
+    # Optionally save the weights and vocabulary as a compact .npz for the pure-NumPy engine, which
+    # generates without importing TensorFlow: `python -m shakespeare_lm.numpy_engine models/model.npz 'ROMEO:'`
 
-# In[29]:
+    export_numpy_model = False
 
+    if export_numpy_model:
+        convert_model(model, './models/model.npz', tokenizer.word_index)
 
-# Test the get_logits function by passing a dummy token sequence
 
-dummy_initial_state = tf.random.normal(model.layers[1].states[0].shape)
+    # An algorithm to generate text is as follows:
+    # 
+    # 1. Specify a seed string (e.g. `'ROMEO:'`) to get the network started, and a define number of characters for the model to generate, `num_generation_steps`.
+    # 2. Tokenize this sentence to obtain a list containing one list of the integer tokens.
+    # 3. Reset the initial state of the network. 
+    # 4. Convert the token list into a Tensor (or numpy array) and pass it to your model as a batch of size one.
+    # 5. Get the model prediction (logits) for the last time step and extract the state of the recurrent layer.
+    # 6. Use the logits to construct a categorical distribution and sample a token from it.
+    # 7. Repeat the following for `num_generation_steps - 1` steps:
+    # 
+    #     1. Use the saved state of the recurrent layer and the last sampled token to get new logit predictions
+    #     2. Use the logits to construct a new categorical distribution and sample a token from it.
+    #     3. Save the updated state of the recurrent layer.    
+    # 
+    # 8. Take the final list of tokens and convert to text using the Tokenizer.
+    # 
+    # Note that the internal state of the recurrent layer can be accessed using the `states` property. For the GRU layer, it is a list of one variable:
 
-p = get_logits(model, [[1, 2, 3, 4]], initial_state=dummy_initial_state)
-print(p.shape)
+    # In[27]:
 
 
-# You should now write a function that takes a logits prediction similar to the above, uses it to create a categorical distribution, and samples a token from this distribution. The following function takes a 2D numpy array `logits` as an argument, and should return a single integer prediction that is sampled from the categorical distribution. 
-# 
-# **Hint:** you might find the `tf.random.categorical` function useful for this; see the documentation [here](https://www.tensorflow.org/api_docs/python/tf/random/categorical).
+    # Inspect the model's current recurrent state
 
-# In[30]:
+    model.layers[1].states
 
 
-#### GRADED CELL ####
+    # We will break the algorithm down into two steps. First, you should now complete the following function that takes a sequence of tokens of any length and returns the model's prediction (the logits) for the last time step. The specification is as follows:
+    # 
+    # * The token sequence will be a python list, containing one list of integer tokens, e.g. `[[1, 2, 3, 4]]`
+    # * The function should convert the list into a 2D Tensor or numpy array
+    # * If the function argument `initial_state` is `None`, then the function should reset the state of the recurrent layer to zeros.
+    # * Otherwise, if the function argument `initial_state` is a 2D Tensor or numpy array, assign the value of the internal state of the GRU layer to this argument.
+    # * Get the model's prediction (logits) for the last time step only.
+    # 
+    # The function should then return the logits as a 2D numpy array, where the first dimension is equal to 1 (batch size).
+    # 
+    # **Hint:** the internal state of the recurrent can be reset to zeros using the `reset_states` method.
 
-# Complete the following function.
-# Make sure not to change the function name or arguments.
+    # In[28]:
 
-def sample_token(logits):
-    """
-    This function takes a 2D numpy array as an input, and constructs a 
-    categorical distribution using it. It should then sample from this
-    distribution and return the sample as a single integer.
-    """
-    samples = tf.random.categorical(logits[0], 1)
-    return samples
 
+    # The graded `get_logits` function is defined in shakespeare_lm/model.py
 
-# In[32]:
 
+    # In[29]:
 
-# Test the sample_token function by passing dummy logits
 
-dummy_initial_state = tf.random.normal(model.layers[1].states[0].shape)
+    # Test the get_logits function by passing a dummy token sequence
 
-dummy_logits = get_logits(model, [[1, 2, 3, 4]], initial_state=dummy_initial_state)
+    dummy_initial_state = tf.random.normal(model.layers[1].states[0].shape)
 
-s = sample_token(dummy_logits)
+    p = get_logits(model, [[1, 2, 3, 4]], initial_state=dummy_initial_state)
+    print(p.shape)
 
-print("1 ..........", dummy_initial_state.shape)
-print("2 ..........", dummy_logits.shape)
-print("3 ..........", s.shape)
 
+    # You should now write a function that takes a logits prediction similar to the above, uses it to create a categorical distribution, and samples a token from this distribution. The following function takes a 2D numpy array `logits` as an argument, and should return a single integer prediction that is sampled from the categorical distribution. 
+    # 
+    # **Hint:** you might find the `tf.random.categorical` function useful for this; see the documentation [here](https://www.tensorflow.org/api_docs/python/tf/random/categorical).
 
-# In[34]:
+    # In[30]:
 
 
-logits_size  = dummy_logits.shape[1]
-dummy_logits = -np.inf*np.ones((1, logits_size))
-#dummy_logits[0, 20] = 0
-print(np.ones((1, logits_size)))
-print(logits_size)
-print(dummy_logits)
+    # The graded `sample_token` function is defined in shakespeare_lm/model.py
 
-sample_token(dummy_logits)
-random_inx = np.random.choice(logits_size, 2, replace=False)
-random_inx1, random_inx2 = random_inx[0], random_inx[1]
-print(random_inx1, random_inx2)
-dummy_logits = -np.inf*np.ones((1, logits_size))
-dummy_logits[0, random_inx1] = 0
-dummy_logits[0, random_inx2] = 0
-sampled_token = []
-for _ in range(100):
-    sampled_token.append(sample_token(dummy_logits))
-    
-l_tokens, l_counts = np.unique(np.array(sampled_token), return_counts=True)
-len(l_tokens) == 2
 
+    # In[32]:
 
-# #### Generate text from the model
-# 
-# You are now ready to generate text from the model!
 
-# In[1]:
+    # Test the sample_token function by passing dummy logits
+
+    dummy_initial_state = tf.random.normal(model.layers[1].states[0].shape)
+
+    dummy_logits = get_logits(model, [[1, 2, 3, 4]], initial_state=dummy_initial_state)
+
+    s = sample_token(dummy_logits)
+
+    print("1 ..........", dummy_initial_state.shape)
+    print("2 ..........", dummy_logits.shape)
+    print("3 ..........", s)
+
+
+    # In[34]:
+
+
+    logits_size  = dummy_logits.shape[1]
+    dummy_logits = -np.inf*np.ones((1, logits_size))
+    #dummy_logits[0, 20] = 0
+    print(np.ones((1, logits_size)))
+    print(logits_size)
+    print(dummy_logits)
+
+    sample_token(dummy_logits)
+    random_inx = np.random.choice(logits_size, 2, replace=False)
+    random_inx1, random_inx2 = random_inx[0], random_inx[1]
+    print(random_inx1, random_inx2)
+    dummy_logits = -np.inf*np.ones((1, logits_size))
+    dummy_logits[0, random_inx1] = 0
+    dummy_logits[0, random_inx2] = 0
+    sampled_token = []
+    for _ in range(100):
+        sampled_token.append(sample_token(dummy_logits))
+
+    l_tokens, l_counts = np.unique(np.array(sampled_token), return_counts=True)
+    len(l_tokens) == 2
+
+
+    # #### Generate text from the model
+    # 
+    # You are now ready to generate text from the model!
+
+    # In[1]:
+
+
+    # Create a seed string and number of generation steps
+
+    init_string = 'ROMEO:'
+    num_generation_steps = 1000
+
+
+    # In[2]:
+
+
+    # Use the model to generate a token sequence. The step decoder runs the whole generation loop,
+    # sampling included, as one compiled function, instead of one `predict` call per token. Set a
+    # seed in the sampler to make the generated text reproducible. The GRU state after each seed is
+    # kept in an LRU prefix cache, so repeated (or extended) seeds are not primed from scratch
+
+    use_step_decoder = True
+
+    sampler = Sampler(temperature=1.0, top_k=0, top_p=1.0, seed=None)
+
+    token_sequence = [list(tokenizer.texts_to_sequences([init_string])[0])]
+    decoder = StepDecoder(model)
+    prefix_cache = PrefixStateCache(decoder, max_bytes=64 << 20)
+
+    if use_step_decoder:
+        # A padding token leaves the cached state unchanged and recomputes the logits after the seed
+        _, seed_state = prefix_cache.prime(token_sequence[0])
+        generated, _ = decoder.sample_sequence([[0]], num_generation_steps, sampler, state=seed_state)
+        token_sequence[0].extend(generated[0].tolist())
+    else:
+        initial_state = None
+        input_sequence = token_sequence
+
+        for _ in range(num_generation_steps):
+            logits = get_logits(model, input_sequence, initial_state=initial_state)
+            sampled_token = sample_token(logits)
+            token_sequence[0].append(sampled_token)
+            input_sequence = [[sampled_token]]
+            initial_state = model.layers[1].states[0].numpy()
+
+    print(tokenizer.sequences_to_texts(token_sequence)[0][::2])
+
 
+    # Several seed strings can also be decoded together: each row of the batch carries its own GRU
+    # state, and finished rows are refilled from the queue of pending requests
 
-# Create a seed string and number of generation steps
+    seed_strings = ['ROMEO:', 'JULIET:', 'KING LEAR:', 'HAMLET:']
+    seed_tokens = [list(seq) for seq in tokenizer.texts_to_sequences(seed_strings)]
 
-init_string = 'ROMEO:'
-num_generation_steps = 1000
+    batch_model = get_model(len(tokenizer.word_index) + 1, batch_size=len(seed_strings))
+    batch_model.load_weights(tf.train.latest_checkpoint('./models/'))
+    batch_sequences = generate_batch(StepDecoder(batch_model), seed_tokens, num_steps=200)
 
+    for text in tokenizer.sequences_to_texts(batch_sequences):
+        print(text[::2])
+        print()
 
-# In[2]:
 
+    # For a deterministic, high-likelihood completion, use beam search instead of sampling
 
-# Use the model to generate a token sequence
+    beam_search = BeamSearchDecoder(decoder, beam_width=8, alpha=0.6, end_token=tokenizer.word_index['\n'])
+    seed_sequence = tokenizer.texts_to_sequences([init_string])[0]
 
-token_sequence = tokenizer.texts_to_sequences([init_string])
-initial_state = None
-input_sequence = token_sequence
+    for tokens, score in beam_search.search(seed_sequence, max_steps=100)[:3]:
+        print('{:.3f}'.format(score), init_string + tokenizer.sequences_to_texts([tokens])[0][::2])
 
-for _ in range(num_generation_steps):
-    logits = get_logits(model, input_sequence, initial_state=initial_state)
-    sampled_token = sample_token(logits)
-    token_sequence[0].append(sampled_token)
-    input_sequence = [[sampled_token]]
-    initial_state = model.layers[1].states[0].numpy()
-    
-print(tokenizer.sequences_to_texts(token_sequence)[0][::2])
+    if enable_instrumentation:
+        instrumentation.write('./models/metrics.json')
+        for stage, stats in instrumentation.summary().items():
+            print('{:>20s}: {:>8d} calls, p50 {:.2e}s, p99 {:.2e}s'.format(
+                stage, stats['count'], stats['p50_seconds'], stats['p99_seconds']))
 
 
-# Congratulations for completing this programming assignment! In the next week of the course we will see how to build customised models and layers, and make custom training loops.
+    # Congratulations for completing this programming assignment! In the next week of the course we will see how to build customised models and layers, and make custom training loops.
@@ -0,0 +1,7 @@
+"""
+Helpers for the character-level Shakespeare language model.
+
+The notebook export `Language_Model_for_Shakespeare_Dataset.py` walks through
+the assignment cell by cell; the modules in this package hold the supporting
+code that is too large to live in a notebook cell.
+"""
@@ -0,0 +1,241 @@
+"""
+Command line interface: `python -m shakespeare_lm <command> ...`.
+
+    preprocess  encode a text file, or a directory or glob of them, into the token cache
+    train       train the `get_model` network as in the notebook
+    generate    sample text from a trained model
+    eval        bits per character and perplexity of a checkpoint on a text file
+    convert     save a checkpoint as an .npz for the NumPy engine
+    serve       stream generations over HTTP from a batched NumPy engine
+
+TensorFlow is only imported by the commands that need it: `preprocess` and
+`generate --engine numpy` (the default), like every `--help`, run without it.
+
+Every command takes `--metrics PATH` to write per-stage timings (JSON, or
+Prometheus text for a `.prom` path) and `--profile LOGDIR` to record a
+`tf.profiler` trace.
+"""
+
+import argparse
+import os
+import sys
+
+from shakespeare_lm import instrumentation
+from shakespeare_lm.model import ARCHITECTURES, DEFAULT_VARIANT
+
+
+def preprocess(args):
+    from shakespeare_lm.sharding import load_corpus
+
+    corpus_cache = load_corpus(args.text, args.cache_dir, args.delimiter, args.workers)
+    print('{}: {:,} tokens in {:,} chunks, vocabulary of {}'.format(
+        corpus_cache.directory, len(corpus_cache.tokens), len(corpus_cache), corpus_cache.codec.vocab_size))
+
+
+def train(args):
+    import tensorflow as tf
+
+    from shakespeare_lm.checkpointing import CheckpointManager
+    from shakespeare_lm.model import get_model
+    from shakespeare_lm.pipeline import make_pipeline_dataset
+    from shakespeare_lm.preprocessing import create_inputs_and_targets
+    from shakespeare_lm.sharding import load_corpus
+    from shakespeare_lm.stateful import stateful_order
+    from shakespeare_lm.tbptt import make_tbptt_datasets
+    from shakespeare_lm.training import BestCheckpoint, CompiledTrainer
+
+    corpus_cache = load_corpus(args.text, args.cache_dir, workers=args.workers)
+    if args.tbptt_window:
+        train_data, valid_data = make_tbptt_datasets(corpus_cache.tokens, args.batch_size, args.tbptt_window)
+    else:
+        input_seq, target_seq = create_inputs_and_targets(corpus_cache.padded(maxlen=500))
+        inx = stateful_order(len(input_seq), args.batch_size)
+        num_train_examples = int(args.batch_size * ((0.8 * len(inx)) // args.batch_size))
+        train_data = make_pipeline_dataset(input_seq, target_seq, inx[:num_train_examples], args.batch_size)
+        valid_data = make_pipeline_dataset(input_seq, target_seq, inx[num_train_examples:], args.batch_size)
+
+    model = get_model(corpus_cache.codec.vocab_size, args.batch_size, args.variant)
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    trainer = CompiledTrainer(model, tf.keras.optimizers.Adam(), accumulation_steps=args.accumulation_steps)
+    # Resumes from the latest checkpoint under checkpoints/, and streams history.json after every epoch
+    checkpoint_manager = CheckpointManager(trainer, os.path.join(args.checkpoint_dir, 'checkpoints'),
+                                           every_steps=args.checkpoint_every, max_to_keep=args.keep_checkpoints)
+    history = trainer.fit(train_data, epochs=args.epochs, validation_data=valid_data, validation_steps=50,
+                          callbacks=[BestCheckpoint(model, os.path.join(args.checkpoint_dir, 'ckpt'))],
+                          checkpoint=checkpoint_manager)
+    checkpoint_manager.close()
+    if args.plot:
+        from shakespeare_lm.plotting import plot_history
+        plot_history(history, os.path.join(args.checkpoint_dir, 'history.png'))
+
+
+def generate(args):
+    if args.engine == 'numpy':
+        from shakespeare_lm.numpy_engine import NumpyGRU
+
+        engine = NumpyGRU(args.model or os.path.join(args.checkpoint_dir, 'model.npz'))
+        tokens = engine.generate(engine.codec.encode(args.seed_string), args.steps,
+                                 temperature=args.temperature, seed=args.random_seed)
+        print(engine.codec.decode(tokens))
+        return
+
+    import tensorflow as tf
+
+    from shakespeare_lm.inference import StepDecoder
+    from shakespeare_lm.model import get_model
+    from shakespeare_lm.sampling import Sampler
+    from shakespeare_lm.sharding import load_corpus
+
+    codec = load_corpus(args.train_text, args.cache_dir).codec
+    model = get_model(codec.vocab_size, batch_size=1, variant=args.variant)
+    model.load_weights(args.model or tf.train.latest_checkpoint(args.checkpoint_dir)).expect_partial()
+    # As with the NumPy engine, a temperature of 0 means greedy decoding
+    sampler = Sampler(temperature=args.temperature, top_k=args.top_k, top_p=args.top_p,
+                      greedy=args.temperature == 0, seed=args.random_seed)
+    seed_tokens = codec.encode(args.seed_string)
+    generated, _ = StepDecoder(model).sample_sequence([seed_tokens], args.steps, sampler)
+    print(codec.decode(list(seed_tokens) + generated[0].tolist()))
+
+
+def evaluate(args):
+    import tensorflow as tf
+
+    from shakespeare_lm.evaluate import evaluate_file
+    from shakespeare_lm.model import get_model
+
+    checkpoint = args.model or tf.train.latest_checkpoint(args.checkpoint_dir)
+    report = evaluate_file(args.text, checkpoint, args.train_text, args.cache_dir, args.batch_size, args.window,
+                           build_model=lambda vocab_size, batch_size: get_model(vocab_size, batch_size, args.variant))
+    for name, value in report.items():
+        print('{:>15s}: {:,.4f}'.format(name, value))
+
+
+def convert(args):
+    import tensorflow as tf
+
+    from shakespeare_lm.numpy_engine import convert_checkpoint
+    from shakespeare_lm.sharding import load_corpus
+
+    codec = load_corpus(args.train_text, args.cache_dir).codec
+    output = args.output or os.path.join(args.checkpoint_dir, 'model.npz')
+    convert_checkpoint(args.model or tf.train.latest_checkpoint(args.checkpoint_dir), output, codec.word_index,
+                       args.variant)
+    print('wrote {}'.format(output))
+
+
+def serve(args):
+    import asyncio
+
+    from shakespeare_lm.server import GenerationService, load_engine, serve as serve_http
+
+    model = args.model or os.path.join(args.checkpoint_dir, 'model.npz')
+    engine = load_engine(model, args.slots, args.train_text, args.cache_dir, args.variant)
+
+    async def run():
+        service = GenerationService(engine, batch_window=args.batch_window_ms / 1000, max_queue=args.max_queue,
+                                    max_tokens=args.max_tokens)
+        await serve_http(service, args.host, args.port, args.unix)
+
+    print('serving {} on {}'.format(model, args.unix or '{}:{}'.format(args.host, args.port)), flush=True)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m shakespeare_lm', description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='\n'.join(__doc__.strip().splitlines()[2:]))
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_command(name, handler, help):
+        command = commands.add_parser(name, help=help, description=help)
+        command.set_defaults(handler=handler)
+        command.add_argument('--cache-dir', default='cache')
+        command.add_argument('--metrics', metavar='PATH',
+                             help='write per-stage timings here (Prometheus text if it ends in .prom, else JSON)')
+        command.add_argument('--profile', metavar='LOGDIR', help='record a tf.profiler trace into this directory')
+        return command
+
+    def add_model_arguments(command):
+        command.add_argument('--checkpoint-dir', default='./models/')
+        command.add_argument('--model', help='checkpoint prefix (or .npz) instead of the latest in --checkpoint-dir')
+        command.add_argument('--train-text', default='data/Shakespeare.txt',
+                             help='training corpus (file, directory or glob) whose vocabulary the model uses')
+        add_variant_argument(command)
+
+    def add_workers_argument(command):
+        command.add_argument('--workers', type=int, help='preprocessing processes for a directory or glob '
+                             '(default: all cores)')
+
+    def add_variant_argument(command):
+        command.add_argument('--variant', choices=list(ARCHITECTURES), default=DEFAULT_VARIANT,
+                             help='model architecture (see shakespeare_lm.architectures)')
+
+    command = add_command('preprocess', preprocess,
+                          'encode a text file, or a directory or glob of them, into the token cache')
+    command.add_argument('text', help='text file, or directory or glob of text files encoded in parallel')
+    add_workers_argument(command)
+    command.add_argument('--delimiter', default='.')
+
+    command = add_command('train', train, 'train the model with the compiled training loop')
+    command.add_argument('text', nargs='?', default='data/Shakespeare.txt',
+                         help='text file, or directory or glob of text files')
+    add_workers_argument(command)
+    command.add_argument('--checkpoint-dir', default='./models/')
+    add_variant_argument(command)
+    command.add_argument('--epochs', type=int, default=15)
+    command.add_argument('--batch-size', type=int, default=32)
+    command.add_argument('--accumulation-steps', type=int, default=1)
+    command.add_argument('--tbptt-window', type=int, default=0,
+                         help='train on the continuous token stream in windows of this length')
+    command.add_argument('--checkpoint-every', type=int, default=500,
+                         help='steps between background checkpoints of the full training state')
+    command.add_argument('--keep-checkpoints', type=int, default=3)
+    command.add_argument('--plot', action='store_true', help='save the learning curves to history.png')
+
+    command = add_command('generate', generate, 'sample text from a trained model')
+    add_model_arguments(command)
+    command.add_argument('seed_string', nargs='?', default='ROMEO:')
+    command.add_argument('--steps', type=int, default=1000)
+    command.add_argument('--engine', choices=['numpy', 'tf'], default='numpy',
+                         help='numpy: the .npz of `convert`, without TensorFlow; tf: the Keras checkpoint')
+    command.add_argument('--temperature', type=float, default=1.0)
+    command.add_argument('--top-k', type=int, default=0, help='tf engine only')
+    command.add_argument('--top-p', type=float, default=1.0, help='tf engine only')
+    command.add_argument('--random-seed', type=int)
+
+    command = add_command('eval', evaluate, 'bits per character and perplexity on a text file')
+    add_model_arguments(command)
+    command.add_argument('text')
+    command.add_argument('--batch-size', type=int, default=64)
+    command.add_argument('--window', type=int, default=256)
+
+    command = add_command('convert', convert, 'save a checkpoint as an .npz for the NumPy engine')
+    add_model_arguments(command)
+    command.add_argument('--output', help='defaults to model.npz in --checkpoint-dir')
+
+    command = add_command('serve', serve, 'stream generations over HTTP from a batched NumPy engine')
+    add_model_arguments(command)
+    command.add_argument('--host', default='127.0.0.1')
+    command.add_argument('--port', type=int, default=8000)
+    command.add_argument('--unix', metavar='PATH', help='listen on this Unix socket instead of TCP')
+    command.add_argument('--slots', type=int, default=32, help='requests decoded together (rows of GRU state)')
+    command.add_argument('--batch-window-ms', type=float, default=5.0,
+                         help='wait this long after a prompt arrives at an idle service to batch others with it')
+    command.add_argument('--max-queue', type=int, default=1024)
+    command.add_argument('--max-tokens', type=int, default=2000,
+                         help='largest max_tokens a request may ask for (larger ones get 400)')
+
+    args = parser.parse_args(argv)
+    if args.metrics:
+        instrumentation.enable()
+    with instrumentation.trace(args.profile):
+        args.handler(args)
+    if args.metrics:
+        instrumentation.write(args.metrics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
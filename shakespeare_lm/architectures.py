@@ -0,0 +1,211 @@
+"""
+Compact variants of the `get_model` network, and a table to choose between them.
+
+The notebook model (Embedding(256) -> GRU(1024) -> Dense) spends almost all of
+its ~4M parameters and per-token time in the 1024-unit GRU, although the
+vocabulary has only about 65 characters. `build_model` builds the variants
+registered in `shakespeare_lm.model.ARCHITECTURES`, all with the same
+interface (a stateful Sequential model mapping token ids to logits):
+
+* narrower GRUs (`gru512`, `gru256`);
+* stacks of thin GRUs (`stacked2x256`, `stacked3x192`);
+* tied input/output embeddings (`tied512`): the logits are the final hidden
+  state, projected to the embedding width if needed, times the transposed
+  embedding matrix;
+* a low-rank output projection (`lowrank1024`): Dense(rank) -> Dense(vocab).
+
+`StepDecoder`, `NumpyGRU`, training and evaluation work with every variant; the
+state of a stack of GRUs is handled as the concatenation of the per-layer
+states. `architecture_table` reports the parameter count, the per-token decode
+latency (compiled TensorFlow step and NumPy engine) and, for variants with a
+trained checkpoint under `<checkpoint_root>/<variant>/`, the bits per
+character on a text file:
+
+    python -m shakespeare_lm train data/Shakespeare.txt --variant gru256 --checkpoint-dir models/gru256
+    python -m shakespeare_lm.architectures data/valid.txt --checkpoint-root models
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Dense, Embedding, GRU, Layer
+from tensorflow.keras.models import Sequential
+
+
+class TiedOutput(Layer):
+    """
+    Output projection sharing the matrix of an `Embedding` layer: maps
+    `(..., embedding_dim)` inputs to `(..., vocab_size)` logits as
+    `inputs @ embeddings^T + bias`. Only the bias is a weight of its own.
+    """
+
+    def __init__(self, embedding, **kwargs):
+        super().__init__(**kwargs)
+        self.embedding = embedding
+        self.units = embedding.input_dim
+
+    def build(self, input_shape):
+        self.bias = self.add_weight(name='bias', shape=(self.units,), initializer='zeros')
+        super().build(input_shape)
+
+    def call(self, inputs):
+        embeddings = tf.cast(self.embedding.embeddings, inputs.dtype)
+        return tf.matmul(inputs, embeddings, transpose_b=True) + tf.cast(self.bias, inputs.dtype)
+
+    def compute_mask(self, inputs, mask=None):
+        return mask
+
+
+def build_model(vocab_size, batch_size, embedding_dim=256, units=(1024,), tie_embeddings=False, output_rank=None):
+    """
+    This function builds a stateful Sequential model: Embedding(embedding_dim,
+    masking zeros) -> one stateful GRU per entry of `units`, returning
+    sequences -> logits over `vocab_size`, through a plain Dense layer, the
+    tied embedding matrix (`tie_embeddings`) or a Dense(output_rank) ->
+    Dense(vocab_size) factorization (`output_rank`).
+    """
+    if tie_embeddings and output_rank:
+        raise ValueError('tie_embeddings and output_rank are mutually exclusive.')
+    embedding = Embedding(input_dim=vocab_size, output_dim=embedding_dim, mask_zero=True,
+                          batch_input_shape=(batch_size, None))
+    layers = [embedding]
+    for i, width in enumerate(units):
+        layers.append(GRU(units=width, stateful=True, return_sequences=True,
+                          name='myGRU' if i == 0 else 'myGRU_{}'.format(i + 1)))
+    if tie_embeddings:
+        if units[-1] != embedding_dim:
+            layers.append(Dense(embedding_dim, use_bias=False, name='tied_projection'))
+        layers.append(TiedOutput(embedding, name='tied_output'))
+    elif output_rank:
+        layers.append(Dense(output_rank, use_bias=False, name='low_rank_projection'))
+        layers.append(Dense(vocab_size))
+    else:
+        layers.append(Dense(vocab_size))
+    return Sequential(layers)
+
+
+def split_layers(model):
+    """
+    This function returns the embedding layer, the list of GRU layers and the
+    list of output layers (applied in order to the last GRU's output) of a
+    model built by `get_model` or `build_model`.
+    """
+    grus = [layer for layer in model.layers if isinstance(layer, GRU)]
+    head = model.layers[model.layers.index(grus[-1]) + 1:]
+    return model.layers[0], grus, head
+
+
+def count_parameters(model):
+    """
+    This function returns the number of distinct weights of a built model
+    (the tied embedding matrix is counted once).
+    """
+    seen = {id(weight): weight for weight in model.weights if weight.trainable}
+    return int(sum(np.prod(weight.shape) for weight in seen.values()))
+
+
+def step_latency(model, num_tokens=200, seed=0):
+    """
+    This function returns the median per-token latency, in seconds, of the
+    compiled `StepDecoder.step` and of the `NumpyGRU` engine for a
+    `batch_size=1` model, over `num_tokens` random tokens.
+    """
+    from shakespeare_lm.inference import StepDecoder
+    from shakespeare_lm.numpy_engine import NumpyGRU, convert_model
+
+    tokens = np.random.default_rng(seed).integers(1, model.output_shape[-1], size=num_tokens).astype(np.int32)
+    decoder = StepDecoder(model)
+    state = decoder.zero_state(1)
+    decoder.step(tf.constant(tokens[:1]), state)     # trace before timing
+    times = []
+    for token in tokens:
+        start = time.perf_counter()
+        logits, state = decoder.step(tf.constant([token]), state)
+        logits.numpy()
+        times.append(time.perf_counter() - start)
+    tf_latency = float(np.median(times))
+
+    with tempfile.TemporaryDirectory() as directory:
+        npz_path = os.path.join(directory, 'model.npz')
+        convert_model(model, npz_path)
+        engine = NumpyGRU(npz_path)
+    times = []
+    for token in tokens:
+        start = time.perf_counter()
+        engine.step([token])
+        times.append(time.perf_counter() - start)
+    return tf_latency, float(np.median(times))
+
+
+def architecture_table(vocab_size, variants=None, eval_text=None, train_text='data/Shakespeare.txt',
+                       cache_dir='cache', checkpoint_root='./models/', batch_size=64, window=256,
+                       num_tokens=200):
+    """
+    This function returns one dict per variant (all of `ARCHITECTURES` by
+    default) with its parameter count, per-token decode latencies in ms and,
+    if `eval_text` is given and `<checkpoint_root>/<variant>/` holds a
+    checkpoint, its bits per character on `eval_text` (None otherwise).
+    """
+    from shakespeare_lm.evaluate import evaluate_file
+    from shakespeare_lm.model import ARCHITECTURES, get_model
+
+    rows = []
+    for variant in variants or ARCHITECTURES:
+        model = get_model(vocab_size, batch_size=1, variant=variant)
+        model.build((1, None))
+        checkpoint = tf.train.latest_checkpoint(os.path.join(checkpoint_root, variant))
+        if checkpoint:
+            model.load_weights(checkpoint).expect_partial()
+        tf_latency, numpy_latency = step_latency(model, num_tokens)
+        bits_per_char = None
+        if checkpoint and eval_text:
+            report = evaluate_file(eval_text, checkpoint, train_text, cache_dir, batch_size, window,
+                                   build_model=lambda vocab, batch, variant=variant: get_model(vocab, batch, variant))
+            bits_per_char = report['bits_per_char']
+        rows.append({
+            'variant': variant,
+            'parameters': count_parameters(model),
+            'tf_ms_per_token': 1000 * tf_latency,
+            'numpy_ms_per_token': 1000 * numpy_latency,
+            'bits_per_char': bits_per_char,
+        })
+    return rows
+
+
+def format_table(rows):
+    lines = ['| variant | parameters | TF step (ms/token) | NumPy step (ms/token) | bits/char |',
+             '|---|---:|---:|---:|---:|']
+    for row in rows:
+        bits_per_char = '-' if row['bits_per_char'] is None else '{:.3f}'.format(row['bits_per_char'])
+        lines.append('| {} | {:,} | {:.3f} | {:.3f} | {} |'.format(
+            row['variant'], row['parameters'], row['tf_ms_per_token'], row['numpy_ms_per_token'], bits_per_char))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    from shakespeare_lm.sharding import load_corpus
+    from shakespeare_lm.model import ARCHITECTURES
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('eval_text', nargs='?', help='text file for bits per character (skipped if omitted)')
+    parser.add_argument('--variants', nargs='+', choices=list(ARCHITECTURES), default=list(ARCHITECTURES))
+    parser.add_argument('--checkpoint-root', default='./models/',
+                        help='directory holding one checkpoint directory per variant')
+    parser.add_argument('--train-text', default='data/Shakespeare.txt',
+                        help='training corpus whose vocabulary the models use')
+    parser.add_argument('--cache-dir', default='cache')
+    parser.add_argument('--num-tokens', type=int, default=200, help='tokens timed per variant')
+    args = parser.parse_args(argv)
+
+    vocab_size = load_corpus(args.train_text, args.cache_dir).codec.vocab_size
+    rows = architecture_table(vocab_size, args.variants, args.eval_text, args.train_text, args.cache_dir,
+                              args.checkpoint_root, num_tokens=args.num_tokens)
+    print(format_table(rows))
+
+
+if __name__ == '__main__':
+    main()
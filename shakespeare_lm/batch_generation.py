@@ -0,0 +1,156 @@
+"""
+Batched text generation with continuous batching.
+
+The notebook generates one sequence at a time through a model rebuilt with
+`batch_size=1`. `BatchGenerator` instead decodes up to `num_slots` requests in
+lockstep through one `StepDecoder` call per step, with one row of GRU state per
+slot. Each slot first feeds its seed tokens one per step, then samples new
+tokens; when a request has generated `num_steps` tokens its slot is retired and
+the next queued request joins in its place on the following step, with its row
+of state reset to zeros.
+"""
+
+import collections
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from shakespeare_lm.instrumentation import instrument
+from shakespeare_lm.sampling import mask_padding
+
+
+def sample_categorical(logits):
+    """
+    This function takes a 2D array of logits and returns a 1D numpy array with
+    one token sampled from each row, never the padding id 0.
+    """
+    return tf.random.categorical(mask_padding(tf.cast(logits, tf.float32)), 1)[:, 0].numpy()
+
+
+class GenerationRequest:
+    """
+    One generation request: a non-empty sequence of seed tokens and the number
+    of tokens to generate after it. `tokens` holds the seed followed by the
+    tokens generated so far, and `done` is set once all have been generated.
+    """
+
+    def __init__(self, seed_tokens, num_steps):
+        self.tokens = list(np.asarray(seed_tokens).ravel().tolist())
+        if not self.tokens:
+            raise ValueError('A generation request needs at least one seed token.')
+        self.num_seed_tokens = len(self.tokens)
+        self.num_steps = num_steps
+        self.position = 0           # index in `tokens` of the next token to feed
+        self.done = num_steps == 0
+
+    @property
+    def generated(self):
+        return self.tokens[self.num_seed_tokens:]
+
+
+class BatchGenerator:
+    """
+    Continuous-batching generator over a `StepDecoder`. Submit requests with
+    `submit`, then call `step` (or `run`) until they are done; free slots are
+    refilled from the queue at the start of every step.
+    """
+
+    def __init__(self, decoder, num_slots, sample_fn=sample_categorical):
+        self.decoder = decoder
+        self.num_slots = num_slots
+        self.sample_fn = sample_fn
+        self.slots = [None] * num_slots
+        self.queue = collections.deque()
+        self.state = decoder.zero_state(num_slots)
+        self.num_generated = 0
+
+    def submit(self, seed_tokens, num_steps):
+        request = GenerationRequest(seed_tokens, num_steps)
+        if not request.done:
+            self.queue.append(request)
+        return request
+
+    @property
+    def active(self):
+        return any(request is not None for request in self.slots) or bool(self.queue)
+
+    def _fill_slots(self):
+        joined = np.zeros(self.num_slots, dtype=bool)
+        for i, request in enumerate(self.slots):
+            if request is None and self.queue:
+                self.slots[i] = self.queue.popleft()
+                joined[i] = True
+        if joined.any():
+            self.state = tf.where(joined[:, None], tf.zeros_like(self.state), self.state)
+
+    @instrument('batch_decode_step')
+    def step(self):
+        """
+        This function advances every occupied slot by one token and returns the
+        list of requests that finished during this step.
+        """
+        self._fill_slots()
+        inputs = np.zeros(self.num_slots, dtype=np.int32)   # empty slots feed padding
+        for i, request in enumerate(self.slots):
+            if request is not None:
+                inputs[i] = request.tokens[request.position]
+
+        logits, self.state = self.decoder.step(tf.constant(inputs), self.state)
+
+        # Rows that just consumed their last known token need a new sample
+        needs_sample = [i for i, request in enumerate(self.slots)
+                        if request is not None and request.position == len(request.tokens) - 1]
+        samples = self.sample_fn(tf.gather(logits, needs_sample)) if needs_sample else []
+
+        finished = []
+        for i, request in enumerate(self.slots):
+            if request is not None:
+                request.position += 1
+        for i, token in zip(needs_sample, samples):
+            request = self.slots[i]
+            request.tokens.append(int(token))
+            self.num_generated += 1
+            if len(request.generated) == request.num_steps:
+                request.done = True
+                self.slots[i] = None
+                finished.append(request)
+        return finished
+
+    def run(self):
+        while self.active:
+            self.step()
+
+
+def generate_batch(decoder, seeds, num_steps, num_slots=None, sample_fn=sample_categorical):
+    """
+    This function takes a `StepDecoder`, a list of seed token sequences and a
+    list (or single value) of numbers of tokens to generate, and returns the
+    list of generated token sequences (seed included), in the order of `seeds`.
+    """
+    if np.isscalar(num_steps):
+        num_steps = [num_steps] * len(seeds)
+    generator = BatchGenerator(decoder, num_slots or len(seeds), sample_fn)
+    requests = [generator.submit(seed, steps) for seed, steps in zip(seeds, num_steps)]
+    generator.run()
+    return [request.tokens for request in requests]
+
+
+def benchmark_batch_sizes(decoder, seed_tokens, num_steps=200, batch_sizes=(1, 2, 4, 8, 16, 32, 64)):
+    """
+    This function generates `num_steps` tokens from `seed_tokens` in batches of
+    each of the given sizes and returns a dict mapping batch size to the total
+    number of generated tokens per second.
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        generator = BatchGenerator(decoder, batch_size)
+        generator.submit(seed_tokens, 1)
+        generator.run()   # trace the step function outside the timing
+        generator.num_generated = 0
+        for _ in range(batch_size):
+            generator.submit(seed_tokens, num_steps)
+        start = time.perf_counter()
+        generator.run()
+        results[batch_size] = generator.num_generated / (time.perf_counter() - start)
+    return results
@@ -0,0 +1,117 @@
+"""
+Beam search decoding for the `get_model` network.
+
+Ancestral sampling produces a different continuation on every run. For
+deterministic, high-likelihood completions `BeamSearchDecoder` keeps the
+`beam_width` best partial sequences instead. The GRU states of all beams live
+in one `(beam_width, units)` tensor that is reordered with `tf.gather` after
+every step, and expanding the beams (gather, GRU step, log-softmax, top-k over
+all beam/token pairs) is a single compiled call, traced once per decoder and
+reused across searches.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from shakespeare_lm.sampling import mask_padding
+
+
+def length_penalty(length, alpha):
+    """
+    Length normalization of Wu et al. (2016): `((5 + length) / 6) ** alpha`.
+    With `alpha=0` the raw log-probabilities are compared.
+    """
+    return ((5.0 + length) / 6.0) ** alpha
+
+
+class BeamSearchDecoder:
+    """
+    Beam search over a `StepDecoder`. Hypotheses end when they produce
+    `end_token` (if given) or after `max_steps` tokens, and are ranked by their
+    log-probability divided by `length_penalty(length, alpha)`.
+    """
+
+    def __init__(self, decoder, beam_width=8, alpha=0.6, end_token=None, early_stopping=True):
+        self.decoder = decoder
+        self.beam_width = beam_width
+        self.alpha = alpha
+        self.end_token = end_token
+        self.early_stopping = early_stopping
+
+        state_spec = tf.TensorSpec([beam_width, decoder.units], tf.float32)
+        scores_spec = tf.TensorSpec([beam_width], tf.float32)
+        self._expand_from_logits = tf.function(self._candidates, input_signature=[
+            tf.TensorSpec([beam_width, decoder.vocab_size], tf.float32), scores_spec])
+        self._expand = tf.function(self._step_and_expand, input_signature=[
+            tf.TensorSpec([beam_width], tf.int32), tf.TensorSpec([beam_width], tf.int32),
+            state_spec, scores_spec])
+
+    def _candidates(self, logits, scores):
+        # Keep 2 * beam_width candidates so that beam_width of them are still alive
+        # even if every beam emits the end token
+        totals = tf.expand_dims(scores, 1) + tf.nn.log_softmax(mask_padding(logits))
+        top = tf.math.top_k(tf.reshape(totals, [-1]), k=2 * self.beam_width)
+        vocab_size = tf.shape(logits)[1]
+        return top.values, top.indices // vocab_size, top.indices % vocab_size
+
+    def _step_and_expand(self, beam_indices, tokens, state, scores):
+        state = tf.gather(state, beam_indices)
+        logits, state = self.decoder._step(tokens, state)
+        return self._candidates(logits, scores) + (state,)
+
+    def _normalized(self, score, length):
+        return score / length_penalty(length, self.alpha)
+
+    def search(self, seed_tokens, max_steps):
+        """
+        This function takes a 1D sequence of seed tokens and a maximum number of
+        tokens to generate, and returns a list of up to `beam_width` tuples
+        `(tokens, score)` of generated continuations and their normalized
+        log-probabilities, best first.
+        """
+        width = self.beam_width
+        logits, state = self.decoder.prime(tf.constant([list(seed_tokens)], dtype=tf.int32),
+                                           self.decoder.zero_state(1))
+        state = tf.tile(state, [width, 1])
+        # Only the first beam is live at the start, so the first expansion has no duplicates
+        scores = np.full(width, -np.inf, dtype=np.float32)
+        scores[0] = 0.0
+        cand_scores, cand_beams, cand_tokens = self._expand_from_logits(tf.tile(logits, [width, 1]), scores)
+
+        history = np.zeros((width, 0), dtype=np.int32)
+        finished = []
+        for length in range(1, max_steps + 1):
+            alive = []
+            for score, beam, token in zip(cand_scores.numpy(), cand_beams.numpy(), cand_tokens.numpy()):
+                if score == -np.inf or len(alive) == width:
+                    break
+                if token == self.end_token:
+                    finished.append((history[beam].tolist() + [int(token)],
+                                     self._normalized(float(score), length)))
+                else:
+                    alive.append((score, beam, token))
+            if not alive or self._done(finished, alive, length, max_steps):
+                break
+            # Pad with dead beams so that the compiled step always sees beam_width rows
+            alive += [(-np.inf, alive[0][1], alive[0][2])] * (width - len(alive))
+            scores, beams, tokens = (np.array(column) for column in zip(*alive))
+            scores, beams, tokens = scores.astype(np.float32), beams.astype(np.int32), tokens.astype(np.int32)
+            history = np.concatenate((history[beams], tokens[:, None]), axis=1)
+            if length == max_steps:
+                # Beams that ran out of steps are complete hypotheses too
+                finished.extend((history[beam].tolist(), self._normalized(float(scores[beam]), length))
+                                for beam in range(width) if scores[beam] > -np.inf)
+                break
+            cand_scores, cand_beams, cand_tokens, state = self._expand(beams, tokens, state, scores)
+
+        finished.sort(key=lambda hypothesis: hypothesis[1], reverse=True)
+        return finished[:width]
+
+    def _done(self, finished, alive, length, max_steps):
+        if len(finished) < self.beam_width:
+            return False
+        if self.early_stopping:
+            return True
+        # Otherwise stop only when no alive beam can still beat the worst finished one
+        best_alive = max(a[0] for a in alive) / length_penalty(max_steps if self.alpha > 0 else length, self.alpha)
+        return best_alive < min(score for _, score in finished)
@@ -0,0 +1,270 @@
+"""
+Benchmark suite for the preprocessing, training and generation hot paths.
+
+Every stage of the notebook is timed on a synthetic corpus of configurable
+size, so the numbers are reproducible offline and on CPU: the graded
+preprocessing functions, the stateful reordering, iterating `make_Dataset`,
+one training step of `get_model` and per-token generation through
+`get_logits`/`sample_token`, plus the `CharacterCodec` and `StepDecoder` fast
+paths for reference. Each stage records its best wall time over `repeats` runs,
+the peak resident memory while it ran and its throughput. Results are written
+as JSON and can be compared against a stored baseline, flagging any stage that
+got slower or uses more memory than the baseline allows.
+
+Run `python -m shakespeare_lm.benchmark --output results.json --baseline
+benchmarks/baseline.json`; the exit status is 1 if a regression was found.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+WORDS = ('the', 'and', 'to', 'of', 'my', 'thou', 'thy', 'that', 'is', 'not', 'with', 'me', 'be', 'his',
+         'your', 'this', 'king', 'lord', 'love', 'good', 'sir', 'shall', 'what', 'speak', 'night', 'death')
+NAMES = ('ROMEO', 'JULIET', 'HAMLET', 'KING LEAR', 'MACBETH', 'First Citizen', 'DUKE VINCENTIO')
+
+
+def synthetic_corpus(num_chars, seed=0):
+    """
+    This function returns a deterministic Shakespeare-like text of about
+    `num_chars` characters: speaker headers followed by '.'-terminated
+    sentences of random words, with the punctuation of the real corpus.
+    """
+    rng = np.random.default_rng(seed)
+    parts, size = [], 0
+    while size < num_chars:
+        words = [WORDS[i] for i in rng.integers(len(WORDS), size=rng.integers(3, 40))]
+        words[0] = words[0].capitalize()
+        sentence = ' '.join(words) + rng.choice(['.', '.', '.', ',', '!', '?', ';']) + ' '
+        if rng.random() < 0.1:
+            sentence = '\n\n' + NAMES[rng.integers(len(NAMES))] + ':\n' + sentence
+        parts.append(sentence)
+        size += len(sentence)
+    return ''.join(parts)[:num_chars]
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes (from /proc where available,
+    otherwise the lifetime peak reported by `getrusage`).
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class PeakRSS:
+    """
+    Context manager sampling the resident memory of the process in a
+    background thread; `peak` is the highest value seen (in bytes) and `delta`
+    its increase over the value on entry.
+    """
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = self.start = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    @property
+    def delta(self):
+        return self.peak - self.start
+
+
+def time_stage(function, num_items, unit, repeats=3):
+    """
+    This function calls `function()` `repeats` times and returns its last
+    result together with a dict of the best wall time, the peak and added
+    resident memory over all runs, and the throughput in `unit`s per second.
+    """
+    times = []
+    with PeakRSS() as rss:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start)
+    best = min(times)
+    return result, {
+        'seconds': best,
+        'median_seconds': float(np.median(times)),
+        'peak_rss_mb': rss.peak / 2 ** 20,
+        'rss_delta_mb': rss.delta / 2 ** 20,
+        'throughput': num_items / best,
+        'unit': unit + '/sec',
+    }
+
+
+def run_benchmarks(num_chars=1_000_000, batch_size=32, repeats=3, train_steps=3, generation_steps=50,
+                   seed=0, log=print):
+    """
+    This function runs every stage on a synthetic corpus of `num_chars`
+    characters and returns a dict with the configuration, the environment and
+    the per-stage results (see `time_stage`).
+    """
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')   # CPU only, for comparable numbers
+    import tensorflow as tf
+
+    from shakespeare_lm.codec import CharacterCodec
+    from shakespeare_lm.inference import StepDecoder
+    from shakespeare_lm.model import get_logits, get_model, sample_token
+    from shakespeare_lm.preprocessing import (create_character_tokenizer, create_inputs_and_targets,
+                                              make_Dataset, make_padded_dataset, strings_to_sequences)
+    from shakespeare_lm.sampling import Sampler
+    from shakespeare_lm.stateful import stateful_order
+
+    tf.random.set_seed(seed)
+    text_chunks = synthetic_corpus(num_chars, seed).split('.')
+    results = {}
+
+    def record(name, function, num_items, unit, stage_repeats=repeats):
+        result, results[name] = time_stage(function, num_items, unit, stage_repeats)
+        log('{:>26s}: {seconds:8.4f} s  {throughput:14,.1f} {unit}  peak RSS {peak_rss_mb:8.1f} MB'.format(
+            name, **results[name]))
+        return result
+
+    tokenizer = record('create_character_tokenizer', lambda: create_character_tokenizer(text_chunks),
+                       num_chars, 'chars')
+    seq_chunks = record('strings_to_sequences', lambda: strings_to_sequences(tokenizer, text_chunks),
+                        num_chars, 'chars')
+    codec = record('codec_fit', lambda: CharacterCodec.from_texts(text_chunks), num_chars, 'chars')
+    record('codec_texts_to_sequences', lambda: codec.texts_to_sequences(text_chunks), num_chars, 'chars')
+    padded = record('make_padded_dataset', lambda: make_padded_dataset(seq_chunks),
+                    len(seq_chunks), 'sequences')
+    input_seq, target_seq = record('create_inputs_and_targets', lambda: create_inputs_and_targets(padded),
+                                   len(padded), 'sequences')
+
+    def reorder():
+        inx = stateful_order(len(input_seq), batch_size)
+        return input_seq[inx], target_seq[inx]
+
+    input_seq, target_seq = record('stateful_reorder', reorder, len(input_seq), 'examples')
+
+    def iterate_dataset():
+        for inputs, targets in make_Dataset(input_seq, target_seq, batch_size):
+            pass
+
+    record('make_Dataset_iteration', iterate_dataset, len(input_seq) // batch_size * batch_size, 'examples')
+
+    vocab_size = len(tokenizer.word_index) + 1
+    model = get_model(vocab_size, batch_size)
+    model.compile(optimizer='adam', loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                  metrics=['sparse_categorical_accuracy'])
+    inputs, targets = input_seq[:batch_size], target_seq[:batch_size]
+    model.train_on_batch(inputs, targets)   # trace outside the timing
+    record('train_step', lambda: model.train_on_batch(inputs, targets), inputs.size, 'tokens',
+           stage_repeats=train_steps)
+
+    generation_model = get_model(vocab_size, batch_size=1)
+    generation_model.set_weights(model.get_weights())
+    seed_tokens = [list(seq_chunks[0][:20]) or [1]]
+
+    def generate_with_get_logits():
+        tokens = list(seed_tokens[0])
+        logits = get_logits(generation_model, seed_tokens)
+        for _ in range(generation_steps):
+            tokens.append(sample_token(logits))
+            state = generation_model.layers[1].states[0].numpy()
+            logits = get_logits(generation_model, [[tokens[-1]]], initial_state=state)
+        return tokens
+
+    generate_with_get_logits()
+    record('get_logits_generation', generate_with_get_logits, generation_steps, 'tokens')
+
+    decoder = StepDecoder(generation_model)
+    sampler = Sampler(seed=seed)
+    decoder.sample_sequence(seed_tokens, generation_steps, sampler)
+    record('step_decoder_generation', lambda: decoder.sample_sequence(seed_tokens, generation_steps, sampler),
+           generation_steps, 'tokens')
+
+    return {
+        'config': {'num_chars': num_chars, 'batch_size': batch_size, 'repeats': repeats,
+                   'train_steps': train_steps, 'generation_steps': generation_steps, 'seed': seed},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'tensorflow': tf.__version__, 'machine': platform.machine(),
+                        'cpu_count': os.cpu_count()},
+        'results': results,
+    }
+
+
+def compare(report, baseline, time_tolerance=0.25, memory_tolerance=0.25, time_slack=0.005, memory_slack_mb=32.0):
+    """
+    This function compares the stage results of `report` with those of
+    `baseline` (two dicts as returned by `run_benchmarks`) and returns a list
+    of regressions: stages whose best time grew by more than `time_tolerance`
+    plus `time_slack` seconds, or whose added memory grew by more than
+    `memory_tolerance` plus `memory_slack_mb`. The absolute slacks keep
+    millisecond-scale stages and allocator noise from being flagged. Stages
+    missing from either side are ignored.
+    """
+    if report['config'] != baseline['config']:
+        raise ValueError('The baseline was recorded with a different configuration: {}'.format(baseline['config']))
+    regressions = []
+    for name, result in report['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None:
+            continue
+        if result['seconds'] > reference['seconds'] * (1 + time_tolerance) + time_slack:
+            regressions.append('{}: {:.4f} s vs {:.4f} s in the baseline'.format(
+                name, result['seconds'], reference['seconds']))
+        if result['rss_delta_mb'] > reference['rss_delta_mb'] * (1 + memory_tolerance) + memory_slack_mb:
+            regressions.append('{}: {:.1f} MB added vs {:.1f} MB in the baseline'.format(
+                name, result['rss_delta_mb'], reference['rss_delta_mb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chars', type=int, default=1_000_000, help='size of the synthetic corpus')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--train-steps', type=int, default=3)
+    parser.add_argument('--generation-steps', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative slowdown (and memory growth) before flagging a regression')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.chars, args.batch_size, args.repeats, args.train_steps,
+                            args.generation_steps, args.seed)
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, sort_keys=True, indent=4)
+    if args.baseline:
+        with open(args.baseline) as json_file:
+            regressions = compare(report, json.load(json_file), args.tolerance, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+Length-bucketed batching of the '.'-delimited chunks.
+
+`make_padded_dataset` pads every chunk to 500 tokens although most chunks are
+much shorter. `make_bucketed_dataset` groups chunks of similar length with
+`Dataset.bucket_by_sequence_length` and pads each batch only to its own longest
+chunk. Batches keep a fixed `batch_size` (as required by the stateful model),
+but consecutive batches no longer continue each other's rows, so the GRU state
+should be reset before every batch (`CompiledTrainer(model, reset_every=1)`, or
+the `ResetStatesCallback` with `model.fit`).
+
+With `loss_weights=True` the dataset also yields a 0/1 weight per position, so
+that `model.fit` ignores padding in the loss; `CompiledTrainer` always does.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+DEFAULT_BOUNDARIES = (16, 32, 64, 128, 256)
+
+
+def make_bucketed_dataset(tokens, offsets, batch_size, maxlen=500, boundaries=DEFAULT_BOUNDARIES,
+                          loss_weights=False, shuffle_buffer=None):
+    """
+    This function takes the concatenated token stream and chunk offsets (as
+    stored by `shakespeare_lm.cache`) and returns a `Dataset` of
+    `(input, target)` batches (plus weights with `loss_weights=True`), built
+    from chunks truncated at the front to `maxlen` tokens, bucketed by length
+    with the given `boundaries`, and padded at the end to each batch's maximum.
+    """
+    chunks = tf.RaggedTensor.from_row_splits(np.asarray(tokens, dtype=np.int32),
+                                             np.asarray(offsets, dtype=np.int64))
+    dataset = tf.data.Dataset.from_tensor_slices(chunks)
+    dataset = dataset.map(lambda chunk: chunk[-maxlen:])
+    dataset = dataset.filter(lambda chunk: tf.size(chunk) >= 2)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.map(lambda chunk: (chunk[:-1], chunk[1:]))
+    dataset = dataset.bucket_by_sequence_length(
+        element_length_func=lambda inputs, targets: tf.size(inputs),
+        bucket_boundaries=list(boundaries),
+        bucket_batch_sizes=[batch_size] * (len(boundaries) + 1),
+        padded_shapes=([None], [None]),
+        padding_values=(0, 0),
+        drop_remainder=True)
+    if loss_weights:
+        dataset = dataset.map(lambda inputs, targets: (inputs, targets, tf.cast(inputs != 0, tf.float32)))
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def split_chunks(corpus_cache, train_fraction=0.8):
+    """
+    This function splits the chunks of a `TokenCache` into a training and a
+    validation part and returns a `(tokens, offsets)` pair for each. Each part
+    gets only its own slice of the token stream, with offsets rebased to
+    start at 0.
+    """
+    num_train_chunks = int(train_fraction * len(corpus_cache))
+    offsets = np.asarray(corpus_cache.offsets)
+    return [(corpus_cache.tokens[part[0]:part[-1]], part - part[0])
+            for part in (offsets[:num_train_chunks + 1], offsets[num_train_chunks:])]
+
+
+def make_bucketed_splits(corpus_cache, batch_size, train_fraction=0.8, **kwargs):
+    """
+    This function returns a `(train_data, valid_data)` pair of
+    `make_bucketed_dataset` datasets over the two parts of `split_chunks`.
+    """
+    return tuple(make_bucketed_dataset(tokens, offsets, batch_size, **kwargs)
+                 for tokens, offsets in split_chunks(corpus_cache, train_fraction))
+
+
+class ResetStatesCallback(tf.keras.callbacks.Callback):
+    """
+    Keras callback resetting the GRU states before every training and
+    evaluation batch, for `model.fit` on bucketed batches whose rows do not
+    continue each other.
+    """
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.model.reset_states()
+
+    def on_test_batch_begin(self, batch, logs=None):
+        self.model.reset_states()
+
+
+def padding_stats(dataset, num_batches=None):
+    """
+    This function iterates over (at most `num_batches` batches of) a dataset
+    of `(input, target, ...)` batches and returns a dict with the number of
+    positions, the fraction of them that is padding, and the number of real
+    tokens delivered per second by the pipeline.
+    """
+    positions = padding = 0
+    start = time.perf_counter()
+    for batch in dataset.take(num_batches) if num_batches else dataset:
+        inputs = batch[0].numpy()
+        positions += inputs.size
+        padding += int(np.count_nonzero(inputs == 0))
+    elapsed = time.perf_counter() - start
+    return {
+        'positions': positions,
+        'padding_ratio': padding / max(positions, 1),
+        'pipeline_tokens_per_sec': (positions - padding) / elapsed,
+    }
+
+
+def training_tokens_per_sec(trainer, dataset, num_batches):
+    """
+    This function runs `num_batches` training steps of a `CompiledTrainer`
+    (after one untimed step for tracing) and returns the number of real,
+    non-padding tokens trained on per second.
+    """
+    batches = [batch[:2] for batch in dataset.take(num_batches + 1)]
+    trainer.train_step(0, *batches[0])
+    real_tokens = 0
+    start = time.perf_counter()
+    for step, (inputs, targets) in enumerate(batches[1:], start=1):
+        loss, _ = trainer.train_step(step, inputs, targets)
+        real_tokens += int(np.count_nonzero(inputs.numpy()))
+    float(loss)   # wait for the last step
+    return real_tokens / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    import sys
+
+    from shakespeare_lm.cache import load_or_build_cache
+
+    corpus_cache = load_or_build_cache(sys.argv[1] if len(sys.argv) > 1 else 'data/Shakespeare.txt')
+    fixed = tf.data.Dataset.from_tensor_slices(corpus_cache.padded(maxlen=500)).batch(32, drop_remainder=True)
+    fixed = fixed.map(lambda batch: (batch[:, :-1], batch[:, 1:]))
+    bucketed = make_bucketed_dataset(corpus_cache.tokens, corpus_cache.offsets, batch_size=32)
+    for name, dataset in [('fixed-500', fixed), ('bucketed', bucketed)]:
+        stats = padding_stats(dataset)
+        print('{:>10s}: {positions:,} positions, padding ratio {padding_ratio:.3f}, '
+              '{pipeline_tokens_per_sec:,.0f} tokens/sec'.format(name, **stats))
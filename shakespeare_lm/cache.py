@@ -0,0 +1,230 @@
+"""
+Memory-mapped, pre-tokenized corpus cache.
+
+Tokenizing, padding and shifting the whole corpus on every run is the slowest
+part of start-up. `load_or_build_cache` encodes the corpus once into a
+directory holding
+
+* `tokens.bin`: the concatenated token ids of all chunks (uint8 or uint16),
+* `offsets.npy`: the start of every chunk in `tokens.bin`, plus the end,
+* `vocab.json`: the codec vocabulary (the Keras `word_index`),
+* `meta.json`: the cache key and the layout of `tokens.bin`,
+
+and later runs simply `np.memmap` the files. The directory is named after the
+file and a hash of its absolute path and imposed vocabulary (see
+`cache_directory`). The cache key is a SHA-256 hash of the source text and the
+tokenizer settings, so editing the corpus or changing the delimiter or
+vocabulary triggers a rebuild.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from shakespeare_lm.codec import CharacterCodec
+from shakespeare_lm.corpus import DEFAULT_BLOCK_SIZE, iter_text_chunks
+from shakespeare_lm.instrumentation import instrument
+
+
+CACHE_FORMAT_VERSION = 1
+
+
+def hash_file(path, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    This function takes a file path and returns the hex SHA-256 digest of its
+    contents, reading the file one block at a time.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(source_hash, delimiter, codec=None):
+    """
+    This function combines the hash of the source text with the tokenizer
+    settings into a single cache key. A `codec` is only part of the key when a
+    fixed vocabulary is imposed; otherwise the vocabulary is fitted to the text.
+    """
+    settings = {
+        'version': CACHE_FORMAT_VERSION,
+        'source': source_hash,
+        'delimiter': delimiter,
+        'vocabulary': None if codec is None else codec.word_index,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class TokenCache:
+    """
+    Read-only view of a cache directory written by `build_cache`. The token
+    stream and chunk offsets are memory-mapped, so opening a cache costs a few
+    file-system calls regardless of the corpus size.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as json_file:
+            self.meta = json.load(json_file)
+        with open(os.path.join(directory, 'vocab.json'), 'r', encoding='utf-8') as json_file:
+            self.codec = CharacterCodec.from_json(json_file.read())
+        num_tokens = self.meta['num_tokens']
+        if num_tokens:
+            self.tokens = np.memmap(os.path.join(directory, 'tokens.bin'), dtype=self.meta['dtype'],
+                                    mode='r', shape=(num_tokens,))
+        else:
+            self.tokens = np.zeros((0,), dtype=self.meta['dtype'])
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+
+    @property
+    def key(self):
+        return self.meta['key']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def sequence(self, i):
+        """
+        Token ids of chunk `i`, as a view into the memory-mapped stream.
+        """
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def sequences(self):
+        """
+        This function returns a list with one memory-mapped view per chunk, in
+        the same form as `strings_to_sequences`.
+        """
+        offsets = np.asarray(self.offsets)
+        return np.split(self.tokens, offsets[1:-1])
+
+    @instrument('pad')
+    def padded(self, maxlen=500):
+        """
+        This function returns the chunks as a 2D int32 array padded and truncated
+        at the front to `maxlen`, identical to `make_padded_dataset`, but built
+        with one vectorized gather of strided windows over the token stream.
+        """
+        offsets = np.asarray(self.offsets)
+        lengths = np.minimum(np.diff(offsets), maxlen)
+        # The window ending at a chunk's end holds its last `maxlen` tokens, preceded by
+        # tokens of earlier chunks (or the leading zeros) which are then zeroed out
+        stream = np.concatenate((np.zeros(maxlen, dtype=self.tokens.dtype), self.tokens))
+        windows = np.lib.stride_tricks.sliding_window_view(stream, maxlen)
+        padded = windows[offsets[1:]].astype(np.int32)
+        padded[np.arange(maxlen) < (maxlen - lengths)[:, None]] = 0
+        return padded
+
+
+@instrument('build_cache')
+def build_cache(path, directory, delimiter='.', codec=None, source_hash=None,
+                block_size=DEFAULT_BLOCK_SIZE):
+    """
+    This function encodes the text file at `path`, split into chunks on
+    `delimiter`, and writes the cache files into `directory`. The corpus is
+    streamed twice (once to fit the vocabulary unless `codec` is given, once to
+    encode it), so memory stays bounded by the block size. The cache is written
+    to a temporary directory and moved into place once complete.
+    """
+    if source_hash is None:
+        source_hash = hash_file(path, block_size)
+    key = cache_key(source_hash, delimiter, codec)
+    if codec is None:
+        codec = CharacterCodec.from_texts(iter_text_chunks(path, delimiter, block_size))
+
+    tmp_directory = directory + '.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    all_lengths = []
+    with open(os.path.join(tmp_directory, 'tokens.bin'), 'wb') as token_file:
+        for ids, lengths in codec.encode_batches(iter_text_chunks(path, delimiter, block_size)):
+            token_file.write(ids.astype(codec.dtype).tobytes())
+            all_lengths.append(lengths)
+    lengths = np.concatenate(all_lengths) if all_lengths else np.zeros((0,), dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    np.save(os.path.join(tmp_directory, 'offsets.npy'), offsets)
+
+    with open(os.path.join(tmp_directory, 'vocab.json'), 'w', encoding='utf-8') as json_file:
+        json_file.write(codec.to_json())
+    stat = os.stat(path)
+    meta = {
+        'key': key,
+        'source': os.path.abspath(path),
+        'source_hash': source_hash,
+        'source_size': stat.st_size,
+        'source_mtime_ns': stat.st_mtime_ns,
+        'delimiter': delimiter,
+        'dtype': np.dtype(codec.dtype).name,
+        'num_tokens': int(offsets[-1]),
+        'num_chunks': len(lengths),
+    }
+    with open(os.path.join(tmp_directory, 'meta.json'), 'w', encoding='utf-8') as json_file:
+        json.dump(meta, json_file, sort_keys=True, indent=4)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+    return TokenCache(directory)
+
+
+def cache_directory(path, cache_dir='cache', codec=None):
+    """
+    This function returns the directory under `cache_dir` holding the cache of
+    the text file at `path`: its base name followed by a hash of its absolute
+    path and of the imposed `codec` vocabulary, if any, so that same-named
+    files in different folders, or one file encoded with different
+    vocabularies, never overwrite each other's cache.
+    """
+    identity = {'path': os.path.abspath(path), 'vocabulary': None if codec is None else codec.word_index}
+    digest = hashlib.sha256(json.dumps(identity, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, '{}-{}'.format(os.path.basename(path), digest[:16]))
+
+
+def _current_cache(path, directory, delimiter, codec, block_size):
+    """
+    This function returns the `TokenCache` in `directory` if its key matches
+    the text file at `path`, or None, together with the hash of the source if
+    it had to be computed (None otherwise).
+    """
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None, None
+    with open(meta_path, 'r', encoding='utf-8') as json_file:
+        meta = json.load(json_file)
+    stat = os.stat(path)
+    if (meta['source_size'], meta['source_mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+        source_hash = meta['source_hash']
+    else:
+        source_hash = hash_file(path, block_size)
+    if meta['key'] != cache_key(source_hash, delimiter, codec):
+        return None, source_hash
+    if (meta['source_size'], meta['source_mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+        # Same contents with a new timestamp: record it to skip hashing next time
+        meta.update(source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+        with open(meta_path, 'w', encoding='utf-8') as json_file:
+            json.dump(meta, json_file, sort_keys=True, indent=4)
+    return TokenCache(directory), source_hash
+
+
+def load_or_build_cache(path, cache_dir='cache', delimiter='.', codec=None,
+                        block_size=DEFAULT_BLOCK_SIZE):
+    """
+    This function returns a `TokenCache` for the text file at `path`, reusing
+    the cache under `cache_dir` when its key matches and rebuilding it otherwise.
+    The source is only re-hashed when its size or modification time changed
+    since the cache was written, so a warm start is just a file map. With a
+    `codec`, the cache fitted on the file itself is reused if its vocabulary is
+    the same (e.g. when evaluating on the training corpus).
+    """
+    if codec is not None:
+        fitted, _ = _current_cache(path, cache_directory(path, cache_dir), delimiter, None, block_size)
+        if fitted is not None and fitted.codec.word_index == codec.word_index:
+            return fitted
+    directory = cache_directory(path, cache_dir, codec)
+    corpus_cache, source_hash = _current_cache(path, directory, delimiter, codec, block_size)
+    if corpus_cache is not None:
+        return corpus_cache
+    return build_cache(path, directory, delimiter, codec, source_hash, block_size)
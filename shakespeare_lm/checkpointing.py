@@ -0,0 +1,220 @@
+"""
+Asynchronous checkpoints with exact mid-epoch resume for `CompiledTrainer`.
+
+`ModelCheckpoint` writes the weights on the training thread, and the notebook
+only writes `models/history.json` once all epochs are done. `CheckpointManager`
+instead copies everything needed to continue training to host memory (model
+weights, optimizer slots and step counter, gradient accumulators, the GRU
+states and the position in the epoch, with the running loss totals and the
+history so far) and hands the copy to a background thread that writes it. The
+training thread only pays for the copy; serialization and disk I/O overlap with
+the next steps.
+
+Checkpoints are directories `ckpt-<global step>` holding one `.npy` file per
+variable and `meta.json`, written to a temporary directory and renamed into place, so a
+crash never leaves a partial checkpoint; only the newest `max_to_keep` are kept.
+After every epoch the history is also written to `history_path`.
+
+    manager = CheckpointManager(trainer, './models/checkpoints', every_steps=200)
+    history = trainer.fit(train_data, epochs=15, validation_data=valid_data, checkpoint=manager)
+
+Calling `fit` again with the same manager (e.g. after a crash) restores the
+latest checkpoint and continues from the same batch of the same epoch.
+"""
+
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+
+import numpy as np
+
+
+class CheckpointManager:
+    """
+    Periodic background checkpoints of a `CompiledTrainer` every `every_steps`
+    training steps and at the end of every epoch, keeping the newest
+    `max_to_keep` under `directory`, and streaming the history to
+    `history_path` (`history.json` next to `directory` by default).
+    """
+
+    def __init__(self, trainer, directory='./models/checkpoints', every_steps=500, max_to_keep=3,
+                 history_path=None):
+        self.trainer = trainer
+        self.directory = directory
+        self.every_steps = every_steps
+        self.max_to_keep = max_to_keep
+        self.history_path = os.path.abspath(
+            history_path or os.path.join(os.path.dirname(os.path.abspath(directory)), 'history.json'))
+        self.global_step = 0
+        self._queue = queue.Queue(maxsize=2)
+        self._error = None
+        self._writer = None
+
+    # Variable groups, in a fixed order so that a snapshot maps back to the same variables
+
+    def _variable_groups(self):
+        model = self.trainer.model
+        optimizer = self.trainer.optimizer
+        optimizer.build(model.trainable_variables)   # no-op once built; creates the slots before a restore
+        states = []
+        for layer in model.layers:
+            if getattr(layer, 'stateful', False):
+                if layer.states[0] is None:
+                    layer.reset_states()
+                states.extend(layer.states)
+        return {
+            'model': model.weights,
+            'optimizer': optimizer.variables,
+            'accumulators': self.trainer.gradients,
+            'states': states,
+        }
+
+    def _snapshot(self):
+        arrays = {}
+        for group, variables in self._variable_groups().items():
+            for i, variable in enumerate(variables):
+                # Copy: the buffer behind a CPU tensor may be reused by the next in-place update
+                arrays['{}/{}'.format(group, i)] = np.array(variable.numpy(), copy=True)
+        return arrays
+
+    # Background writer
+
+    def _ensure_writer(self):
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        if sys.platform.startswith('linux'):
+            # Lowest priority for this thread only, so that writes yield the CPU to training
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        while True:
+            job = self._queue.get()
+            try:
+                if job is not None:
+                    job()
+            except Exception as error:   # re-raised on the training thread
+                self._error = error
+            finally:
+                self._queue.task_done()
+            if job is None:
+                return
+
+    def _submit(self, job):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        self._ensure_writer()
+        self._queue.put(job)
+
+    def wait(self):
+        """
+        This function blocks until every submitted write has finished, and
+        raises the first error of the background writer, if any.
+        """
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    # Writing
+
+    def _write_checkpoint(self, arrays, meta):
+        name = 'ckpt-{}'.format(meta['global_step'])
+        path = os.path.join(self.directory, name)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        # One uncompressed .npy per variable: no zip checksums to compute on the shared CPU
+        for key, array in arrays.items():
+            np.save(os.path.join(tmp_path, key.replace('/', '.') + '.npy'), array)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as json_file:
+            json.dump(meta, json_file, sort_keys=True, indent=4)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        for old in self.checkpoints()[:-self.max_to_keep]:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def _write_history(self, history):
+        os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+        tmp_path = self.history_path + '.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(history, json_file, sort_keys=True, indent=4)
+        os.replace(tmp_path, self.history_path)
+
+    def checkpoints(self):
+        """
+        This function returns the paths of the complete checkpoints under
+        `directory`, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        steps = sorted(int(name[len('ckpt-'):]) for name in os.listdir(self.directory)
+                       if name.startswith('ckpt-') and name[len('ckpt-'):].isdigit())
+        return [os.path.join(self.directory, 'ckpt-{}'.format(step)) for step in steps]
+
+    def save(self, epoch, step, totals, history):
+        """
+        This function snapshots the training state at `step` batches into
+        `epoch` and queues it for writing; it returns once the state has been
+        copied to host memory.
+        """
+        meta = {
+            'epoch': epoch,
+            'step': step,
+            'global_step': self.global_step,
+            'totals': [float(total) for total in totals],
+            'history': {name: list(values) for name, values in history.items()},
+        }
+        arrays = self._snapshot()
+        self._submit(lambda: self._write_checkpoint(arrays, meta))
+
+    # Hooks called by `CompiledTrainer.fit`
+
+    def on_step_end(self, epoch, step, totals, history):
+        self.global_step += 1
+        if self.every_steps and self.global_step % self.every_steps == 0:
+            self.save(epoch, step, totals, history)
+
+    def on_epoch_end(self, epoch, history):
+        history = {name: list(values) for name, values in history.items()}
+        self.save(epoch + 1, 0, [0.0, 0.0], history)
+        self._submit(lambda: self._write_history(history))
+
+    def restore(self, path=None):
+        """
+        This function loads the checkpoint at `path` (the latest one by
+        default) into the trainer's model, optimizer, accumulators and GRU
+        states, and returns its metadata (`epoch`, `step`, `global_step`,
+        `totals`, `history`), or None if there is no checkpoint.
+        """
+        self.wait()
+        if path is None:
+            checkpoints = self.checkpoints()
+            if not checkpoints:
+                return None
+            path = checkpoints[-1]
+        with open(os.path.join(path, 'meta.json')) as json_file:
+            meta = json.load(json_file)
+        for group, variables in self._variable_groups().items():
+            for i, variable in enumerate(variables):
+                value = np.load(os.path.join(path, '{}.{}.npy'.format(group, i)))
+                if tuple(value.shape) != tuple(variable.shape):
+                    raise ValueError('Checkpoint {} does not match the model: {} {} has shape {}, '
+                                     'expected {}.'.format(path, group, i, value.shape, variable.shape))
+                variable.assign(value)
+        self.global_step = meta['global_step']
+        return meta
+
+    def close(self):
+        """
+        This function waits for the pending writes and stops the writer thread.
+        """
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._writer = None
+        self.wait()
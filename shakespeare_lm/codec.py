@@ -0,0 +1,272 @@
+"""
+Vectorized character codec.
+
+`CharacterCodec` is a drop-in replacement for the Keras
+`Tokenizer(char_level=True, filters='', lower=False)` used in the notebook.
+The vocabulary is built from one `np.bincount` pass per block of text, and
+encoding/decoding goes through lookup-table arrays instead of a Python loop per
+character. Token ids are assigned exactly as Keras assigns them (descending
+frequency, ties broken by first occurrence, starting at 1), so checkpoints
+trained with the Keras tokenizer under `./models/` remain valid.
+"""
+
+import json
+import time
+
+import numpy as np
+
+from shakespeare_lm.corpus import iter_text_chunks
+from shakespeare_lm.instrumentation import instrument
+
+
+ENCODE_BATCH_CHARS = 1 << 22   # characters encoded per vectorized batch
+
+
+def text_to_codepoints(text):
+    """
+    This function takes a string and returns its Unicode code points as a
+    1D uint32 numpy array.
+    """
+    return np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+
+
+def codepoints_to_text(codepoints):
+    """
+    This function takes an array of Unicode code points and returns the
+    corresponding string.
+    """
+    return np.ascontiguousarray(codepoints, dtype='<u4').tobytes().decode('utf-32-le')
+
+
+def _batched_texts(texts, batch_chars=ENCODE_BATCH_CHARS):
+    """
+    This function takes an iterable of strings and yields lists of them whose
+    total length is about `batch_chars`, so that they can be processed with a
+    single vectorized call.
+    """
+    batch, size = [], 0
+    for text in texts:
+        batch.append(text)
+        size += len(text)
+        if size >= batch_chars:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def _first_positions(codepoints, chars):
+    """
+    This function takes an array of code points and a list of code points that
+    occur in it, and returns a dict mapping each of them to the index of its
+    first occurrence. New characters almost always appear near the start of a
+    block, so growing prefixes are searched before falling back to the whole array.
+    """
+    if not chars:
+        return {}
+    window = 1 << 12
+    while True:
+        prefix = codepoints[:window]
+        uniq, first = np.unique(prefix, return_index=True)
+        positions = dict(zip(uniq.tolist(), first.tolist()))
+        if window >= len(codepoints) or all(char in positions for char in chars):
+            return {char: positions[char] for char in chars}
+        window *= 8
+
+
+class CharacterCodec:
+    """
+    Character-level tokenizer exposing the subset of the Keras `Tokenizer` API
+    used by the notebook (`fit_on_texts`, `texts_to_sequences`,
+    `sequences_to_texts`, `word_index`, `index_word`), plus `encode`/`decode`
+    for single strings. Sequences are returned as numpy int32 arrays.
+    """
+
+    def __init__(self, word_index=None):
+        self._counts = {}      # code point -> [count, first position]
+        self._seen = 0         # number of characters fitted so far
+        self._set_vocabulary(word_index or {})
+
+    @classmethod
+    def from_texts(cls, texts):
+        codec = cls()
+        codec.fit_on_texts(texts)
+        return codec
+
+    @classmethod
+    def merged(cls, codecs):
+        """
+        Combine codecs fitted on consecutive parts of a corpus (e.g. one file
+        each, in order) into the codec `fit_on_texts` would give on all of
+        them: counts are summed, and ties are broken by first occurrence in the
+        concatenated parts.
+        """
+        merged = cls()
+        for codec in codecs:
+            for char, (count, first) in codec._counts.items():
+                entry = merged._counts.get(char)
+                if entry is None:
+                    merged._counts[char] = [count, merged._seen + first]
+                else:
+                    entry[0] += count
+            merged._seen += codec._seen
+        merged._set_vocabulary(merged._fitted_word_index())
+        return merged
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer):
+        """
+        Build a codec sharing the vocabulary of a fitted Keras `Tokenizer`.
+        """
+        return cls(tokenizer.word_index)
+
+    @classmethod
+    def from_json(cls, json_string):
+        return cls(json.loads(json_string))
+
+    def to_json(self):
+        return json.dumps(self.word_index, ensure_ascii=False)
+
+    def _set_vocabulary(self, word_index):
+        self.word_index = dict(word_index)
+        self.index_word = {i: c for c, i in self.word_index.items()}
+        vocab_size = len(self.word_index) + 1
+        self.dtype = np.uint8 if vocab_size <= 1 << 8 else np.uint16 if vocab_size <= 1 << 16 else np.uint32
+
+        # id -> code point (id 0 is padding and decodes to nothing)
+        self._decode_table = np.zeros(vocab_size, dtype=np.uint32)
+        # code point -> id, with one trailing zero entry for unknown code points
+        max_codepoint = max((ord(c) for c in self.word_index), default=0)
+        self._encode_table = np.zeros(max_codepoint + 2, dtype=np.int32)
+        for char, i in self.word_index.items():
+            self._decode_table[i] = ord(char)
+            self._encode_table[ord(char)] = i
+
+    @property
+    def vocab_size(self):
+        """
+        Number of ids including the padding id 0, i.e. `len(word_index) + 1`.
+        """
+        return len(self.word_index) + 1
+
+    @instrument('fit_vocabulary')
+    def fit_on_texts(self, texts):
+        """
+        This function takes an iterable of strings (which may be a generator)
+        and updates the vocabulary with their characters.
+        """
+        for batch in _batched_texts(texts):
+            codepoints = text_to_codepoints(''.join(batch))
+            counts = np.bincount(codepoints)
+            chars = np.flatnonzero(counts)
+            new_chars = [char for char in chars.tolist() if char not in self._counts]
+            first = _first_positions(codepoints, new_chars)
+            for char in chars.tolist():
+                entry = self._counts.get(char)
+                if entry is None:
+                    self._counts[char] = [int(counts[char]), self._seen + first[char]]
+                else:
+                    entry[0] += int(counts[char])
+            self._seen += len(codepoints)
+        self._set_vocabulary(self._fitted_word_index())
+
+    def _fitted_word_index(self):
+        # Most frequent first, ties in order of first occurrence, as in Keras
+        ordered = sorted(self._counts.items(), key=lambda item: (-item[1][0], item[1][1]))
+        return {chr(char): i + 1 for i, (char, _) in enumerate(ordered)}
+
+    def encode_codepoints(self, codepoints):
+        """
+        This function takes an array of code points and returns an array of the
+        same length holding their ids, with 0 for characters not in the vocabulary.
+        """
+        table = self._encode_table
+        return table.take(np.minimum(codepoints, len(table) - 1))
+
+    def encode(self, text):
+        """
+        This function takes a string and returns its token ids as a 1D int32
+        array. Characters outside the vocabulary are dropped, as in Keras.
+        """
+        ids = self.encode_codepoints(text_to_codepoints(text))
+        return ids[ids != 0]
+
+    def decode(self, sequence):
+        """
+        This function takes a sequence of token ids and returns the decoded
+        string. Padding and unknown ids are skipped.
+        """
+        sequence = np.asarray(sequence, dtype=np.int64).ravel()
+        sequence = sequence[(sequence > 0) & (sequence < self.vocab_size)]
+        return codepoints_to_text(self._decode_table[sequence])
+
+    def texts_to_sequences(self, texts):
+        """
+        This function takes an iterable of strings and returns a list with one
+        int32 array of token ids per string. Strings are encoded in large
+        concatenated batches, so the per-string cost is a single array split.
+        """
+        sequences = []
+        for ids, lengths in self.encode_batches(texts):
+            sequences.extend(np.split(ids, np.cumsum(lengths)[:-1]))
+        return sequences
+
+    def encode_batches(self, texts):
+        """
+        This function takes an iterable of strings and yields tuples
+        `(ids, lengths)`, where `ids` is the concatenated encoding of a batch of
+        consecutive strings and `lengths` holds the number of ids of each string.
+        """
+        for batch in _batched_texts(texts):
+            lengths = np.fromiter((len(text) for text in batch), dtype=np.int64, count=len(batch))
+            ids = self.encode_codepoints(text_to_codepoints(''.join(batch)))
+            known = ids != 0
+            kept = np.concatenate(([0], np.cumsum(known)))[np.cumsum(lengths)]
+            yield ids[known], np.diff(kept, prepend=0)
+
+    def sequences_to_texts(self, sequences):
+        """
+        This function takes a list of token id sequences and returns a list of
+        strings. As with the Keras tokenizer, characters are joined with spaces.
+        """
+        return [' '.join(self.decode(sequence)) for sequence in sequences]
+
+
+def benchmark(path, delimiter='.'):
+    """
+    This function fits and applies both the Keras `Tokenizer` and the
+    `CharacterCodec` to the text file at `path`, checks that they assign the
+    same ids, and returns a dict of timings in seconds.
+    """
+    from tensorflow.keras.preprocessing.text import Tokenizer
+
+    chunks = list(iter_text_chunks(path, delimiter=delimiter))
+    timings = {}
+
+    start = time.perf_counter()
+    tokenizer = Tokenizer(num_words=None, filters='', lower=False, split='', char_level=True)
+    tokenizer.fit_on_texts(chunks)
+    timings['keras_fit'] = time.perf_counter() - start
+    start = time.perf_counter()
+    keras_sequences = tokenizer.texts_to_sequences(chunks)
+    timings['keras_encode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    codec = CharacterCodec.from_texts(chunks)
+    timings['codec_fit'] = time.perf_counter() - start
+    start = time.perf_counter()
+    codec_sequences = codec.texts_to_sequences(chunks)
+    timings['codec_encode'] = time.perf_counter() - start
+
+    assert codec.word_index == tokenizer.word_index
+    assert all(np.array_equal(a, b) for a, b in zip(keras_sequences, codec_sequences))
+    timings['speedup'] = ((timings['keras_fit'] + timings['keras_encode']) /
+                          (timings['codec_fit'] + timings['codec_encode']))
+    return timings
+
+
+if __name__ == '__main__':
+    import sys
+
+    for name, value in benchmark(sys.argv[1] if len(sys.argv) > 1 else 'data/Shakespeare.txt').items():
+        print('{:>14s}: {:.4f}'.format(name, value))
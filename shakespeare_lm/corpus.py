@@ -0,0 +1,69 @@
+"""
+Streaming ingestion of raw text corpora.
+
+The notebook originally read the whole file with `file.read()` and split it
+with `text.split('.')`, which keeps two full copies of the corpus in memory.
+The generators below read the file in fixed-size blocks instead, so peak memory
+is bounded by `block_size` plus the longest single chunk.
+"""
+
+import random
+
+
+DEFAULT_BLOCK_SIZE = 1 << 20   # characters read per block
+
+
+def iter_blocks(path, block_size=DEFAULT_BLOCK_SIZE, encoding='utf-8'):
+    """
+    This function takes the path of a text file and yields its contents as
+    consecutive strings of at most `block_size` characters.
+    """
+    with open(path, 'r', encoding=encoding) as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+def split_blocks(blocks, delimiter='.'):
+    """
+    This function takes an iterable of text blocks and yields the chunks of the
+    concatenated text separated by `delimiter`. A chunk that straddles a block
+    boundary is stitched back together, so the output is identical to
+    `''.join(blocks).split(delimiter)`.
+    """
+    tail = ''
+    for block in blocks:
+        parts = (tail + block).split(delimiter)
+        tail = parts.pop()
+        yield from parts
+    yield tail
+
+
+def iter_text_chunks(path, delimiter='.', block_size=DEFAULT_BLOCK_SIZE, encoding='utf-8'):
+    """
+    This function takes the path of a text file and lazily yields the same
+    chunks as `open(path).read().split(delimiter)`, reading the file one block
+    at a time.
+    """
+    return split_blocks(iter_blocks(path, block_size, encoding), delimiter)
+
+
+def sample_chunks(chunks, num_samples, seed=None):
+    """
+    This function takes an iterable of text chunks and returns `num_samples` of
+    them chosen uniformly at random without replacement, in a single pass and
+    without holding the whole iterable in memory (reservoir sampling).
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for i, chunk in enumerate(chunks):
+        if i < num_samples:
+            reservoir.append(chunk)
+        else:
+            j = rng.randint(0, i)
+            if j < num_samples:
+                reservoir[j] = chunk
+    rng.shuffle(reservoir)
+    return reservoir
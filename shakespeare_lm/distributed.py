@@ -0,0 +1,240 @@
+"""
+Data-parallel training across processes with `MultiWorkerMirroredStrategy`.
+
+Keras refuses to build stateful RNNs inside a `tf.distribute` strategy scope,
+so the strategy is used as a process group only: every worker builds its own
+copy of the `get_model` network outside the scope, worker 0's initial weights
+are broadcast with a collective all-reduce, and each step all-reduces (averages)
+the gradients before every worker applies them with its own optimizer. The
+weights therefore stay identical, while each worker's GRU state follows its own
+streams.
+
+The stateful batch ordering is split by stream: with `num_workers` workers of
+`batch_size` rows each, the global order is computed for `num_workers *
+batch_size` streams and worker `w` owns streams `w * batch_size` to
+`(w + 1) * batch_size - 1`, so each replica keeps contiguous state streams.
+
+Run `python -m shakespeare_lm.distributed launch --num-workers 4 <text file>`
+to start local worker processes, or `... scaling --max-workers 4 <text file>`
+to report the scaling efficiency from 1 to N workers.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def worker_stream_indices(num_examples, batch_size, num_workers, worker_index):
+    """
+    This function returns the stateful index array of worker `worker_index`:
+    its `batch_size` streams out of the `num_workers * batch_size` streams of
+    the global stateful order, so that row `j` of every local batch continues
+    row `j` of the previous local batch.
+    """
+    from shakespeare_lm.stateful import stateful_order
+
+    global_batch = batch_size * num_workers
+    order = stateful_order(num_examples, global_batch).reshape(-1, global_batch)
+    return order[:, worker_index * batch_size:(worker_index + 1) * batch_size].ravel()
+
+
+def tf_config(num_workers, worker_index, port_base):
+    return json.dumps({
+        'cluster': {'worker': ['localhost:{}'.format(port_base + i) for i in range(num_workers)]},
+        'task': {'type': 'worker', 'index': worker_index},
+    })
+
+
+class DataParallelTrainer:
+    """
+    Synchronous data-parallel training of a stateful model over the workers of
+    a `MultiWorkerMirroredStrategy`. The model must be built outside the
+    strategy scope.
+    """
+
+    def __init__(self, strategy, model, optimizer=None):
+        import tensorflow as tf
+
+        from shakespeare_lm.training import masked_loss_and_accuracy
+
+        self.strategy = strategy
+        self.model = model
+        self.optimizer = optimizer or tf.keras.optimizers.Adam()
+        self.optimizer.build(model.trainable_variables)
+        self.is_chief = strategy.cluster_resolver.task_id == 0
+
+        @tf.function
+        def broadcast():
+            def replica_fn():
+                values = [tf.identity(v) if self.is_chief else tf.zeros_like(v) for v in model.weights]
+                return tf.distribute.get_replica_context().all_reduce('SUM', values)
+            for variable, value in zip(model.weights, strategy.run(replica_fn)):
+                variable.assign(value)
+
+        @tf.function
+        def train_step(inputs, targets):
+            def replica_fn(inputs, targets):
+                with tf.GradientTape() as tape:
+                    logits = model(inputs, training=True)
+                    loss, _ = masked_loss_and_accuracy(targets, logits, inputs != 0)
+                grads = [tf.convert_to_tensor(g) for g in tape.gradient(loss, model.trainable_variables)]
+                context = tf.distribute.get_replica_context()
+                return context.all_reduce('MEAN', loss), context.all_reduce('MEAN', grads)
+            loss, grads = strategy.run(replica_fn, args=(inputs, targets))
+            self.optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            return loss
+
+        self.train_step = train_step
+        broadcast()
+
+    def fit(self, dataset, epochs=1, steps_per_epoch=None):
+        """
+        This function trains for `epochs` epochs of (at most `steps_per_epoch`)
+        local batches and returns a history dict with the mean loss and the
+        local steps/sec of every epoch.
+        """
+        history = {'loss': [], 'steps_per_sec': []}
+        for _ in range(epochs):
+            self.model.reset_states()
+            total, num_steps = 0.0, 0
+            start = time.perf_counter()
+            for inputs, targets in dataset.take(steps_per_epoch) if steps_per_epoch else dataset:
+                total += self.train_step(inputs, targets)
+                num_steps += 1
+            total = float(total)
+            history['steps_per_sec'].append(num_steps / (time.perf_counter() - start))
+            history['loss'].append(total / max(num_steps, 1))
+        return history
+
+
+def run_worker(args):
+    """
+    Entry point of one worker process: joins the process group, trains on its
+    share of the streams and, on worker 0, prints a JSON summary.
+    """
+    os.environ['TF_CONFIG'] = tf_config(args.num_workers, args.worker_index, args.port_base)
+    import tensorflow as tf
+
+    from shakespeare_lm.cache import load_or_build_cache
+    from shakespeare_lm.examples import sliding_window_examples
+    from shakespeare_lm.stateful import make_indexed_dataset
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    corpus_cache = load_or_build_cache(args.text, args.cache_dir)
+    input_array, target_array = sliding_window_examples(corpus_cache.tokens, seq_len=args.seq_len)
+    indices = worker_stream_indices(len(input_array), args.batch_size, args.num_workers, args.worker_index)
+    dataset = make_indexed_dataset(input_array, target_array, indices, args.batch_size,
+                                   num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+    module_name, function_name = args.model.split(':')
+    build_model = getattr(importlib.import_module(module_name), function_name)
+    model = build_model(corpus_cache.codec.vocab_size, args.batch_size)
+    model.build((args.batch_size, None))
+
+    trainer = DataParallelTrainer(strategy, model)
+    trainer.fit(dataset, epochs=1, steps_per_epoch=1)   # trace and warm up
+    history = trainer.fit(dataset, epochs=args.epochs, steps_per_epoch=args.steps)
+    if trainer.is_chief:
+        steps_per_sec = history['steps_per_sec'][-1]
+        print(json.dumps({
+            'num_workers': args.num_workers,
+            'loss': history['loss'],
+            'steps_per_sec': steps_per_sec,
+            'examples_per_sec': steps_per_sec * args.batch_size * args.num_workers,
+        }))
+
+
+def launch(args):
+    """
+    This function starts `args.num_workers` local worker processes and returns
+    the JSON summary printed by worker 0. If a worker fails, the others (which
+    would wait for it forever in the all-reduce) are killed and RuntimeError is
+    raised with its exit code.
+    """
+    from shakespeare_lm.cache import load_or_build_cache
+
+    load_or_build_cache(args.text, args.cache_dir)   # build once, before the workers map it
+    processes = []
+    with tempfile.TemporaryFile('w+') as output:
+        try:
+            for worker_index in range(args.num_workers):
+                command = [sys.executable, '-m', 'shakespeare_lm.distributed', 'worker',
+                           '--worker-index', str(worker_index)] + _shared_arguments(args)
+                stdout = output if worker_index == 0 else subprocess.DEVNULL
+                processes.append(subprocess.Popen(command, stdout=stdout, text=True))
+            running = list(enumerate(processes))
+            while running:
+                time.sleep(0.1)
+                for worker_index, process in list(running):
+                    returncode = process.poll()
+                    if returncode is None:
+                        continue
+                    if returncode:
+                        raise RuntimeError('Worker {} failed with exit code {}.'.format(worker_index, returncode))
+                    running.remove((worker_index, process))
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+        output.seek(0)
+        return json.loads(output.read().strip().splitlines()[-1])
+
+
+def measure_scaling(args):
+    """
+    This function runs `launch` with 1 to `args.max_workers` workers, each with
+    the same per-worker batch size, and returns a list of summaries with the
+    scaling efficiency `examples_per_sec(n) / (n * examples_per_sec(1))`.
+    """
+    results = []
+    for num_workers in range(1, args.max_workers + 1):
+        args.num_workers = num_workers
+        summary = launch(args)
+        summary['efficiency'] = summary['examples_per_sec'] / (num_workers * results[0]['examples_per_sec']
+                                                               if results else summary['examples_per_sec'])
+        results.append(summary)
+    return results
+
+
+def _shared_arguments(args):
+    return ['--num-workers', str(args.num_workers), '--port-base', str(args.port_base),
+            '--cache-dir', args.cache_dir, '--batch-size', str(args.batch_size),
+            '--seq-len', str(args.seq_len), '--epochs', str(args.epochs), '--steps', str(args.steps),
+            '--model', args.model, args.text]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=['worker', 'launch', 'scaling'])
+    parser.add_argument('text', help='text file to train on')
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--worker-index', type=int, default=0)
+    parser.add_argument('--port-base', type=int, default=23456)
+    parser.add_argument('--cache-dir', default='cache')
+    parser.add_argument('--batch-size', type=int, default=32, help='batch size per worker')
+    parser.add_argument('--seq-len', type=int, default=100)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=20, help='steps per epoch')
+    parser.add_argument('--model', default='shakespeare_lm.model:get_model',
+                        help='model builder taking (vocab_size, batch_size), as module:function')
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        run_worker(args)
+    elif args.command == 'launch':
+        print(json.dumps(launch(args)))
+    else:
+        for summary in measure_scaling(args):
+            print('{num_workers} workers: {examples_per_sec:,.1f} examples/sec, '
+                  'efficiency {efficiency:.2f}'.format(**summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Bits-per-character and perplexity of a trained checkpoint on any text file.
+
+The text is tokenized with the vocabulary of the training corpus (through the
+token cache, so a warm start only maps the file) and laid out as `batch_size`
+contiguous tracks, as in `shakespeare_lm.tbptt`. A stateful model walks the
+tracks window by window, carrying the GRU state across windows, and a compiled
+forward pass reduces each window to its summed negative log-likelihood, so only
+one window of logits exists at a time.
+
+Run `python -m shakespeare_lm.evaluate <text file> --checkpoint-dir ./models/`.
+"""
+
+import argparse
+import math
+import time
+
+import numpy as np
+
+
+def make_eval_step(model):
+    """
+    This function returns a compiled function mapping a batch of
+    `(inputs, targets)` windows to the summed negative log-likelihood (in nats)
+    of the targets under the stateful `model`, advancing its GRU state.
+    """
+    import tensorflow as tf
+
+    @tf.function(reduce_retracing=True)
+    def eval_step(inputs, targets):
+        logits = tf.cast(model(inputs, training=False), tf.float32)
+        nll = tf.nn.sparse_softmax_cross_entropy_with_logits(tf.cast(targets, tf.int32), logits)
+        return tf.reduce_sum(nll)
+
+    return eval_step
+
+
+def evaluate_tokens(model, tokens, window=256):
+    """
+    This function scores the 1D token stream `tokens` with a stateful model
+    built for `batch_size` rows (split into that many tracks, the last partial
+    window included) and returns a dict with the number of scored tokens, the
+    bits per character, the perplexity and the throughput.
+    """
+    from shakespeare_lm.tbptt import make_tracks
+
+    batch_size = model.input_shape[0]
+    if len(tokens) <= batch_size:
+        raise ValueError('Need more than {} tokens to fill {} tracks.'.format(batch_size, batch_size))
+    inputs, targets = make_tracks(tokens, batch_size)
+    eval_step = make_eval_step(model)
+    model.reset_states()
+
+    total_nll = 0.0
+    start = time.perf_counter()
+    for begin in range(0, inputs.shape[1], window):
+        columns = slice(begin, begin + window)
+        total_nll += eval_step(np.ascontiguousarray(inputs[:, columns], dtype=np.int32),
+                               np.ascontiguousarray(targets[:, columns], dtype=np.int32))
+    total_nll = float(total_nll)
+    elapsed = time.perf_counter() - start
+    num_tokens = inputs.size
+    return {
+        'tokens': num_tokens,
+        'nll': total_nll,
+        'bits_per_char': total_nll / num_tokens / math.log(2),
+        'perplexity': math.exp(total_nll / num_tokens),
+        'seconds': elapsed,
+        'tokens_per_sec': num_tokens / elapsed,
+    }
+
+
+def evaluate_file(text_path, checkpoint, train_text='data/Shakespeare.txt', cache_dir='cache',
+                  batch_size=64, window=256, build_model=None):
+    """
+    This function loads the weights at `checkpoint` into a `get_model` network
+    (or `build_model(vocab_size, batch_size)`) with `batch_size` rows, tokenizes
+    `text_path` with the vocabulary of `train_text` and returns the dict of
+    `evaluate_tokens`. Characters outside the vocabulary are skipped.
+    """
+    from shakespeare_lm.cache import load_or_build_cache
+    from shakespeare_lm.sharding import load_corpus
+
+    if build_model is None:
+        from shakespeare_lm.model import get_model as build_model
+
+    codec = load_corpus(train_text, cache_dir).codec
+    tokens = load_or_build_cache(text_path, cache_dir, codec=codec).tokens
+    model = build_model(codec.vocab_size, batch_size)
+    model.load_weights(checkpoint).expect_partial()
+    return evaluate_tokens(model, tokens, window)
+
+
+def main(argv=None):
+    import tensorflow as tf
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('text', help='text file to evaluate on')
+    parser.add_argument('--checkpoint-dir', default='./models/')
+    parser.add_argument('--train-text', default='data/Shakespeare.txt',
+                        help='training corpus whose vocabulary the checkpoint uses')
+    parser.add_argument('--cache-dir', default='cache')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--window', type=int, default=256)
+    args = parser.parse_args(argv)
+
+    checkpoint = tf.train.latest_checkpoint(args.checkpoint_dir) or args.checkpoint_dir
+    report = evaluate_file(args.text, checkpoint, args.train_text, args.cache_dir,
+                           args.batch_size, args.window)
+    for name, value in report.items():
+        print('{:>15s}: {:,.4f}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
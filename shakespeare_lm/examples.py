@@ -0,0 +1,80 @@
+"""
+Zero-copy construction of training examples from the token stream.
+
+The notebook builds examples by padding every chunk to 500 tokens and then
+shifting the padded matrix by one position, which materializes several copies
+of an array that is mostly padding. `sliding_window_examples` instead takes the
+concatenated token stream and returns input and target windows as strided
+views into it: no padding, no per-row Python loop, and no copy at all.
+"""
+
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def sliding_window_examples(tokens, seq_len=499, stride=None):
+    """
+    This function takes a 1D array of token ids and returns a tuple
+    `(input_array, target_array)` of 2D views of shape `(num_examples, seq_len)`,
+    where each target row is the input row shifted forward by one token. Windows
+    start every `stride` tokens (by default `seq_len`, so every token is
+    predicted exactly once). Neither array owns any memory.
+    """
+    if stride is None:
+        stride = seq_len
+    if len(tokens) <= seq_len:
+        empty = np.zeros((0, seq_len), dtype=np.asarray(tokens).dtype)
+        return empty, empty
+    windows = sliding_window_view(tokens, seq_len + 1)[::stride]
+    return windows[:, :-1], windows[:, 1:]
+
+
+def owned_nbytes(*arrays):
+    """
+    This function returns the number of bytes held by the given arrays
+    themselves, counting views of another array (or of a memory map) as zero.
+    """
+    return sum(array.nbytes for array in arrays if array.base is None)
+
+
+def compare_example_builders(sequence_chunks, tokens, maxlen=500):
+    """
+    This function builds training examples both ways, the padded path
+    (`pad_sequences` followed by the one-token shift) from the list of encoded
+    `sequence_chunks`, and the sliding-window path from the concatenated token
+    stream `tokens`, and returns a dict of build times, memory and token counts.
+    """
+    from tensorflow.keras.preprocessing.sequence import pad_sequences
+
+    report = {}
+
+    start = time.perf_counter()
+    padded = pad_sequences(sequence_chunks, maxlen=maxlen, dtype='int32',
+                           padding='pre', truncating='pre', value=0.0)
+    max_seq_len = max(len(seq) for seq in padded)
+    in_arr = np.array([seq[:max_seq_len - 1] for seq in padded])
+    ou_arr = np.array([seq[1:max_seq_len] for seq in padded])
+    report['padded_seconds'] = time.perf_counter() - start
+    report['padded_bytes'] = owned_nbytes(padded, in_arr, ou_arr)
+    report['padded_examples'] = len(in_arr)
+    report['padded_real_targets'] = int(np.count_nonzero(ou_arr))
+
+    start = time.perf_counter()
+    in_win, ou_win = sliding_window_examples(tokens, seq_len=maxlen - 1)
+    report['window_seconds'] = time.perf_counter() - start
+    report['window_bytes'] = owned_nbytes(in_win, ou_win)
+    report['window_examples'] = len(in_win)
+    report['window_real_targets'] = int(ou_win.size)
+    return report
+
+
+if __name__ == '__main__':
+    import sys
+
+    from shakespeare_lm.cache import load_or_build_cache
+
+    corpus_cache = load_or_build_cache(sys.argv[1] if len(sys.argv) > 1 else 'data/Shakespeare.txt')
+    for name, value in compare_example_builders(corpus_cache.sequences(), corpus_cache.tokens).items():
+        print('{:>20s}: {}'.format(name, value))
@@ -0,0 +1,151 @@
+"""
+Quantized TFLite export of the single-step decoder.
+
+For generation the notebook rebuilds the float32 Keras model and loads the raw
+checkpoint. `export_tflite` instead freezes one `StepDecoder` step
+(`(token, state) -> (logits, new_state)`) into a TFLite flatbuffer with
+int8 dynamic-range weights; the GRU and Dense matrices make up almost all of
+the model, so the artifact is about four times smaller than the float weights.
+`TFLiteStepRunner` runs the artifact token by token, and `compare_models`
+checks its perplexity, latency and size against the float model.
+"""
+
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from shakespeare_lm.inference import StepDecoder
+
+
+def export_tflite(model, path, quantize=True):
+    """
+    This function converts one decoding step of `model` (a network built by
+    `get_model`, with weights loaded) into a TFLite model at `path`, with int8
+    dynamic-range quantized weights unless `quantize=False`. Returns the size of
+    the file in bytes.
+    """
+    decoder = StepDecoder(model)
+
+    def named_step(token, state):
+        # Named outputs end up in the TFLite signature, which `TFLiteStepRunner` reads them from
+        logits, new_state = decoder._step(token, state)
+        return {'logits': logits, 'new_state': new_state}
+
+    step = tf.function(named_step, input_signature=[
+        tf.TensorSpec([1], tf.int32, name='token'),
+        tf.TensorSpec([1, decoder.units], tf.float32, name='state')])
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([step.get_concrete_function()], model)
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    with open(path, 'wb') as file:
+        file.write(converter.convert())
+    return os.path.getsize(path)
+
+
+class TFLiteStepRunner:
+    """
+    Step decoder backed by an exported TFLite model, with the same `prime` and
+    `step` interface as `StepDecoder` but on numpy arrays and a batch of one.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        # Look the tensors up by name in the exported signature: the logits and the state
+        # cannot be told apart by shape when `units == vocab_size`
+        signature = self.interpreter.get_signature_runner()
+        inputs = signature.get_input_details()
+        outputs = signature.get_output_details()
+        self._token = inputs['token']['index']
+        self._state_in = inputs['state']['index']
+        self._logits = outputs['logits']['index']
+        self._state_out = outputs['new_state']['index']
+        self.units = int(inputs['state']['shape'][1])
+        self.vocab_size = int(outputs['logits']['shape'][1])
+
+    def zero_state(self):
+        return np.zeros((1, self.units), dtype=np.float32)
+
+    def step(self, token, state):
+        self.interpreter.set_tensor(self._token, np.array([token], dtype=np.int32))
+        self.interpreter.set_tensor(self._state_in, state)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._logits), self.interpreter.get_tensor(self._state_out)
+
+    def prime(self, tokens, state=None):
+        if not len(tokens):
+            raise ValueError('seed must contain at least one in-vocabulary character')
+        state = self.zero_state() if state is None else state
+        for token in tokens:
+            logits, state = self.step(token, state)
+        return logits, state
+
+
+def _log_softmax(logits):
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+def stepwise_perplexity(step_fn, state, tokens):
+    """
+    This function feeds `tokens` one at a time through `step_fn(token, state)
+    -> (logits, state)` and returns the perplexity of each token given the
+    previous ones, along with the mean time per step in seconds.
+    """
+    nll = 0.0
+    start = time.perf_counter()
+    logits, state = step_fn(tokens[0], state)
+    for token in tokens[1:]:
+        nll -= float(_log_softmax(np.asarray(logits))[0, token])
+        logits, state = step_fn(token, state)
+    elapsed = time.perf_counter() - start
+    return float(np.exp(nll / (len(tokens) - 1))), elapsed / len(tokens)
+
+
+def compare_models(model, tflite_path, heldout_tokens):
+    """
+    This function scores `heldout_tokens` with the float Keras model (through a
+    compiled `StepDecoder`) and with the exported TFLite model, and returns a
+    dict with both perplexities, their difference, the per-token latencies and
+    the size of the weights.
+    """
+    decoder = StepDecoder(model)
+    runner = TFLiteStepRunner(tflite_path)
+
+    def float_step(token, state):
+        return decoder.step(tf.constant([token], dtype=tf.int32), state)
+
+    float_step(int(heldout_tokens[0]), decoder.zero_state(1))   # trace outside the timing
+    tokens = [int(token) for token in heldout_tokens]
+    float_ppl, float_latency = stepwise_perplexity(float_step, decoder.zero_state(1), tokens)
+    tflite_ppl, tflite_latency = stepwise_perplexity(runner.step, runner.zero_state(), tokens)
+    return {
+        'float_perplexity': float_ppl,
+        'tflite_perplexity': tflite_ppl,
+        'perplexity_delta': tflite_ppl - float_ppl,
+        'float_ms_per_token': 1000 * float_latency,
+        'tflite_ms_per_token': 1000 * tflite_latency,
+        'float_weight_bytes': int(sum(np.prod(v.shape) * v.dtype.size for v in model.weights)),
+        'tflite_file_bytes': os.path.getsize(tflite_path),
+    }
+
+
+if __name__ == '__main__':
+    import sys
+
+    from shakespeare_lm.cache import load_or_build_cache
+    from shakespeare_lm.model import get_model
+
+    text_path = sys.argv[1] if len(sys.argv) > 1 else 'data/Shakespeare.txt'
+    checkpoint_dir = sys.argv[2] if len(sys.argv) > 2 else './models/'
+    output_path = sys.argv[3] if len(sys.argv) > 3 else os.path.join(checkpoint_dir, 'step_decoder_int8.tflite')
+
+    corpus_cache = load_or_build_cache(text_path)
+    model = get_model(corpus_cache.codec.vocab_size, batch_size=1)
+    model.load_weights(tf.train.latest_checkpoint(checkpoint_dir))
+    print('wrote {} ({:,} bytes)'.format(output_path, export_tflite(model, output_path)))
+    # The last 2000 tokens are a held-out slice of the 80/20 training split
+    for name, value in compare_models(model, output_path, corpus_cache.tokens[-2000:]).items():
+        print('{:>20s}: {:,.4f}'.format(name, value))
@@ -0,0 +1,146 @@
+"""
+Incremental-state inference for the `get_model` network.
+
+`get_logits` runs `model.predict` over the whole input on every call: the GRU
+and the Dense projection are applied at every position although only the last
+one is needed, and each call pays `predict`'s setup cost. `StepDecoder` wraps
+the layers of a built model in two compiled functions instead:
+
+* `prime(tokens, state)` runs a batch of seed sequences through the GRU cell
+  and projects only the final hidden state to logits;
+* `step(tokens, state)` advances a batch by one token;
+* `sample_sequence(...)` runs priming, sampling and stepping for a whole
+  generation inside one compiled loop, with no host round trip per token.
+
+Both take and return the GRU state explicitly, so no layer state is mutated and
+the same decoder serves any batch size. For the stacked variants of
+`shakespeare_lm.architectures` the state is the concatenation of the states of
+all GRU layers, bottom first, and `units` is its total width.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from shakespeare_lm import instrumentation
+from shakespeare_lm.architectures import split_layers
+from shakespeare_lm.instrumentation import instrument, timer
+
+
+class StepDecoder:
+    """
+    Compiled single-step decoder sharing the weights of a model built by
+    `get_model` (Embedding -> GRU(s) -> output layers). Token id 0 is treated as padding,
+    as with `mask_zero=True`: it leaves the state of its row unchanged, so
+    seed sequences of different lengths can be left-padded into one batch.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.embedding, self.grus, self.head = split_layers(model)
+        self.gru = self.grus[0]
+        self.dense = self.head[-1]
+        self.widths = [gru.units for gru in self.grus]
+        self.units = sum(self.widths)
+        self.vocab_size = self.dense.units
+
+        state_spec = tf.TensorSpec([None, self.units], tf.float32)
+        self.step = tf.function(self._step, input_signature=[
+            tf.TensorSpec([None], tf.int32), state_spec])
+        self.prime = tf.function(self._prime, input_signature=[
+            tf.TensorSpec([None, None], tf.int32), state_spec])
+        self._sampling_loops = {}
+
+    def zero_state(self, batch_size):
+        return tf.zeros((batch_size, self.units), dtype=tf.float32)
+
+    def _advance(self, tokens, state):
+        if len(self.grus) == 1:
+            output, _ = self.gru.cell(self.embedding(tokens), [state])
+        else:
+            output = self.embedding(tokens)
+            outputs = []
+            for gru, layer_state in zip(self.grus, tf.split(state, self.widths, axis=-1)):
+                output, _ = gru.cell(output, [layer_state])
+                outputs.append(output)
+            output = tf.concat(outputs, axis=-1)
+        return tf.where(tf.expand_dims(tokens > 0, -1), output, state)
+
+    def _project(self, state):
+        output = state[:, -self.widths[-1]:] if len(self.grus) > 1 else state
+        for layer in self.head:
+            output = layer(output)
+        return output
+
+    def _step(self, tokens, state):
+        state = self._advance(tokens, state)
+        return self._project(state), state
+
+    def _prime(self, tokens, state):
+        for t in tf.range(tf.shape(tokens)[1]):
+            state = self._advance(tokens[:, t], state)
+        return self._project(state), state
+
+    def generate(self, seed_tokens, num_steps, sample_fn, state=None):
+        """
+        This function takes a 1D sequence of seed token ids, a number of tokens
+        to generate and a function mapping a `(1, vocab_size)` numpy array of
+        logits to an integer token, and returns the list of seed and generated
+        tokens together with the final GRU state.
+        """
+        if state is None:
+            state = self.zero_state(1)
+        tokens = list(np.asarray(seed_tokens).ravel().tolist())
+        with timer('prime'):
+            logits, state = self.prime(tf.constant([tokens], dtype=tf.int32), state)
+        for _ in range(num_steps):
+            with timer('decode_token'):
+                token = int(sample_fn(logits.numpy()))
+                tokens.append(token)
+                logits, state = self.step(tf.constant([token], dtype=tf.int32), state)
+        return tokens, state
+
+    def _sampling_loop(self, sampler):
+        cached = self._sampling_loops.get(id(sampler))
+        if cached is not None and cached[0] is sampler:
+            return cached[1]
+
+        @tf.function(input_signature=[tf.TensorSpec([None, None], tf.int32),
+                                      tf.TensorSpec([], tf.int32),
+                                      tf.TensorSpec([None, self.units], tf.float32)])
+        def loop(tokens, num_steps, state):
+            logits, state = self._prime(tokens, state)
+            generated = tf.TensorArray(tf.int32, size=num_steps, element_shape=[None])
+            for i in tf.range(num_steps):
+                token = sampler(logits)
+                generated = generated.write(i, token)
+                logits, state = self._step(token, state)
+            return tf.transpose(generated.stack()), state
+
+        self._sampling_loops[id(sampler)] = (sampler, loop)
+        return loop
+
+    @instrument('sample_sequence')
+    def sample_sequence(self, seed_tokens, num_steps, sampler, state=None):
+        """
+        This function takes a 2D batch of (left-padded) seed token sequences, a
+        number of tokens to generate and a `Sampler`, and returns a
+        `(batch_size, num_steps)` numpy array of generated tokens together with
+        the final GRU state. The whole loop runs as one compiled function, so
+        individual tokens cannot be timed: when instrumentation is enabled, the
+        loop's mean per-token time (priming included) is recorded once under
+        `decode_token_mean`.
+        """
+        seed_tokens = tf.constant(seed_tokens, dtype=tf.int32)
+        if state is None:
+            state = self.zero_state(seed_tokens.shape[0])
+        if num_steps == 0:
+            _, state = self.prime(seed_tokens, state)
+            return np.zeros((seed_tokens.shape[0], 0), dtype=np.int32), state
+        start = time.perf_counter()
+        generated, state = self._sampling_loop(sampler)(seed_tokens, num_steps, state)
+        generated = generated.numpy()
+        if instrumentation.enabled():
+            instrumentation.observe('decode_token_mean', (time.perf_counter() - start) / num_steps)
+        return generated, state
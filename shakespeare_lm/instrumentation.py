@@ -0,0 +1,208 @@
+"""
+Opt-in timers for the preprocessing, training and generation hot paths.
+
+The library functions of each stage are wrapped with `instrument(stage)` (or
+time a block with `timer(stage)`); nothing is recorded unless instrumentation
+is enabled with `enable()` or the `SHAKESPEARE_LM_METRICS=1` environment
+variable. When disabled, a wrapped call costs one flag check, `timer` returns
+a shared no-op context manager, and `timed_iter` returns its iterable as is.
+
+Stages recorded by the package:
+
+    fit_vocabulary, tokenize     codec / Tokenizer fitting and encoding
+    pad                          padding chunks to fixed-length rows
+    reorder                      stateful example ordering
+    dataset_next                 waiting for the next training batch
+    train_step                   one `CompiledTrainer` step
+    build_cache                  encoding a corpus into the token cache
+    prime, decode_token          seeding and per-token generation steps
+    sample_sequence              one compiled `StepDecoder` generation loop
+    decode_token_mean            the mean time per token of that loop
+    batch_decode_step            one `BatchGenerator` step over all requests
+    serve_step                   one step of the generation service
+    get_logits                   the notebook's per-token `get_logits` call
+
+`train_step` times the host side of a step: on an accelerator, TensorFlow
+dispatches it asynchronously, so its samples measure how long the host is
+held up by the queue of steps rather than the kernels themselves (use
+`trace` for those).
+
+Every observation is kept, so `summary()` reports exact p50/p95/p99 latencies
+(e.g. of `decode_token`) along with counts and totals; `to_json()` and
+`to_prometheus()` export them, and `write(path)` picks the format from the file
+extension (`.prom` for Prometheus text, JSON otherwise). `trace(logdir)`
+records a `tf.profiler` trace for TensorBoard around a block.
+"""
+
+import array
+import contextlib
+import functools
+import json
+import os
+import time
+
+import numpy as np
+
+
+_enabled = os.environ.get('SHAKESPEARE_LM_METRICS', '') not in ('', '0')
+_samples = {}        # stage -> array('d') of durations in seconds
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    _samples.clear()
+
+
+def observe(stage, seconds):
+    samples = _samples.get(stage)
+    if samples is None:
+        samples = _samples[stage] = array.array('d')
+    samples.append(seconds)
+
+
+class _Timer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.stage, time.perf_counter() - self.start)
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def timer(stage):
+    """
+    This function returns a context manager that records the duration of its
+    block under `stage`, or a shared no-op one when instrumentation is disabled.
+    """
+    return _Timer(stage) if _enabled else _NULL_TIMER
+
+
+def instrument(stage):
+    """
+    Decorator recording the duration of every call of the function under
+    `stage` while instrumentation is enabled.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _timed(iterator, stage):
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(stage, time.perf_counter() - start)
+        yield item
+
+
+def timed_iter(iterable, stage):
+    """
+    This function returns an iterator over `iterable` that records the time
+    spent waiting for each item under `stage`, or `iterable` itself when
+    instrumentation is disabled.
+    """
+    return _timed(iter(iterable), stage) if _enabled else iterable
+
+
+@contextlib.contextmanager
+def trace(logdir):
+    """
+    Context manager recording a `tf.profiler` trace of its block into
+    `logdir` (viewable in TensorBoard's profile tab). Does nothing if `logdir`
+    is None.
+    """
+    if logdir is None:
+        yield
+        return
+    import tensorflow as tf
+
+    tf.profiler.experimental.start(logdir)
+    try:
+        yield
+    finally:
+        tf.profiler.experimental.stop()
+
+
+def summary():
+    """
+    This function returns a dict mapping each recorded stage to its count,
+    total, mean, p50/p95/p99 and maximum duration in seconds.
+    """
+    stages = {}
+    for stage, samples in sorted(_samples.items()):
+        values = np.frombuffer(samples, dtype=np.float64)
+        p50, p95, p99 = np.quantile(values, QUANTILES)
+        stages[stage] = {
+            'count': len(values),
+            'total_seconds': float(values.sum()),
+            'mean_seconds': float(values.mean()),
+            'p50_seconds': float(p50),
+            'p95_seconds': float(p95),
+            'p99_seconds': float(p99),
+            'max_seconds': float(values.max()),
+        }
+    return stages
+
+
+def to_json():
+    return json.dumps(summary(), sort_keys=True, indent=4)
+
+
+def to_prometheus(prefix='shakespeare_lm'):
+    """
+    This function returns the recorded stages in the Prometheus text
+    exposition format, as one summary metric labelled by stage.
+    """
+    name = prefix + '_stage_seconds'
+    lines = ['# HELP {} Duration of instrumented stages.'.format(name), '# TYPE {} summary'.format(name)]
+    for stage, stats in summary().items():
+        for quantile in QUANTILES:
+            lines.append('{}{{stage="{}",quantile="{}"}} {!r}'.format(
+                name, stage, quantile, stats['p{}_seconds'.format(int(quantile * 100))]))
+        lines.append('{}_sum{{stage="{}"}} {!r}'.format(name, stage, stats['total_seconds']))
+        lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, stats['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def write(path):
+    """
+    This function writes the recorded stages to `path`, in Prometheus text
+    format if it ends in `.prom` and as JSON otherwise.
+    """
+    with open(path, 'w') as file:
+        file.write(to_prometheus() if path.endswith('.prom') else to_json())
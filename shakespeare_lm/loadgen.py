@@ -0,0 +1,145 @@
+"""
+Load generator for the generation service of `shakespeare_lm.server`.
+
+`run_load` keeps `concurrency` streaming requests in flight until
+`num_requests` have completed, and reports the throughput (requests and
+characters per second) with the p50/p95/p99 time to first character and total
+latency per request. Without `--host`/`--unix`, the service is started in
+process on a free port from `--model`, so the whole benchmark runs locally:
+
+    python -m shakespeare_lm.loadgen --model models/model.npz --concurrency 1 4 16 64
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+
+PROMPTS = ('ROMEO:', 'JULIET:', 'KING LEAR:', 'HAMLET:', 'First Citizen:\n', 'MACBETH:\nIs this a')
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+async def generate_request(payload, host='127.0.0.1', port=8000, unix_path=None):
+    """
+    This coroutine posts one `/generate` request and reads its stream. Returns
+    `(time_to_first_char, latency, text)`, with times in seconds.
+    """
+    start = time.perf_counter()
+    if unix_path:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(b'POST /generate HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                 b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+    await writer.drain()
+    try:
+        status = (await reader.readline()).split(b' ', 2)
+        if len(status) < 2 or status[1] != b'200':
+            raise RuntimeError('Request failed: {}'.format((await reader.read()).decode('utf-8', 'replace')))
+        await reader.readuntil(b'\r\n\r\n')
+        first, pieces = None, []
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            if size == 0:
+                break
+            pieces.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+            if first is None:
+                first = time.perf_counter() - start
+        latency = time.perf_counter() - start
+    finally:
+        writer.close()
+    return (latency if first is None else first), latency, b''.join(pieces).decode('utf-8')
+
+
+async def run_load(concurrency, num_requests, max_tokens=100, temperature=1.0, host='127.0.0.1', port=8000,
+                   unix_path=None):
+    """
+    This coroutine sends `num_requests` requests of `max_tokens` tokens, with
+    prompts cycling through `PROMPTS`, keeping `concurrency` of them in flight,
+    and returns a dict of throughput and latency percentiles.
+    """
+    next_request = iter(range(num_requests))
+    results = []
+
+    async def client():
+        for i in next_request:
+            payload = {'prompt': PROMPTS[i % len(PROMPTS)], 'max_tokens': max_tokens,
+                       'temperature': temperature, 'seed': i}
+            results.append(await generate_request(payload, host, port, unix_path))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    first_char = np.array([result[0] for result in results])
+    latency = np.array([result[1] for result in results])
+    num_chars = sum(len(result[2]) for result in results)
+    report = {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'seconds': elapsed,
+        'requests_per_sec': len(results) / elapsed,
+        'chars_per_sec': num_chars / elapsed,
+    }
+    for name, values in (('first_char', first_char), ('latency', latency)):
+        for quantile, value in zip(QUANTILES, np.quantile(values, QUANTILES)):
+            report['{}_p{}_ms'.format(name, int(quantile * 100))] = 1000 * float(value)
+    return report
+
+
+async def _run_all(args):
+    host, port, unix_path, server_task = args.host, args.port, args.unix, None
+    if not (host or unix_path):
+        from shakespeare_lm.server import GenerationService, load_engine, serve
+
+        engine = load_engine(args.model, args.slots, args.train_text, args.cache_dir)
+        service = GenerationService(engine, batch_window=args.batch_window_ms / 1000,
+                                    max_tokens=max(args.max_tokens, 2000))
+        ready = asyncio.get_running_loop().create_future()
+        server_task = asyncio.ensure_future(serve(service, '127.0.0.1', 0, ready=ready))
+        server = await ready
+        host, port = server.sockets[0].getsockname()[:2]
+
+    reports = []
+    try:
+        await run_load(1, 2, 5, host=host, port=port, unix_path=unix_path)     # warm up
+        for concurrency in args.concurrency:
+            reports.append(await run_load(concurrency, max(args.requests, concurrency), args.max_tokens,
+                                          host=host, port=port, unix_path=unix_path))
+            print(' '.join('{}={:.4g}'.format(name, value) for name, value in reports[-1].items()), flush=True)
+    finally:
+        if server_task is not None:
+            server_task.cancel()
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--model', default='./models/model.npz',
+                        help='.npz (or checkpoint) to serve in process when no --host or --unix is given')
+    parser.add_argument('--host', help='address of a running service')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', help='Unix socket of a running service')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--requests', type=int, default=64, help='requests per concurrency level')
+    parser.add_argument('--max-tokens', type=int, default=100)
+    parser.add_argument('--slots', type=int, default=32, help='decoding slots of the in-process service')
+    parser.add_argument('--batch-window-ms', type=float, default=5.0)
+    parser.add_argument('--train-text', default='data/Shakespeare.txt')
+    parser.add_argument('--cache-dir', default='cache')
+    parser.add_argument('--output', help='write the reports here as JSON')
+    args = parser.parse_args(argv)
+
+    reports = asyncio.run(_run_all(args))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(reports, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
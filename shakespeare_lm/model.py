@@ -0,0 +1,87 @@
+"""
+The character-level GRU language model used throughout the notebook.
+
+These are the graded `get_model`, `get_logits` and `sample_token` functions of
+the notebook, importable by code that runs outside it (e.g. distributed
+training workers or the command line). TensorFlow is only imported when one of
+them is called.
+"""
+
+import numpy as np
+
+from shakespeare_lm.instrumentation import instrument
+
+
+# Architecture variants selectable with `get_model(..., variant=name)`, as
+# keyword arguments of `shakespeare_lm.architectures.build_model`:
+#   embedding_dim    width of the character embedding
+#   units            widths of the stacked stateful GRUs, bottom first
+#   tie_embeddings   reuse the embedding matrix as the output projection
+#   output_rank      factorize the output projection through this rank
+ARCHITECTURES = {
+    'gru1024': dict(embedding_dim=256, units=(1024,)),
+    'gru512': dict(embedding_dim=256, units=(512,)),
+    'gru256': dict(embedding_dim=128, units=(256,)),
+    'stacked2x256': dict(embedding_dim=128, units=(256, 256)),
+    'stacked3x192': dict(embedding_dim=96, units=(192, 192, 192)),
+    'tied512': dict(embedding_dim=256, units=(512,), tie_embeddings=True),
+    'lowrank1024': dict(embedding_dim=256, units=(1024,), output_rank=32),
+}
+DEFAULT_VARIANT = 'gru1024'
+
+
+def get_model(vocab_size, batch_size, variant=None):
+    """
+    This function takes a vocabulary size and batch size, and builds and returns a
+    Sequential model: Embedding(256, masking zeros) -> stateful GRU(1024)
+    returning sequences -> Dense(vocab_size) logits. Any other `variant` of
+    `ARCHITECTURES` is built by `shakespeare_lm.architectures.build_model`.
+    """
+    if variant not in (None, DEFAULT_VARIANT):
+        from shakespeare_lm.architectures import build_model
+
+        if variant not in ARCHITECTURES:
+            raise ValueError('Unknown model variant {!r}, expected one of {}.'.format(
+                variant, ', '.join(ARCHITECTURES)))
+        return build_model(vocab_size, batch_size, **ARCHITECTURES[variant])
+
+    from tensorflow.keras.layers import Dense, Embedding, GRU
+    from tensorflow.keras.models import Sequential
+
+    model = Sequential([
+        Embedding(input_dim=vocab_size, output_dim=256, mask_zero=True, batch_input_shape=(batch_size, None)),
+        GRU(units=1024, stateful=True, return_sequences=True, name='myGRU'),
+        Dense(units=vocab_size)
+    ])
+    return model
+
+
+@instrument('get_logits')
+def get_logits(model, token_sequence, initial_state=None):
+    """
+    This function takes a model object, a token sequence and an optional initial
+    state for the recurrent layer. The function should return the logits prediction
+    for the final time step as a 2D numpy array.
+    """
+    arr2d = np.array(token_sequence)
+    if initial_state is not None:
+        # initial_state 2D -> internal state of GRU
+        if len(initial_state.shape) == 2:
+            model.layers[1].reset_states(states=initial_state)
+    else:
+        # set state of the recurrent layer -> 0
+        model.reset_states()
+    pred = model.predict(arr2d, batch_size=1, verbose=0)      # <---- shape = (1, n, vocab_size)
+    return pred[:, -1, :]
+
+
+def sample_token(logits):
+    """
+    This function takes a 2D numpy array as an input, and constructs a
+    categorical distribution using it. It should then sample from this
+    distribution and return the sample as a single integer.
+    """
+    import tensorflow as tf
+
+    samples = tf.random.categorical(logits, 1)
+    return int(samples[0, 0])
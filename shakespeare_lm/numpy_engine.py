@@ -0,0 +1,286 @@
+"""
+Pure-NumPy inference for the `get_model` network.
+
+Importing TensorFlow and building the Keras model takes seconds and hundreds of
+MB before the first character is generated. This module serves generation with
+NumPy alone: `convert_checkpoint` (which does need TensorFlow, once) extracts
+the Embedding, GRU and Dense weights of a checkpoint into a compact `.npz`, and
+`NumpyGRU` loads it and implements the Keras GRU step (`reset_after=True`,
+sigmoid recurrent activation) with matmuls into preallocated buffers, so that
+decoding allocates nothing per step. The embedding lookup is fused with the
+GRU input projection into a single `(vocab_size, 3 * units)` table. Every
+architecture variant of `get_model` (stacked GRUs, tied or low-rank outputs)
+converts and runs the same way.
+
+Generate from the command line with
+`python -m shakespeare_lm.numpy_engine models/model.npz 'ROMEO:' 1000`.
+"""
+
+import json
+
+import numpy as np
+
+from shakespeare_lm.codec import CharacterCodec
+from shakespeare_lm.instrumentation import instrument, timer
+
+
+CHECKPOINT_KEYS = {
+    'embedding': 'layer_with_weights-0/embeddings',
+    'kernel': 'layer_with_weights-1/cell/kernel',
+    'recurrent_kernel': 'layer_with_weights-1/cell/recurrent_kernel',
+    'bias': 'layer_with_weights-1/cell/bias',
+    'dense_kernel': 'layer_with_weights-2/kernel',
+    'dense_bias': 'layer_with_weights-2/bias',
+}
+
+
+def mask_padding(logits, padding_id=0):
+    """
+    This function sets the logits of `padding_id` to -inf in place (along the
+    last axis) and returns them. Padding decodes to nothing and leaves the GRU
+    state unchanged, so every decoder masks it before choosing a token.
+    """
+    logits[..., padding_id] = -np.inf
+    return logits
+
+
+def convert_checkpoint(checkpoint_path, npz_path, word_index=None, variant=None):
+    """
+    This function reads the weights of a `get_model` checkpoint (as written by
+    `save_weights` / `ModelCheckpoint`) and saves them, with the vocabulary
+    `word_index` if given, to `npz_path`. Checkpoints of the other
+    architecture `variant`s are loaded into their model first. This is the
+    only function of the module that imports TensorFlow.
+    """
+    import tensorflow as tf
+
+    from shakespeare_lm.model import DEFAULT_VARIANT, get_model
+
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    if variant not in (None, DEFAULT_VARIANT):
+        vocab_size = reader.get_tensor(CHECKPOINT_KEYS['embedding'] + '/.ATTRIBUTES/VARIABLE_VALUE').shape[0]
+        model = get_model(vocab_size, batch_size=1, variant=variant)
+        model.load_weights(checkpoint_path).expect_partial()
+        convert_model(model, npz_path, word_index)
+        return
+    arrays = {name: reader.get_tensor(key + '/.ATTRIBUTES/VARIABLE_VALUE')
+              for name, key in CHECKPOINT_KEYS.items()}
+    save_npz(npz_path, arrays, word_index)
+
+
+def convert_model(model, npz_path, word_index=None):
+    """
+    This function saves the weights of a built `get_model` network (of any
+    architecture variant) to `npz_path`. The GRU layers after the first are
+    saved as `kernel_2`, `recurrent_kernel_2`, `bias_2`, ...; a tied or
+    low-rank output is saved as an `output_projection` (if any) followed by
+    the `dense_kernel` and `dense_bias` of the logits.
+    """
+    from shakespeare_lm.architectures import TiedOutput, split_layers
+
+    embedding, grus, head = split_layers(model)
+    arrays = {'embedding': embedding.embeddings.numpy()}
+    for i, gru in enumerate(grus):
+        suffix = '_{}'.format(i + 1) if i else ''
+        arrays['kernel' + suffix] = gru.cell.kernel.numpy()
+        arrays['recurrent_kernel' + suffix] = gru.cell.recurrent_kernel.numpy()
+        arrays['bias' + suffix] = gru.cell.bias.numpy()
+    if len(head) > 1:
+        arrays['output_projection'] = head[0].kernel.numpy()
+    if isinstance(head[-1], TiedOutput):
+        arrays['dense_kernel'] = arrays['embedding'].T
+    else:
+        arrays['dense_kernel'] = head[-1].kernel.numpy()
+    arrays['dense_bias'] = head[-1].bias.numpy()
+    save_npz(npz_path, arrays, word_index)
+
+
+def save_npz(npz_path, arrays, word_index=None):
+    arrays = {name: np.asarray(value, dtype=np.float32) for name, value in arrays.items()}
+    if word_index is not None:
+        arrays['word_index'] = np.array(json.dumps(word_index, ensure_ascii=False))
+    np.savez(npz_path, **arrays)
+
+
+class _GRULayer:
+    """
+    Weights and preallocated buffers of one GRU layer of `NumpyGRU`, updating
+    its state `h` (a view of the engine state) in place from the projected
+    input `x`.
+    """
+
+    def __init__(self, kernel, recurrent_kernel, bias, state):
+        self.kernel = kernel
+        self.input_bias = bias[0]
+        self.recurrent_kernel = np.ascontiguousarray(recurrent_kernel)
+        self.recurrent_bias = bias[1]
+        self.units = units = self.recurrent_kernel.shape[0]
+        self.h = state
+        batch_size = state.shape[0]
+        self.x = np.empty((batch_size, 3 * units), dtype=np.float32)
+        self.inner = np.empty((batch_size, 3 * units), dtype=np.float32)
+        self.gates = np.empty((batch_size, 2 * units), dtype=np.float32)
+        self.candidate = np.empty((batch_size, units), dtype=np.float32)
+
+    def update(self, num_rows):
+        units = self.units
+        x, inner, gates, candidate, h = (self.x[:num_rows], self.inner[:num_rows], self.gates[:num_rows],
+                                         self.candidate[:num_rows], self.h[:num_rows])
+        np.matmul(h, self.recurrent_kernel, out=inner)
+        inner += self.recurrent_bias
+
+        # z and r gates: sigmoid(x + inner), computed in place
+        np.add(x[:, :2 * units], inner[:, :2 * units], out=gates)
+        np.negative(gates, out=gates)
+        np.exp(gates, out=gates)
+        gates += 1.0
+        np.reciprocal(gates, out=gates)
+        z, r = gates[:, :units], gates[:, units:]
+
+        # candidate = tanh(x_h + r * inner_h); h = z * h + (1 - z) * candidate
+        np.multiply(r, inner[:, 2 * units:], out=candidate)
+        candidate += x[:, 2 * units:]
+        np.tanh(candidate, out=candidate)
+        h -= candidate
+        h *= z
+        h += candidate
+
+
+class NumpyGRU:
+    """
+    GRU language model step engine over the weights saved by
+    `convert_checkpoint`. Holds the GRU state of `batch_size` rows; `step`
+    advances every row by one token, and token 0 (padding) leaves its row's
+    state unchanged, as with `mask_zero=True`. With stacked GRUs, `state` is
+    the concatenation of the layer states, bottom first.
+    """
+
+    def __init__(self, npz_path, batch_size=1):
+        with np.load(npz_path) as weights:
+            embedding = weights['embedding']
+            layer_weights = [(weights['kernel'], weights['recurrent_kernel'], weights['bias'])]
+            while 'kernel_{}'.format(len(layer_weights) + 1) in weights:
+                suffix = '_{}'.format(len(layer_weights) + 1)
+                layer_weights.append((weights['kernel' + suffix], weights['recurrent_kernel' + suffix],
+                                      weights['bias' + suffix]))
+            self.output_projection = (np.ascontiguousarray(weights['output_projection'])
+                                      if 'output_projection' in weights else None)
+            self.dense_kernel = np.ascontiguousarray(weights['dense_kernel'])
+            self.dense_bias = weights['dense_bias']
+            self.codec = CharacterCodec.from_json(str(weights['word_index'])) if 'word_index' in weights else None
+
+        self.widths = [recurrent_kernel.shape[0] for _, recurrent_kernel, _ in layer_weights]
+        self.units = sum(self.widths)
+        self.vocab_size = self.dense_kernel.shape[1]
+        self.batch_size = batch_size
+        self.state = np.zeros((batch_size, self.units), dtype=np.float32)
+
+        self.layers = []
+        offset = 0
+        for kernel, recurrent_kernel, bias in layer_weights:
+            width = recurrent_kernel.shape[0]
+            self.layers.append(_GRULayer(kernel, recurrent_kernel, bias, self.state[:, offset:offset + width]))
+            offset += width
+        # Embedding lookup fused with the input projection: row t is embedding[t] @ kernel + bias
+        self.input_table = embedding @ layer_weights[0][0] + layer_weights[0][2][0]
+        self._projected = (np.empty((batch_size, self.output_projection.shape[1]), dtype=np.float32)
+                           if self.output_projection is not None else None)
+        self._logits = np.empty((batch_size, self.vocab_size), dtype=np.float32)
+
+    def reset(self):
+        self.state.fill(0.0)
+
+    def step(self, tokens, logits=True, num_rows=None):
+        """
+        This function advances the state by one token per row (a sequence of
+        `batch_size` token ids) and returns the `(batch_size, vocab_size)`
+        logits, or None when `logits=False`. With `num_rows`, only the first
+        `num_rows` rows are advanced (and `tokens` holds one id per such row).
+        The returned array is an internal buffer that is overwritten by the
+        next step.
+        """
+        num_rows = self.batch_size if num_rows is None else num_rows
+        tokens = np.asarray(tokens).reshape(num_rows)
+        state = self.state[:num_rows]
+        padding = tokens == 0
+        if padding.any():
+            kept = state[padding].copy()
+
+        below = None
+        for layer in self.layers:
+            if below is None:
+                np.take(self.input_table, tokens, axis=0, out=layer.x[:num_rows])
+            else:
+                np.matmul(below.h[:num_rows], layer.kernel, out=layer.x[:num_rows])
+                layer.x[:num_rows] += layer.input_bias
+            layer.update(num_rows)
+            below = layer
+
+        if padding.any():
+            state[padding] = kept
+        if not logits:
+            return None
+        output = below.h[:num_rows]
+        if self.output_projection is not None:
+            np.matmul(output, self.output_projection, out=self._projected[:num_rows])
+            output = self._projected[:num_rows]
+        np.matmul(output, self.dense_kernel, out=self._logits[:num_rows])
+        self._logits[:num_rows] += self.dense_bias
+        return self._logits[:num_rows]
+
+    @instrument('prime')
+    def prime(self, token_rows):
+        """
+        This function feeds a `(batch_size, seq_len)` array of (left-padded)
+        tokens and returns the logits after the last one, computing the Dense
+        projection only for the final step. Raises ValueError if the rows are
+        empty.
+        """
+        token_rows = np.asarray(token_rows).reshape(self.batch_size, -1)
+        if token_rows.shape[1] == 0:
+            raise ValueError('seed must contain at least one in-vocabulary character')
+        for t in range(token_rows.shape[1] - 1):
+            self.step(token_rows[:, t], logits=False)
+        return self.step(token_rows[:, -1])
+
+    def generate(self, seed_tokens, num_steps, temperature=1.0, seed=None):
+        """
+        This function resets the state, primes it with a 1D sequence of seed
+        tokens and samples `num_steps` tokens (with `batch_size=1`), never the
+        padding id 0. A `temperature` of 0 picks the most likely token at every
+        step. Returns the seed and generated tokens as a list.
+        """
+        if not np.isfinite(temperature) or temperature < 0:
+            raise ValueError('temperature must be a finite, non-negative number.')
+        rng = np.random.default_rng(seed)
+        self.reset()
+        tokens = list(np.asarray(seed_tokens).ravel().tolist())
+        logits = self.prime([tokens])
+        for _ in range(num_steps):
+            with timer('decode_token'):
+                scores = mask_padding(logits[0].copy())
+                if temperature == 0:
+                    token = int(np.argmax(scores))
+                else:
+                    scaled = scores / temperature
+                    probs = np.exp(scaled - scaled.max())
+                    token = int(rng.choice(self.vocab_size, p=probs / probs.sum()))
+                tokens.append(token)
+                logits = self.step([token])
+        return tokens
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    start = time.perf_counter()
+    engine = NumpyGRU(sys.argv[1])
+    seed_string = sys.argv[2] if len(sys.argv) > 2 else 'ROMEO:'
+    num_steps = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    loaded = time.perf_counter()
+    tokens = engine.generate(engine.codec.encode(seed_string), num_steps)
+    done = time.perf_counter()
+    print(engine.codec.decode(tokens))
+    print('\nstartup {:.3f} s, {:.3f} ms/token'.format(loaded - start, 1000 * (done - loaded) / num_steps),
+          file=sys.stderr)
@@ -0,0 +1,141 @@
+"""
+Production `tf.data` input pipelines for the stateful model.
+
+`make_Dataset` in the notebook feeds every training step synchronously from an
+in-memory `from_tensor_slices` copy. The pipelines below keep the stateful
+ordering (row `j` of every batch continues row `j` of the previous batch) while
+gathering batches in parallel, optionally caching them after the first epoch
+and prefetching ahead of the training step. Caching is off by default: an
+in-memory cache (`cache=True` with no `cache_path`) keeps every gathered batch
+in RAM, which defeats memory-mapped sources. Three sources are supported:
+
+* in-memory or memory-mapped example arrays plus a stateful index array,
+* a memory-mapped token store (see `shakespeare_lm.cache`), cut into windows,
+* sharded TFRecord files written by `write_tfrecord_shards`.
+"""
+
+import glob
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from shakespeare_lm.examples import sliding_window_examples
+from shakespeare_lm.stateful import make_indexed_dataset, stateful_order
+
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def _finish(dataset, cache, cache_path):
+    if cache:
+        dataset = dataset.cache(cache_path)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def make_pipeline_dataset(input_array, target_array, indices, batch_size, cache=False, cache_path=''):
+    """
+    This function takes input and target arrays, a stateful index array (as
+    returned by `stateful_order`, possibly split into training and validation
+    parts) and a batch size. It returns a `Dataset` of full batches in stateful
+    order, gathered in parallel and prefetched with `AUTOTUNE`. With `cache`,
+    the batches are cached in files at `cache_path`, or in memory if it is
+    empty.
+    """
+    dataset = make_indexed_dataset(input_array, target_array, indices, batch_size,
+                                   num_parallel_calls=AUTOTUNE)
+    return _finish(dataset, cache, cache_path)
+
+
+def make_token_store_dataset(tokens, batch_size, seq_len=499, cache=False, cache_path=''):
+    """
+    This function takes a 1D (typically memory-mapped) token stream and returns
+    a stateful `Dataset` of `(input, target)` windows of length `seq_len`. The
+    windows are strided views of the stream, so only the rows of the current
+    batches are ever read from disk.
+    """
+    input_array, target_array = sliding_window_examples(tokens, seq_len=seq_len)
+    indices = stateful_order(len(input_array), batch_size)
+    return make_pipeline_dataset(input_array, target_array, indices, batch_size, cache, cache_path)
+
+
+def write_tfrecord_shards(input_array, target_array, indices, batch_size, directory, num_shards=8):
+    """
+    This function writes the stateful batches defined by `indices` to
+    `num_shards` TFRecord files in `directory`, one serialized batch per record.
+    Batch `b` goes to shard `b % num_shards`, so that reading the shards
+    round-robin restores the original batch order. Returns the shard paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, 'shard-{:05d}-of-{:05d}.tfrecord'.format(i, num_shards))
+             for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(path) for path in paths]
+    try:
+        for b in range(len(indices) // batch_size):
+            batch_indices = indices[b * batch_size:(b + 1) * batch_size]
+            features = {
+                'input': tf.train.Feature(bytes_list=tf.train.BytesList(
+                    value=[tf.io.serialize_tensor(np.asarray(input_array[batch_indices])).numpy()])),
+                'target': tf.train.Feature(bytes_list=tf.train.BytesList(
+                    value=[tf.io.serialize_tensor(np.asarray(target_array[batch_indices])).numpy()])),
+            }
+            record = tf.train.Example(features=tf.train.Features(feature=features))
+            writers[b % num_shards].write(record.SerializeToString())
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths
+
+
+def make_tfrecord_dataset(directory, dtype=tf.int32, cache=False, cache_path=''):
+    """
+    This function reads the shards written by `write_tfrecord_shards` from
+    `directory`. Shards are read and parsed in parallel, but interleaved
+    deterministically one record at a time, so batches come out in the order
+    in which they were written.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, 'shard-*.tfrecord')))
+    description = {
+        'input': tf.io.FixedLenFeature([], tf.string),
+        'target': tf.io.FixedLenFeature([], tf.string),
+    }
+
+    def parse(record):
+        features = tf.io.parse_single_example(record, description)
+        return (tf.io.parse_tensor(features['input'], dtype),
+                tf.io.parse_tensor(features['target'], dtype))
+
+    dataset = tf.data.Dataset.from_tensor_slices(paths)
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=len(paths), block_length=1,
+                                 num_parallel_calls=AUTOTUNE, deterministic=True)
+    dataset = dataset.map(parse, num_parallel_calls=AUTOTUNE, deterministic=True)
+    return _finish(dataset, cache, cache_path)
+
+
+def measure_throughput(dataset, num_epochs=2):
+    """
+    This function iterates over `dataset` for `num_epochs` epochs without
+    running a model, and returns a list with the examples/sec of each epoch.
+    With caching enabled, the first epoch measures the cold pipeline and later
+    epochs the cached one.
+    """
+    rates = []
+    for _ in range(num_epochs):
+        num_examples = 0
+        start = time.perf_counter()
+        for inputs, _ in dataset:
+            num_examples += int(inputs.shape[0])
+        rates.append(num_examples / (time.perf_counter() - start))
+    return rates
+
+
+if __name__ == '__main__':
+    import sys
+
+    from shakespeare_lm.cache import load_or_build_cache
+
+    corpus_cache = load_or_build_cache(sys.argv[1] if len(sys.argv) > 1 else 'data/Shakespeare.txt')
+    dataset = make_token_store_dataset(corpus_cache.tokens, batch_size=32, cache=True)
+    for epoch, rate in enumerate(measure_throughput(dataset, num_epochs=3)):
+        print('epoch {}: {:,.0f} examples/sec'.format(epoch + 1, rate))
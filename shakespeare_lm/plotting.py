@@ -0,0 +1,34 @@
+"""
+Learning-curve plots of a training history (as saved to `models/history.json`).
+matplotlib is only imported when a plot is drawn.
+"""
+
+import numpy as np
+
+
+def plot_history(history_dict, path=None):
+    """
+    This function plots accuracy vs. epoch and loss vs. epoch, for training and
+    validation, side by side. The figure is saved to `path` if given, and shown
+    otherwise.
+    """
+    import matplotlib.pyplot as plt
+
+    epochs = np.arange(len(history_dict['sparse_categorical_accuracy']))
+    plt.figure(figsize=(15, 5))
+    for position, (metric, title, legend_location) in enumerate(
+            [('sparse_categorical_accuracy', 'Accuracy', 'lower right'), ('loss', 'Loss', 'upper right')]):
+        plt.subplot(121 + position)
+        plt.plot(history_dict[metric])
+        plt.plot(history_dict['val_' + metric])
+        plt.title('{} vs. epochs'.format(title))
+        plt.ylabel(title)
+        plt.xlabel('Epoch')
+        plt.xticks(epochs)
+        plt.gca().set_xticklabels(1 + epochs)
+        plt.legend(['Training', 'Validation'], loc=legend_location)
+    if path is None:
+        plt.show()
+    else:
+        plt.savefig(path)
+        plt.close()
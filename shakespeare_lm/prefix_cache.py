@@ -0,0 +1,173 @@
+"""
+LRU cache of GRU states after frequently used prompt prefixes.
+
+Every generation primes the GRU from a zero state over its whole seed, although
+most prompts start with one of a few character names or scene headers.
+`PrefixStateCache` stores, per primed prompt, the GRU state and the logits
+after its last token. A new prompt resumes from the longest cached prefix and
+only the remaining tokens are run through the network; the result is cached in
+turn. Entries are evicted least recently used first, to keep the stored arrays
+within `max_bytes`.
+
+The cache works with a `StepDecoder` or a `NumpyGRU` engine. Its results feed
+straight back into either one: starting from a cached state, a single padding
+token (id 0) leaves the state unchanged and recomputes the cached logits, e.g.
+
+    logits, state = cache.prime(seed_tokens)
+    generated, _ = decoder.sample_sequence([[0]], num_steps, sampler, state=state)
+"""
+
+import collections
+
+import numpy as np
+
+from shakespeare_lm.numpy_engine import NumpyGRU
+
+
+class PrefixStateCache:
+    """
+    LRU cache, keyed by token prefix, of `(logits, state)` pairs of shape
+    `(1, vocab_size)` and `(1, units)` over a `StepDecoder` or `NumpyGRU`
+    (with `batch_size=1`). The returned arrays are read-only views of the
+    cached entries.
+    """
+
+    def __init__(self, decoder, max_bytes=64 << 20):
+        self.decoder = decoder
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()     # token tuple -> (logits, state)
+        self.lengths = collections.Counter()         # prefix length -> number of entries
+        self.nbytes = 0
+        self.hits = 0                # prompts that resumed from a cached prefix
+        self.misses = 0              # prompts primed from the zero state
+        self.tokens_primed = 0       # tokens run through the network
+        self.tokens_reused = 0       # tokens skipped thanks to a cached prefix
+
+    def _run(self, tokens, state):
+        if isinstance(self.decoder, NumpyGRU):
+            if state is None:
+                self.decoder.reset()
+            else:
+                self.decoder.state[...] = state
+            logits = self.decoder.prime([tokens])
+            return logits.copy(), self.decoder.state.copy()
+        if state is None:
+            state = np.zeros((1, self.decoder.units), dtype=np.float32)
+        logits, state = self.decoder.prime(np.asarray([tokens], dtype=np.int32), state)
+        return np.asarray(logits), np.asarray(state)
+
+    def lookup(self, tokens):
+        """
+        This function returns `(length, logits, state)` for the longest cached
+        prefix of the token sequence `tokens`, or `(0, None, None)` if there is
+        none, and marks the entry as recently used.
+        """
+        tokens = tuple(tokens)
+        # Only lengths that are actually cached need to be tried
+        for length in sorted((n for n in self.lengths if n <= len(tokens)), reverse=True):
+            entry = self.entries.get(tokens[:length])
+            if entry is not None:
+                self.entries.move_to_end(tokens[:length])
+                return (length,) + entry
+        return 0, None, None
+
+    def insert(self, tokens, logits, state):
+        tokens = tuple(tokens)
+        size = self._entry_bytes(tokens, logits, state)
+        if tokens in self.entries or size > self.max_bytes:
+            return
+        logits, state = np.array(logits, dtype=np.float32), np.array(state, dtype=np.float32)
+        logits.flags.writeable = state.flags.writeable = False
+        self.entries[tokens] = (logits, state)
+        self.lengths[len(tokens)] += 1
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        tokens, (logits, state) = self.entries.popitem(last=False)
+        self.nbytes -= self._entry_bytes(tokens, logits, state)
+        self.lengths[len(tokens)] -= 1
+        if not self.lengths[len(tokens)]:
+            del self.lengths[len(tokens)]
+
+    @staticmethod
+    def _entry_bytes(tokens, logits, state):
+        # The key is a tuple of small ints: one 8-byte pointer per token
+        return 4 * (np.size(logits) + np.size(state)) + 8 * len(tokens)
+
+    def prime(self, tokens):
+        """
+        This function takes a non-empty 1D sequence of token ids and returns
+        the `(logits, state)` after its last token, resuming from the longest
+        cached prefix and caching the result.
+        """
+        tokens = tuple(int(token) for token in np.asarray(tokens).ravel())
+        if not tokens:
+            raise ValueError('Cannot prime the decoder with an empty prompt.')
+        length, logits, state = self.lookup(tokens)
+        if length:
+            self.hits += 1
+            self.tokens_reused += length
+        else:
+            self.misses += 1
+        if length == len(tokens):
+            return logits, state
+        logits, state = self._run(tokens[length:], state)
+        self.tokens_primed += len(tokens) - length
+        self.insert(tokens, logits, state)
+        return self.entries[tokens] if tokens in self.entries else (logits, state)
+
+    def warm(self, prompts):
+        """
+        This function primes and caches each token sequence of `prompts`, e.g.
+        the character names and scene headers that later prompts start with.
+        """
+        for tokens in prompts:
+            self.prime(tokens)
+
+    def clear(self):
+        self.entries.clear()
+        self.lengths.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'tokens_primed': self.tokens_primed,
+            'tokens_reused': self.tokens_reused,
+        }
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    engine = NumpyGRU(sys.argv[1])
+    names = ['ROMEO:', 'JULIET:', 'KING LEAR:', 'HAMLET:', 'First Citizen:']
+    scene = 'ACT I\nSCENE I. Verona. A public place.\n\n'
+    rng = np.random.default_rng(0)
+    prompts = [engine.codec.encode(scene + names[i % len(names)] + '\n' * int(rng.integers(1, 4)))
+               for i in range(200)]
+
+    start = time.perf_counter()
+    for tokens in prompts:
+        engine.reset()
+        engine.prime([tokens])
+    uncached = time.perf_counter() - start
+
+    cache = PrefixStateCache(engine, max_bytes=1 << 20)
+    cache.warm([engine.codec.encode(scene)])
+    start = time.perf_counter()
+    for tokens in prompts:
+        cache.prime(tokens)
+    cached = time.perf_counter() - start
+    print('uncached {:.1f} ms/prompt, cached {:.1f} ms/prompt'.format(
+        1000 * uncached / len(prompts), 1000 * cached / len(prompts)))
+    print(cache.stats())
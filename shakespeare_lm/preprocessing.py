@@ -0,0 +1,74 @@
+"""
+The graded preprocessing functions of the notebook.
+
+These build the Keras `Tokenizer`, encode and pad the text chunks, shift them
+into inputs and targets and batch them into a `Dataset`. They are the reference
+implementations; `CharacterCodec`, `TokenCache` and the `pipeline` module
+produce the same arrays faster. TensorFlow is only imported when a function
+that needs it is called.
+"""
+
+from shakespeare_lm.instrumentation import instrument
+
+
+@instrument('fit_vocabulary')
+def create_character_tokenizer(list_of_strings):
+    """
+    This function takes a list of strings as its argument. It should create
+    and return a Tokenizer according to the above specifications.
+    """
+    from tensorflow.keras.preprocessing.text import Tokenizer
+
+    tokenizer = Tokenizer(num_words=None, filters='', lower=False, split='', char_level=True)
+    tokenizer.fit_on_texts(list_of_strings)
+
+    return tokenizer
+
+
+@instrument('tokenize')
+def strings_to_sequences(tokenizer, list_of_strings):
+    """
+    This function takes a tokenizer object and a list of strings as its arguments.
+    It should use the tokenizer to map the text chunks to sequences of tokens and
+    then return this list of encoded sequences.
+    """
+    sentence_seq = tokenizer.texts_to_sequences(list_of_strings)
+    return sentence_seq
+
+
+@instrument('pad')
+def make_padded_dataset(sequence_chunks):
+    """
+    This function takes a list of lists of tokenized sequences, and transforms
+    them into a 2D numpy array, padding the sequences as necessary according to
+    the above specification. The function should then return the numpy array.
+    """
+    from tensorflow.keras.preprocessing.sequence import pad_sequences
+
+    padded_seq_chunks = pad_sequences(sequence_chunks, maxlen=500, dtype='int32',
+                                      padding='pre', truncating='pre', value=0.0)
+    return padded_seq_chunks
+
+
+def create_inputs_and_targets(array_of_sequences):
+    """
+    This function takes a 2D numpy array of token sequences, and returns a tuple of two
+    elements: the first element is the input array and the second element is the output
+    array, which are defined according to the above specification.
+    """
+    in_arr = array_of_sequences[:, :-1]
+    ou_arr = array_of_sequences[:, 1:]
+    return in_arr, ou_arr
+
+
+def make_Dataset(input_array, target_array, batch_size):
+    """
+    This function takes two 2D numpy arrays in the first two arguments, and an integer
+    batch_size in the third argument. It should create and return a Dataset object
+    using the two numpy arrays and batch size according to the above specification.
+    """
+    import tensorflow as tf
+
+    dat = tf.data.Dataset.from_tensor_slices((input_array, target_array))
+    dat = dat.batch(batch_size, drop_remainder=True)
+    return dat
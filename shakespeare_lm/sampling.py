@@ -0,0 +1,142 @@
+"""
+Vectorized, seedable token sampling.
+
+`sample_token` in the notebook draws one token per call from the logits of a
+single sequence and hands it back to Python. `Sampler` works on a whole
+`(batch_size, vocab_size)` batch of logits with TensorFlow ops only, so it can
+run inside a compiled decode step (see `StepDecoder.sample_sequence`) without a
+host round trip per token. It supports temperature scaling, top-k and top-p
+(nucleus) filtering and greedy decoding, never returns the padding id 0, and
+draws its randomness from a seeded `tf.random.Generator`, so generations are
+reproducible when `seed` is set.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def apply_temperature(logits, temperature):
+    return logits / tf.cast(temperature, logits.dtype)
+
+
+def mask_padding(logits, padding_id=0):
+    """
+    This function takes a 2D tensor of logits and sets the logits of
+    `padding_id` to -inf, like `numpy_engine.mask_padding` for NumPy arrays.
+    """
+    is_padding = tf.equal(tf.range(tf.shape(logits)[-1]), padding_id)
+    return tf.where(is_padding, tf.constant(-np.inf, logits.dtype), logits)
+
+
+def top_k_filter(logits, k):
+    """
+    This function takes a 2D tensor of logits and sets all but the `k` largest
+    logits of each row to -inf. `k` is clamped to the vocabulary size.
+    """
+    k = tf.minimum(k, tf.shape(logits)[-1])
+    threshold = tf.math.top_k(logits, k=k).values[:, -1:]
+    return tf.where(logits < threshold, tf.constant(-np.inf, logits.dtype), logits)
+
+
+def top_p_filter(logits, p):
+    """
+    This function takes a 2D tensor of logits and keeps, for each row, the
+    smallest set of most likely tokens whose total probability reaches `p`,
+    setting the other logits to -inf. The most likely token is always kept.
+    """
+    sorted_logits = tf.sort(logits, axis=-1, direction='DESCENDING')
+    probs_before = tf.cumsum(tf.nn.softmax(sorted_logits), axis=-1, exclusive=True)
+    num_kept = tf.maximum(tf.reduce_sum(tf.cast(probs_before < p, tf.int32), axis=-1), 1)
+    threshold = tf.gather(sorted_logits, num_kept - 1, batch_dims=1)[:, None]
+    return tf.where(logits < threshold, tf.constant(-np.inf, logits.dtype), logits)
+
+
+class Sampler:
+    """
+    Callable mapping a 2D tensor of logits to a 1D int32 tensor with one token
+    per row, never the padding id 0. With `greedy=True` the most likely token
+    is returned; otherwise the logits are divided by `temperature`, optionally
+    restricted to the `top_k` most likely tokens and to the `top_p` probability
+    mass, and sampled from. `temperature` must then be finite and positive.
+    """
+
+    def __init__(self, temperature=1.0, top_k=0, top_p=1.0, greedy=False, seed=None):
+        if not greedy and not (np.isfinite(temperature) and temperature > 0):
+            raise ValueError('temperature must be finite and positive, or use greedy=True.')
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.greedy = greedy
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        """
+        Restart the random stream, so that a seeded sampler reproduces the same
+        sequence of draws.
+        """
+        if self.seed is None:
+            self.generator = tf.random.Generator.from_non_deterministic_state()
+        elif hasattr(self, 'generator'):
+            # Reset in place: compiled decode steps hold on to this generator
+            self.generator.reset_from_seed(self.seed)
+        else:
+            self.generator = tf.random.Generator.from_seed(self.seed)
+
+    def filter(self, logits):
+        logits = apply_temperature(mask_padding(tf.cast(logits, tf.float32)), self.temperature)
+        if self.top_k:
+            logits = top_k_filter(logits, self.top_k)
+        if self.top_p < 1.0:
+            logits = top_p_filter(logits, self.top_p)
+        return logits
+
+    def __call__(self, logits):
+        if self.greedy:
+            return tf.argmax(mask_padding(logits), axis=-1, output_type=tf.int32)
+        seed = self.generator.make_seeds(1)[:, 0]
+        samples = tf.random.stateless_categorical(self.filter(logits), 1, seed=seed, dtype=tf.int32)
+        return samples[:, 0]
+
+
+def benchmark(vocab_size=65, batch_size=32, num_draws=200, sample_token=None):
+    """
+    This function draws `num_draws` tokens for each of `batch_size` rows of
+    random logits, once by calling `sample_token` row by row (by default the
+    notebook's `shakespeare_lm.model.sample_token`) and once with a compiled
+    `Sampler` over the whole batch, and returns a dict with the tokens/sec of
+    each.
+    """
+    if sample_token is None:
+        from shakespeare_lm.model import sample_token
+
+    logits = np.random.randn(batch_size, vocab_size).astype(np.float32)
+    results = {}
+
+    start = time.perf_counter()
+    for _ in range(num_draws):
+        for row in range(batch_size):
+            sample_token(logits[row:row + 1])
+    results['sample_token'] = num_draws * batch_size / (time.perf_counter() - start)
+
+    sampler = Sampler(temperature=0.8, top_k=20, top_p=0.95, seed=0)
+
+    @tf.function
+    def draw_all(logits):
+        tokens = tf.TensorArray(tf.int32, size=num_draws)
+        for i in tf.range(num_draws):
+            tokens = tokens.write(i, sampler(logits))
+        return tokens.stack()
+
+    draw_all(logits)   # trace outside the timing
+    start = time.perf_counter()
+    draw_all(logits).numpy()
+    results['sampler'] = num_draws * batch_size / (time.perf_counter() - start)
+    return results
+
+
+if __name__ == '__main__':
+    for name, rate in benchmark().items():
+        print('{:>14s}: {:,.0f} tokens/sec'.format(name, rate))
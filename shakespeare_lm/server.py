@@ -0,0 +1,388 @@
+"""
+Asyncio HTTP generation service over the NumPy engine.
+
+The notebook's generation cell rebuilds the model and reloads its weights every
+time it runs, and serves one prompt at a time. `GenerationService` loads the
+weights once into a `NumpyGRU` with one row of GRU state per slot and decodes
+all active requests in lockstep, as `BatchGenerator` does:
+
+* incoming prompts are queued; when the service is idle it waits
+  `batch_window` seconds after the first one so that concurrent prompts start
+  in the same batch, and while it is busy queued prompts join at the next step;
+* the state rows are a fixed pool (`SlotPool`), allocated once with the engine:
+  a request takes a free row, zeroed, and returns it when it finishes or its
+  client disconnects;
+* each step feeds one token per slot (a seed token, or the token sampled at the
+  previous step) and runs in a worker thread, so the event loop keeps accepting
+  and streaming while NumPy computes;
+* generated characters are streamed back with HTTP chunked encoding as they
+  are sampled.
+
+Endpoints: `POST /generate` with a JSON body
+`{"prompt": "ROMEO:", "max_tokens": 200, "temperature": 1.0, "seed": 0}`
+(`seed` optional) streams `text/plain`, the prompt excluded; `GET /stats`
+returns the counters of the service as JSON. Start it with
+`python -m shakespeare_lm serve --model models/model.npz --port 8000` (or
+`--unix PATH`), and measure it with `shakespeare_lm.loadgen`. If the scheduler
+fails, the error is logged, open streams are cut off without their final
+chunk, and `serve` stops with a RuntimeError.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import heapq
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from shakespeare_lm.instrumentation import instrument
+from shakespeare_lm.numpy_engine import NumpyGRU, mask_padding
+
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 64 << 10
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+def load_engine(model_path, num_slots, train_text='data/Shakespeare.txt', cache_dir='cache', variant=None):
+    """
+    This function returns a `NumpyGRU` with `num_slots` rows for an `.npz`
+    written by `convert`, or for a Keras checkpoint, which is converted once
+    (with the vocabulary of `train_text`; this imports TensorFlow).
+    """
+    if model_path.endswith('.npz'):
+        return NumpyGRU(model_path, batch_size=num_slots)
+    from shakespeare_lm.numpy_engine import convert_checkpoint
+    from shakespeare_lm.sharding import load_corpus
+
+    codec = load_corpus(train_text, cache_dir).codec
+    with tempfile.TemporaryDirectory() as directory:
+        npz_path = os.path.join(directory, 'model.npz')
+        convert_checkpoint(model_path, npz_path, codec.word_index, variant)
+        return NumpyGRU(npz_path, batch_size=num_slots)
+
+
+class SlotPool:
+    """
+    Pool of the preallocated state rows of a batched `NumpyGRU`. `acquire`
+    returns the lowest free row with its state zeroed, so that the rows in use
+    stay packed at the top and a step only computes up to the highest of
+    them; `release` returns a row to the pool.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.free = list(range(engine.batch_size))      # a heap
+
+    def __len__(self):
+        return len(self.free)
+
+    def acquire(self):
+        row = heapq.heappop(self.free)
+        self.engine.state[row] = 0.0
+        return row
+
+    def release(self, row):
+        heapq.heappush(self.free, row)
+
+
+class StreamRequest:
+    """
+    One prompt of the service: its seed tokens, the number of tokens to
+    generate and its sampling parameters. Generated characters are put on
+    `chunks` as they are sampled, followed by None once the request is done
+    (with `failed` set if the service stopped before it was).
+    """
+
+    def __init__(self, seed_tokens, num_steps, temperature=1.0, seed=None):
+        self.tokens = list(np.asarray(seed_tokens).ravel().tolist())
+        if not self.tokens:
+            raise ValueError('The prompt has no characters in the vocabulary.')
+        if not (np.isfinite(temperature) and temperature > 0):
+            raise ValueError('temperature must be finite and positive.')
+        if num_steps < 0:
+            raise ValueError('The number of tokens to generate must not be negative.')
+        self.num_seed_tokens = len(self.tokens)
+        self.num_steps = num_steps
+        self.temperature = temperature
+        self.rng = np.random.default_rng(seed)
+        self.position = 0           # index in `tokens` of the next token to feed
+        self.row = None
+        self.cancelled = False
+        self.failed = False
+        self.chunks = asyncio.Queue()
+
+    @property
+    def num_generated(self):
+        return len(self.tokens) - self.num_seed_tokens
+
+
+class GenerationService:
+    """
+    Micro-batching scheduler over a batched `NumpyGRU`: `submit` queues a
+    `StreamRequest`, and `run` (a long-lived task) decodes the queued requests
+    in up to `engine.batch_size` slots. Requests may ask for at most
+    `max_tokens` tokens.
+    """
+
+    def __init__(self, engine, batch_window=0.005, max_queue=1024, max_tokens=2000):
+        if engine.codec is None:
+            raise ValueError('The model has no vocabulary; convert it with its word_index.')
+        self.engine = engine
+        self.codec = engine.codec
+        self.batch_window = batch_window
+        self.max_queue = max_queue
+        self.max_tokens = max_tokens
+        self.pool = SlotPool(engine)
+        self.slots = {}                       # row -> StreamRequest
+        self.queue = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._chars = [self.codec.decode([token]) for token in range(engine.vocab_size)]
+        self.stats = collections.Counter()
+        self.error = None
+
+    def submit(self, request):
+        if self.error is not None:
+            raise RuntimeError('The generation service has stopped.')
+        if len(self.queue) >= self.max_queue:
+            raise RuntimeError('The request queue is full.')
+        if request.num_steps == 0:
+            request.chunks.put_nowait(None)
+            return request
+        self.queue.append(request)
+        self.stats['requests'] += 1
+        self._wakeup.set()
+        return request
+
+    def _admit(self):
+        while self.queue and self.pool:
+            request = self.queue.popleft()
+            if request.cancelled:
+                continue
+            request.row = self.pool.acquire()
+            self.slots[request.row] = request
+
+    def _finish(self, request):
+        del self.slots[request.row]
+        self.pool.release(request.row)
+        request.chunks.put_nowait(None)
+
+    @instrument('serve_step')
+    def _compute(self, inputs, sample_rows):
+        logits = mask_padding(self.engine.step(inputs, num_rows=len(inputs)))
+        samples = []
+        for row, temperature, rng in sample_rows:
+            # Gumbel-max: argmax(logits / T + Gumbel noise) is a categorical sample
+            noise = rng.gumbel(size=self.engine.vocab_size)
+            samples.append(int(np.argmax(logits[row] / temperature + noise)))
+        return samples
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        inputs = np.zeros(self.engine.batch_size, dtype=np.int32)
+        while True:
+            if not self.slots:
+                self._wakeup.clear()
+                if not self.queue:
+                    await self._wakeup.wait()
+                await asyncio.sleep(self.batch_window)    # let concurrent prompts join the batch
+            for request in [request for request in self.slots.values() if request.cancelled]:
+                self._finish(request)
+            self._admit()
+            if not self.slots:
+                continue
+
+            inputs.fill(0)       # free rows feed padding, which leaves their state unchanged
+            sample_rows = []
+            for row, request in self.slots.items():
+                inputs[row] = request.tokens[request.position]
+                request.position += 1
+                if request.position == len(request.tokens):
+                    sample_rows.append((row, request.temperature, request.rng))
+            samples = await loop.run_in_executor(self._executor, self._compute, inputs[:max(self.slots) + 1],
+                                                 sample_rows)
+            self.stats['steps'] += 1
+            self.stats['slot_steps'] += len(self.slots)
+
+            for (row, _, _), token in zip(sample_rows, samples):
+                request = self.slots[row]
+                request.tokens.append(token)
+                request.chunks.put_nowait(self._chars[token])
+                self.stats['tokens'] += 1
+                if request.num_generated == request.num_steps:
+                    self._finish(request)
+
+    def fail(self, error):
+        """
+        This function records that `run` stopped with `error` and ends the
+        streams of all active and queued requests as failed.
+        """
+        self.error = error
+        for request in list(self.slots.values()) + list(self.queue):
+            request.failed = True
+            request.chunks.put_nowait(None)
+        self.slots.clear()
+        self.queue.clear()
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats.update(active=len(self.slots), queued=len(self.queue), slots=self.engine.batch_size,
+                     mean_batch=self.stats['slot_steps'] / max(self.stats['steps'], 1))
+        return stats
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+async def _read_request(reader):
+    """
+    This coroutine reads one HTTP request and returns `(method, path, body)`,
+    with `body` None if it exceeds `MAX_BODY_BYTES`. Raises ValueError if the
+    request line or `Content-Length` is malformed.
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    request_line = lines[0].split(' ')
+    if len(request_line) != 3 or not request_line[0] or not request_line[1]:
+        raise ValueError('malformed request line')
+    method, path, _ = request_line
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise ValueError('malformed Content-Length') from None
+    if length < 0:
+        raise ValueError('malformed Content-Length')
+    if length > MAX_BODY_BYTES:
+        return method, path, None
+    body = await reader.readexactly(length) if length else b''
+    return method, path, body
+
+
+def _write_response(writer, status, body, content_type='application/json'):
+    body = body.encode('utf-8')
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+        status, REASONS[status], content_type, len(body)).encode('latin-1') + body)
+
+
+def _error(writer, status, message):
+    _write_response(writer, status, json.dumps({'error': message}))
+
+
+async def _stream(writer, request):
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n'
+                 b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+    done = False
+    while not done:
+        pieces = [await request.chunks.get()]
+        while not request.chunks.empty():       # coalesce everything sampled since the last write
+            pieces.append(request.chunks.get_nowait())
+        if pieces[-1] is None:
+            pieces.pop()
+            done = True
+        data = ''.join(pieces).encode('utf-8')
+        if data:
+            writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+        if done and not request.failed:
+            # A failed stream ends without the last chunk, so clients see it as truncated
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+def make_handler(service, default_max_tokens=200):
+    """
+    This function returns the `asyncio.start_server` connection callback
+    serving `service`.
+    """
+    async def handle(reader, writer):
+        request = None
+        try:
+            try:
+                method, path, body = await _read_request(reader)
+                malformed = None
+            except ValueError as error:
+                malformed = str(error)
+            if malformed:
+                _error(writer, 400, malformed)
+            elif path == '/stats':
+                _write_response(writer, 200, json.dumps(service.snapshot()))
+            elif path != '/generate':
+                _error(writer, 404, 'unknown path {}'.format(path))
+            elif method != 'POST':
+                _error(writer, 405, 'use POST')
+            elif body is None:
+                _error(writer, 413, 'request body too large')
+            else:
+                try:
+                    params = json.loads(body or b'{}')
+                    num_steps = int(params.get('max_tokens', default_max_tokens))
+                    if not 0 <= num_steps <= service.max_tokens:
+                        raise ValueError('max_tokens must be between 0 and {}.'.format(service.max_tokens))
+                    request = StreamRequest(service.codec.encode(params.get('prompt', '')), num_steps,
+                                            float(params.get('temperature', 1.0)), params.get('seed'))
+                    service.submit(request)
+                except RuntimeError as error:
+                    request = None
+                    _error(writer, 503, str(error))
+                except (ValueError, TypeError, AttributeError) as error:
+                    request = None
+                    _error(writer, 400, str(error))
+                else:
+                    await _stream(writer, request)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            if request is not None:
+                request.cancelled = True       # frees the slot if the client went away mid-stream
+            writer.close()
+
+    return handle
+
+
+async def serve(service, host='127.0.0.1', port=8000, unix_path=None, ready=None):
+    """
+    This coroutine serves `service` over TCP on `host:port`, or on the Unix
+    socket `unix_path`, until cancelled. `ready`, if given, is an
+    `asyncio.Future` set to the bound server once it accepts connections.
+    Raises RuntimeError if the scheduler of `service` fails.
+    """
+    handler = make_handler(service)
+    if unix_path:
+        server = await asyncio.start_unix_server(handler, path=unix_path)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+
+    def scheduler_done(task):
+        if task.cancelled():
+            return
+        error = task.exception() or RuntimeError('the scheduler returned')
+        logger.error('The generation scheduler failed; shutting down', exc_info=error)
+        service.fail(error)
+        server.close()
+
+    scheduler = asyncio.ensure_future(service.run())
+    scheduler.add_done_callback(scheduler_done)
+    if ready is not None:
+        ready.set_result(server)
+    serving = asyncio.ensure_future(server.serve_forever())
+    try:
+        async with server:
+            await asyncio.wait([serving, scheduler], return_when=asyncio.FIRST_COMPLETED)
+        if service.error is not None:
+            raise RuntimeError('The generation scheduler failed.') from service.error
+    finally:
+        serving.cancel()
+        scheduler.cancel()
+        service.close()
@@ -0,0 +1,298 @@
+"""
+Parallel preprocessing of corpora made of many text files.
+
+`load_or_build_cache` encodes one file in one process. `build_shards` takes a
+directory or glob of text files, with each file a shard, and runs two passes
+over a process pool:
+
+1. map: every worker fits a `CharacterCodec` on the chunks of its files;
+   reduce: `CharacterCodec.merged` sums the per-shard counts in file order, so
+   the vocabulary is the one a single codec fitted on all files in sorted order
+   would get, whatever the number of workers;
+2. every worker encodes its files with the merged vocabulary into one token
+   cache directory per shard (`shard-00000/`, ... in the `TokenCache` layout:
+   `tokens.bin`, `offsets.npy`, `vocab.json`, `meta.json`).
+
+A `manifest.json` lists the shards in order with their sources and sizes.
+`ShardedCorpus` opens it and exposes the same `codec`, `tokens`, `offsets`,
+`sequence`, `sequences` and `padded` as a `TokenCache`, so training consumes
+a sharded corpus exactly like a single-file one (`python -m shakespeare_lm
+train corpus_dir/`). Its `tokens` is a memory map of the whole stream, copied
+block by block from the shards into `tokens.bin` the first time it is needed,
+and its `offsets` are those of the shards, shifted to index into it. Chunks
+never span files.
+Files are the unit of parallelism, so a corpus of many files scales with the
+number of cores while a single large file does not.
+
+Run `python -m shakespeare_lm preprocess 'corpus/*.txt' --workers 8`, or
+`python -m shakespeare_lm.sharding corpus/ --scaling` to time 1 to
+`os.cpu_count()` workers.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from shakespeare_lm.cache import TokenCache, build_cache, cache_key, hash_file, load_or_build_cache
+from shakespeare_lm.codec import CharacterCodec
+from shakespeare_lm.corpus import DEFAULT_BLOCK_SIZE, iter_text_chunks
+
+
+MANIFEST_VERSION = 1
+
+
+def expand_sources(source):
+    """
+    This function takes a directory (searched recursively), a glob pattern or
+    a single file and returns the sorted list of text files it names.
+    """
+    if os.path.isdir(source):
+        paths = [os.path.join(root, name) for root, _, names in os.walk(source) for name in names
+                 if not name.startswith('.')]
+    else:
+        paths = glob.glob(source, recursive=True)
+    paths = sorted(os.path.abspath(path) for path in paths if os.path.isfile(path))
+    if not paths:
+        raise ValueError('No text files match {!r}.'.format(source))
+    return paths
+
+
+def _source_stats(paths):
+    return [[path, os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in paths]
+
+
+def _count_shard(path, delimiter, block_size):
+    return CharacterCodec.from_texts(iter_text_chunks(path, delimiter, block_size))
+
+
+def _encode_shard(path, directory, delimiter, codec, block_size):
+    source_hash = hash_file(path, block_size)
+    meta_path = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as json_file:
+            meta = json.load(json_file)
+        if meta['key'] == cache_key(source_hash, delimiter, codec):
+            return meta
+    return build_cache(path, directory, delimiter, codec, source_hash, block_size).meta
+
+
+def _map(pool, function, arguments, chunksize=1):
+    """
+    This function returns `[function(*args) for args in arguments]`, computed
+    by the process `pool`, or in this process if `pool` is None.
+    """
+    if pool is None:
+        return [function(*args) for args in arguments]
+    return list(pool.map(function, *zip(*arguments), chunksize=chunksize))
+
+
+def build_shards(source, directory, delimiter='.', workers=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    This function encodes the text files named by `source` (see
+    `expand_sources`) with `workers` processes (all cores by default) into
+    one token cache per file under `directory`, writes the manifest last and
+    returns a `ShardedCorpus`. Shards whose source and vocabulary are unchanged
+    from a previous build are kept.
+    """
+    paths = expand_sources(source)
+    workers = min(workers or os.cpu_count(), len(paths))
+    chunksize = max(1, len(paths) // (4 * workers))
+    names = ['shard-{:05d}'.format(i) for i in range(len(paths))]
+    os.makedirs(directory, exist_ok=True)
+    # Spawned workers only import NumPy and the codec, even if the parent has TensorFlow loaded
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) if workers > 1 else None
+    try:
+        codec = CharacterCodec.merged(_map(pool, _count_shard, [(path, delimiter, block_size) for path in paths],
+                                           chunksize))
+        metas = _map(pool, _encode_shard, [(path, os.path.join(directory, name), delimiter, codec, block_size)
+                                           for path, name in zip(paths, names)], chunksize)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    for stale in set(os.listdir(directory)) - set(names) - {'manifest.json'}:
+        if stale.startswith('shard-'):
+            shutil.rmtree(os.path.join(directory, stale), ignore_errors=True)
+        elif stale.startswith('tokens.bin'):
+            os.remove(os.path.join(directory, stale))
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'source': source,
+        'delimiter': delimiter,
+        'vocabulary': codec.word_index,
+        'dtype': np.dtype(codec.dtype).name,
+        'num_tokens': sum(meta['num_tokens'] for meta in metas),
+        'num_chunks': sum(meta['num_chunks'] for meta in metas),
+        'sources': _source_stats(paths),
+        'shards': [{'directory': name, 'source': path, 'num_tokens': meta['num_tokens'],
+                    'num_chunks': meta['num_chunks']} for name, path, meta in zip(names, paths, metas)],
+    }
+    tmp_path = os.path.join(directory, 'manifest.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as json_file:
+        json.dump(manifest, json_file, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, os.path.join(directory, 'manifest.json'))
+    return ShardedCorpus(directory)
+
+
+def load_or_build_shards(source, cache_dir='cache', delimiter='.', workers=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    This function returns a `ShardedCorpus` for the files named by `source`,
+    reusing the one under `cache_dir` when the same files (by path, size and
+    modification time) were encoded with the same delimiter, and rebuilding
+    it otherwise.
+    """
+    paths = expand_sources(source)
+    name = hashlib.sha256(json.dumps(paths).encode('utf-8')).hexdigest()[:16]
+    directory = os.path.join(cache_dir, 'shards-' + name)
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as json_file:
+            manifest = json.load(json_file)
+        if (manifest['version'], manifest['delimiter'], manifest['sources']) == (
+                MANIFEST_VERSION, delimiter, _source_stats(paths)):
+            return ShardedCorpus(directory)
+    return build_shards(source, directory, delimiter, workers, block_size)
+
+
+def load_corpus(source, cache_dir='cache', delimiter='.', workers=None):
+    """
+    This function returns a `TokenCache` if `source` is a single text file,
+    and a `ShardedCorpus` of its files if it is a directory or glob.
+    """
+    if os.path.isfile(source):
+        return load_or_build_cache(source, cache_dir, delimiter)
+    return load_or_build_shards(source, cache_dir, delimiter, workers)
+
+
+def _concatenate_shards(shards, path, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    This function writes the token streams of `shards`, in order, to the file
+    at `path`, copying `block_size` tokens at a time from their memory maps.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as token_file:
+        for shard in shards:
+            for start in range(0, len(shard.tokens), block_size):
+                token_file.write(shard.tokens[start:start + block_size].tobytes())
+    os.replace(tmp_path, path)
+
+
+class ShardedCorpus:
+    """
+    Read-only view of a directory written by `build_shards`, with the
+    interface of a `TokenCache` over the concatenation of its shards.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json'), 'r', encoding='utf-8') as json_file:
+            self.manifest = json.load(json_file)
+        self.codec = CharacterCodec(self.manifest['vocabulary'])
+        self.shards = [TokenCache(os.path.join(directory, shard['directory'])) for shard in self.manifest['shards']]
+        self._tokens = None
+        self._offsets = None
+
+    def __len__(self):
+        return self.manifest['num_chunks']
+
+    @property
+    def tokens(self):
+        """
+        The token ids of all shards as one memory-mapped array. The first access
+        after a build concatenates the shards on disk into `tokens.bin`, so the
+        stream is never held in memory.
+        """
+        if self._tokens is None:
+            dtype, num_tokens = np.dtype(self.manifest['dtype']), self.manifest['num_tokens']
+            path = os.path.join(self.directory, 'tokens.bin')
+            if not num_tokens:
+                self._tokens = np.zeros((0,), dtype=dtype)
+                return self._tokens
+            if not os.path.exists(path) or os.path.getsize(path) != num_tokens * dtype.itemsize:
+                _concatenate_shards(self.shards, path)
+            self._tokens = np.memmap(path, dtype=dtype, mode='r', shape=(num_tokens,))
+        return self._tokens
+
+    @property
+    def offsets(self):
+        """
+        The start of every chunk in `tokens`, plus the end: the offsets of each
+        shard shifted by the number of tokens in the shards before it.
+        """
+        if self._offsets is None:
+            parts, base = [np.zeros(1, dtype=np.int64)], 0
+            for shard in self.shards:
+                shard_offsets = np.asarray(shard.offsets, dtype=np.int64)
+                parts.append(shard_offsets[1:] + base)
+                base += int(shard_offsets[-1])
+            self._offsets = np.concatenate(parts)
+        return self._offsets
+
+    def sequence(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def sequences(self):
+        return [sequence for shard in self.shards for sequence in shard.sequences()]
+
+    def padded(self, maxlen=500):
+        """
+        This function returns the chunks of all shards, in order, as one 2D
+        int32 array padded and truncated at the front to `maxlen`.
+        """
+        return np.concatenate([shard.padded(maxlen) for shard in self.shards])
+
+
+def measure_scaling(source, max_workers=None, delimiter='.'):
+    """
+    This function builds the shards of `source` from scratch with 1 to
+    `max_workers` workers and returns a list of dicts with the wall time, the
+    throughput and the speedup over one worker.
+    """
+    paths = expand_sources(source)
+    num_bytes = sum(os.path.getsize(path) for path in paths)
+    results = []
+    for workers in range(1, (max_workers or os.cpu_count()) + 1):
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            build_shards(source, directory, delimiter, workers)
+            seconds = time.perf_counter() - start
+        results.append({
+            'workers': workers,
+            'seconds': seconds,
+            'mb_per_sec': num_bytes / seconds / 1e6,
+            'speedup': results[0]['seconds'] / seconds if results else 1.0,
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('source', help='directory or glob of text files')
+    parser.add_argument('--cache-dir', default='cache')
+    parser.add_argument('--delimiter', default='.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--scaling', action='store_true',
+                        help='time fresh builds with 1 to --workers processes instead')
+    args = parser.parse_args(argv)
+
+    if args.scaling:
+        for result in measure_scaling(args.source, args.workers, args.delimiter):
+            print('{workers:>3d} workers: {seconds:8.3f} s, {mb_per_sec:8.2f} MB/s, speedup {speedup:.2f}'.format(
+                **result))
+        return
+    corpus = load_or_build_shards(args.source, args.cache_dir, args.delimiter, args.workers)
+    print('{}: {:,} tokens in {:,} chunks over {} shards, vocabulary of {}'.format(
+        corpus.directory, len(corpus.tokens), len(corpus), len(corpus.shards), corpus.codec.vocab_size))
+
+
+if __name__ == '__main__':
+    main()
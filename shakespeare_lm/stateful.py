@@ -0,0 +1,57 @@
+"""
+Example ordering for stateful RNN training.
+
+A stateful RNN carries its state from row `j` of one batch to row `j` of the
+next, so the examples must be reordered so that each batch row walks through a
+contiguous stream of examples. The notebook built this permutation with one
+`np.concatenate` per step (quadratic in the number of examples) and then copied
+both example arrays through it. `stateful_order` computes the same permutation
+with a single reshape/transpose, and `make_indexed_dataset` applies it lazily
+inside a `tf.data` pipeline instead of materializing reordered copies.
+"""
+
+import numpy as np
+
+from shakespeare_lm.instrumentation import instrument
+
+
+@instrument('reorder')
+def stateful_order(num_examples, batch_size):
+    """
+    This function takes a number of examples and a batch size, and returns the
+    index array that reorders the first `num_examples - num_examples % batch_size`
+    examples for stateful training: batch `i` holds examples
+    `i, i + steps, i + 2 * steps, ...`, where `steps` is the number of batches.
+    """
+    steps = num_examples // batch_size
+    return np.arange(steps * batch_size).reshape(batch_size, steps).T.ravel()
+
+
+def make_indexed_dataset(input_array, target_array, indices, batch_size, num_parallel_calls=None):
+    """
+    This function takes input and target arrays (which may be memory-mapped or
+    strided views), an index array such as returned by `stateful_order`, and a
+    batch size. It returns a batched `Dataset` that gathers the rows of each
+    batch from the arrays only when the batch is requested, so no reordered
+    copy of either array is ever made. Batches may be gathered in parallel with
+    `num_parallel_calls`; they are always emitted in order.
+    """
+    import tensorflow as tf
+
+    input_shape = (batch_size,) + tuple(input_array.shape[1:])
+    target_shape = (batch_size,) + tuple(target_array.shape[1:])
+    input_dtype = tf.as_dtype(input_array.dtype)
+    target_dtype = tf.as_dtype(target_array.dtype)
+
+    def gather(batch_indices):
+        return input_array[batch_indices], target_array[batch_indices]
+
+    def gather_batch(batch_indices):
+        inputs, targets = tf.numpy_function(gather, [batch_indices], (input_dtype, target_dtype))
+        inputs.set_shape(input_shape)
+        targets.set_shape(target_shape)
+        return inputs, targets
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(indices, dtype=np.int64))
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    return dataset.map(gather_batch, num_parallel_calls=num_parallel_calls, deterministic=True)
@@ -0,0 +1,112 @@
+"""
+Truncated backpropagation through time over the continuous token stream.
+
+The notebook cuts the corpus at every '.', left-pads each chunk to 500 tokens
+and relies on the stateful reordering to carry context between batches, so a
+large part of every batch is padding that the GRU still steps through. Here the
+concatenated token stream is instead laid out as `batch_size` contiguous
+tracks, and training walks through them in fixed-length windows:
+
+    track 0: [ window 0 | window 1 | window 2 | ... ]
+    track 1: [ window 0 | window 1 | window 2 | ... ]
+    ...
+
+Row `j` of every batch continues row `j` of the previous one, so a stateful
+model (or `CompiledTrainer`, which only resets states between epochs) carries
+the GRU state across windows, and no position is padding.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+
+def make_tracks(tokens, batch_size):
+    """
+    This function takes a 1D token stream and returns `(inputs, targets)`
+    arrays of shape `(batch_size, track_len)`, where row `j` is the `j`-th
+    contiguous slice of the stream and the targets are shifted by one token.
+    Both are views of `tokens` (no copy for a contiguous or memory-mapped stream).
+    """
+    track_len = (len(tokens) - 1) // batch_size
+    inputs = tokens[:batch_size * track_len].reshape(batch_size, track_len)
+    targets = tokens[1:batch_size * track_len + 1].reshape(batch_size, track_len)
+    return inputs, targets
+
+
+def make_tbptt_dataset(tokens, batch_size, window=100):
+    """
+    This function returns a `Dataset` of `(input, target)` batches of shape
+    `(batch_size, window)`, walking the tracks of `make_tracks` window by
+    window. Windows are sliced out of the stream only when requested.
+    """
+    inputs, targets = make_tracks(tokens, batch_size)
+    num_windows = inputs.shape[1] // window
+    dtype = tf.as_dtype(inputs.dtype)
+
+    def get_window(k):
+        columns = slice(k * window, (k + 1) * window)
+        return np.ascontiguousarray(inputs[:, columns]), np.ascontiguousarray(targets[:, columns])
+
+    def load(k):
+        batch_inputs, batch_targets = tf.numpy_function(get_window, [k], (dtype, dtype))
+        batch_inputs.set_shape((batch_size, window))
+        batch_targets.set_shape((batch_size, window))
+        return batch_inputs, batch_targets
+
+    dataset = tf.data.Dataset.range(num_windows)
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_tbptt_datasets(tokens, batch_size, window=100, validation_fraction=0.2):
+    """
+    This function splits the token stream into a leading training part and a
+    trailing validation part, and returns a TBPTT `Dataset` for each.
+    """
+    split = int(len(tokens) * (1 - validation_fraction))
+    return (make_tbptt_dataset(tokens[:split], batch_size, window),
+            make_tbptt_dataset(tokens[split:], batch_size, window))
+
+
+def gru_flops_per_position(vocab_size, embedding_dim=256, units=1024):
+    """
+    Approximate multiply-add FLOPs of one forward time step of the `get_model`
+    network: the three GRU gates over input and state, and the Dense projection.
+    """
+    return 2 * 3 * (embedding_dim + units) * units + 2 * units * vocab_size
+
+
+def compare_wasted_compute(padded_inputs, tokens, vocab_size, batch_size=32, window=100):
+    """
+    This function compares one epoch over the padded examples (as built by
+    `make_padded_dataset` and `create_inputs_and_targets`) with one TBPTT epoch
+    over the token stream, and returns a dict with the number of time steps
+    each processes, the fraction of them that is padding, and the forward FLOPs.
+    """
+    num_batches = len(padded_inputs) // batch_size
+    padded_positions = num_batches * batch_size * padded_inputs.shape[1]
+    padding = int(np.count_nonzero(padded_inputs[:num_batches * batch_size] == 0))
+    track_inputs, _ = make_tracks(tokens, batch_size)
+    tbptt_positions = batch_size * (track_inputs.shape[1] // window) * window
+    flops = gru_flops_per_position(vocab_size)
+    return {
+        'padded_positions': padded_positions,
+        'padded_padding_fraction': padding / max(padded_positions, 1),
+        'padded_forward_flops': padded_positions * flops,
+        'tbptt_positions': tbptt_positions,
+        'tbptt_padding_fraction': 0.0,
+        'tbptt_forward_flops': tbptt_positions * flops,
+        'flops_saved_fraction': 1 - tbptt_positions / max(padded_positions, 1),
+    }
+
+
+if __name__ == '__main__':
+    import sys
+
+    from shakespeare_lm.cache import load_or_build_cache
+
+    corpus_cache = load_or_build_cache(sys.argv[1] if len(sys.argv) > 1 else 'data/Shakespeare.txt')
+    padded_inputs = corpus_cache.padded(maxlen=500)[:, :-1]
+    report = compare_wasted_compute(padded_inputs, corpus_cache.tokens, corpus_cache.codec.vocab_size)
+    for name, value in report.items():
+        print('{:>24s}: {:,.4g}'.format(name, value))
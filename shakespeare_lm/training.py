@@ -0,0 +1,227 @@
+"""
+CPU-oriented custom training loop for the `get_model` network.
+
+`model.fit` in the notebook runs the stateful GRU with Keras' generic training
+step. `CompiledTrainer` replaces it with
+
+* a compiled `tf.function` forward/backward step, optionally XLA-compiled
+  with `jit_compile=True` (off by default: on the CPUs we measured, XLA's
+  lowering of the GRU loop made the step several times slower),
+* optional bfloat16 mixed precision (call `set_mixed_precision(True)` *before*
+  building the model with `get_model`; variables stay float32),
+* gradient accumulation over `accumulation_steps` batches, so that the
+  effective batch size is not tied to the fixed stateful `batch_size`,
+* GRU state resets at the start of every epoch and, optionally, every
+  `reset_every` steps (the length of a group of contiguous sequences),
+
+and reports steps/sec for every epoch, so it can be compared with `fit`
+(see `measure_fit_steps_per_sec`).
+"""
+
+import time
+
+import tensorflow as tf
+
+from shakespeare_lm.instrumentation import instrument, timed_iter
+
+
+def set_mixed_precision(enabled=True):
+    """
+    This function sets the global Keras dtype policy to `mixed_bfloat16` (or
+    back to `float32`). It only affects models built afterwards.
+    """
+    tf.keras.mixed_precision.set_global_policy('mixed_bfloat16' if enabled else 'float32')
+
+
+def masked_loss_and_accuracy(targets, logits, mask):
+    """
+    This function returns the mean sparse categorical cross-entropy and the
+    accuracy of `logits` against `targets`, over the positions where `mask` is
+    true (the non-padding inputs, as with `mask_zero=True`).
+    """
+    logits = tf.cast(logits, tf.float32)
+    mask = tf.cast(mask, tf.float32)
+    count = tf.maximum(tf.reduce_sum(mask), 1.0)
+    losses = tf.keras.losses.sparse_categorical_crossentropy(targets, logits, from_logits=True)
+    correct = tf.cast(tf.equal(tf.cast(targets, tf.int64), tf.argmax(logits, axis=-1)), tf.float32)
+    return tf.reduce_sum(losses * mask) / count, tf.reduce_sum(correct * mask) / count
+
+
+class CompiledTrainer:
+    """
+    Training loop for a stateful model built by `get_model`. Call `fit` with
+    `tf.data` datasets of `(input, target)` batches in stateful order.
+    """
+
+    def __init__(self, model, optimizer=None, accumulation_steps=1, reset_every=None, jit_compile=False):
+        self.model = model
+        self.optimizer = optimizer or tf.keras.optimizers.Adam()
+        self.accumulation_steps = accumulation_steps
+        self.reset_every = reset_every
+        self.gradients = [tf.Variable(tf.zeros_like(v), trainable=False)
+                          for v in model.trainable_variables]
+        # reduce_retracing: batches of varying length (e.g. bucketed) share one trace
+        self._accumulate = tf.function(self._accumulate_step, jit_compile=jit_compile, reduce_retracing=True)
+        self._apply = tf.function(self._apply_step, jit_compile=jit_compile)
+        self._evaluate = tf.function(self._evaluate_step, jit_compile=jit_compile, reduce_retracing=True)
+
+    def _accumulate_step(self, inputs, targets):
+        with tf.GradientTape() as tape:
+            logits = self.model(inputs, training=True)
+            loss, accuracy = masked_loss_and_accuracy(targets, logits, inputs != 0)
+        grads = tape.gradient(loss, self.model.trainable_variables)
+        scale = 1.0 / self.accumulation_steps
+        for accumulator, grad in zip(self.gradients, grads):
+            accumulator.assign_add(tf.convert_to_tensor(grad) * scale)
+        return loss, accuracy
+
+    def _apply_step(self, scale):
+        # `scale` rescales the accumulated mean when fewer than `accumulation_steps` steps were summed
+        gradients = [accumulator * tf.cast(scale, accumulator.dtype) for accumulator in self.gradients]
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        for accumulator in self.gradients:
+            accumulator.assign(tf.zeros_like(accumulator))
+
+    def _evaluate_step(self, inputs, targets):
+        return masked_loss_and_accuracy(targets, self.model(inputs, training=False), inputs != 0)
+
+    @instrument('train_step')
+    def train_step(self, step, inputs, targets):
+        """
+        This function runs one training step on a batch: it resets the GRU
+        states at sequence-group boundaries, accumulates gradients, and applies
+        them every `accumulation_steps` steps. Returns the loss and accuracy.
+        """
+        if self.reset_every and step % self.reset_every == 0:
+            self.model.reset_states()
+        loss, accuracy = self._accumulate(inputs, targets)
+        if (step + 1) % self.accumulation_steps == 0:
+            self._apply(tf.constant(1.0))
+        return loss, accuracy
+
+    def evaluate(self, dataset, steps=None):
+        """
+        This function returns the mean loss and accuracy over (at most `steps`
+        batches of) `dataset`, resetting the GRU states at the start and every
+        `reset_every` batches, as in training.
+        """
+        self.model.reset_states()
+        totals = [0.0, 0.0]
+        num_batches = 0
+        for inputs, targets in dataset.take(steps) if steps else dataset:
+            if self.reset_every and num_batches and num_batches % self.reset_every == 0:
+                self.model.reset_states()
+            for i, value in enumerate(self._evaluate(inputs, targets)):
+                totals[i] += float(value)
+            num_batches += 1
+        return [total / max(num_batches, 1) for total in totals]
+
+    def fit(self, train_data, epochs=1, validation_data=None, validation_steps=None, callbacks=(), checkpoint=None):
+        """
+        This function trains the model for `epochs` epochs and returns a
+        history dict in the same form as `model.fit(...).history`, with an extra
+        `steps_per_sec` entry per epoch. Each callback is called as
+        `callback(epoch, logs)` at the end of every epoch. With a
+        `CheckpointManager` as `checkpoint`, training first resumes from its
+        latest checkpoint (if any), and is checkpointed in the background as
+        it goes; callbacks with a `resume(history)` method are then given the
+        restored history. If the checkpoint already completed `epochs` epochs,
+        nothing is trained and its history is returned.
+        """
+        history, start_epoch, start_step, start_totals = {}, 0, 0, [0.0, 0.0]
+        resumed = checkpoint.restore() if checkpoint is not None else None
+        if resumed is not None:
+            history, start_epoch, start_step = resumed['history'], resumed['epoch'], resumed['step']
+            start_totals = resumed['totals']
+            for callback in callbacks:
+                if hasattr(callback, 'resume'):
+                    callback.resume(history)
+            if start_epoch >= epochs:
+                print('The checkpoint in {} already completed {} of {} epochs: nothing to train. Use a new '
+                      'checkpoint directory or more epochs to train further.'.format(
+                          checkpoint.directory, start_epoch, epochs))
+                return history
+            print('Resuming from epoch {}, step {}'.format(start_epoch + 1, start_step))
+
+        for epoch in range(start_epoch, epochs):
+            epoch_data = train_data
+            if epoch == start_epoch and start_step:
+                # Mid-epoch resume: the GRU states were restored, skip the batches already seen
+                epoch_data = train_data.skip(start_step)
+                num_steps, totals = start_step, list(start_totals)
+            else:
+                self.model.reset_states()
+                num_steps, totals = 0, [0.0, 0.0]
+            first_step = num_steps
+            start = time.perf_counter()
+            for inputs, targets in timed_iter(epoch_data, 'dataset_next'):
+                loss, accuracy = self.train_step(num_steps, inputs, targets)
+                totals[0] += loss      # summed as tensors, so the host never waits on a step
+                totals[1] += accuracy
+                num_steps += 1
+                if checkpoint is not None:
+                    checkpoint.on_step_end(epoch, num_steps, totals, history)
+            if num_steps % self.accumulation_steps:
+                # Flush a partial accumulation at the end of the epoch, as the mean of the steps it holds
+                self._apply(tf.constant(self.accumulation_steps / (num_steps % self.accumulation_steps)))
+            elapsed = time.perf_counter() - start
+
+            logs = {
+                'loss': float(totals[0]) / max(num_steps, 1),
+                'sparse_categorical_accuracy': float(totals[1]) / max(num_steps, 1),
+                'steps_per_sec': (num_steps - first_step) / elapsed,
+            }
+            if validation_data is not None:
+                logs['val_loss'], logs['val_sparse_categorical_accuracy'] = self.evaluate(
+                    validation_data, validation_steps)
+            for name, value in logs.items():
+                history.setdefault(name, []).append(value)
+            print('Epoch {}/{}: '.format(epoch + 1, epochs) +
+                  ' - '.join('{}: {:.4f}'.format(name, value) for name, value in logs.items()))
+            for callback in callbacks:
+                callback(epoch, logs)
+            if checkpoint is not None:
+                checkpoint.on_epoch_end(epoch, history)
+        if checkpoint is not None:
+            checkpoint.wait()
+        return history
+
+
+class BestCheckpoint:
+    """
+    `CompiledTrainer.fit` callback equivalent to `ModelCheckpoint` with
+    `save_weights_only=True, save_best_only=True`: saves the weights to
+    `filepath` whenever `monitor` improves. On resume, the best value so far
+    is recovered from the checkpointed history, so a resumed run does not
+    overwrite a better `filepath`.
+    """
+
+    def __init__(self, model, filepath, monitor='val_loss'):
+        self.model = model
+        self.filepath = filepath
+        self.monitor = monitor
+        self.best = float('inf')
+
+    def resume(self, history):
+        values = history.get(self.monitor, history.get('loss', []))
+        self.best = min(values, default=float('inf'))
+
+    def __call__(self, epoch, logs):
+        value = logs.get(self.monitor, logs['loss'])
+        if value < self.best:
+            self.best = value
+            self.model.save_weights(self.filepath)
+
+
+def measure_fit_steps_per_sec(model, dataset, num_steps):
+    """
+    This function compiles `model` as in the notebook and returns the
+    steps/sec of `model.fit` over `num_steps` batches of `dataset`, excluding
+    the first (tracing) batch, for comparison with `CompiledTrainer`.
+    """
+    model.compile(optimizer='adam', loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                  metrics=['sparse_categorical_accuracy'])
+    model.fit(dataset.take(1), epochs=1, verbose=0)
+    start = time.perf_counter()
+    model.fit(dataset.take(num_steps), epochs=1, verbose=0)
+    return num_steps / (time.perf_counter() - start)
@@ -0,0 +1,57 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+
+from shakespeare_lm.bucketing import make_bucketed_dataset, make_bucketed_splits, split_chunks
+from shakespeare_lm.cache import build_cache
+
+
+# One chunk per letter, 8 for training and 2 for validation with the default 0.8 split
+CHUNK_LENGTHS = [3, 5, 9, 12, 20, 25, 40, 7, 18, 33]
+BOUNDARIES = (8, 16, 32)
+
+
+@pytest.fixture
+def corpus_cache(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    path.write_text('.'.join(chr(ord('a') + i) * n for i, n in enumerate(CHUNK_LENGTHS)), encoding='utf-8')
+    return build_cache(str(path), str(tmp_path / 'cache'))
+
+
+def test_split_chunks(corpus_cache):
+    (train_tokens, train_offsets), (valid_tokens, valid_offsets) = split_chunks(corpus_cache)
+
+    assert list(train_offsets) == list(np.cumsum([0] + CHUNK_LENGTHS[:8]))
+    assert len(train_tokens) == sum(CHUNK_LENGTHS[:8])
+    assert corpus_cache.codec.decode(train_tokens[-7:]) == 'h' * 7
+
+    assert list(valid_offsets) == [0, 18, 51]
+    assert len(valid_tokens) == sum(CHUNK_LENGTHS[8:])
+    assert corpus_cache.codec.decode(valid_tokens) == 'i' * 18 + 'j' * 33
+
+
+def test_bucketed_splits_from_token_cache(corpus_cache):
+    train_data, valid_data = make_bucketed_splits(corpus_cache, batch_size=1, boundaries=BOUNDARIES)
+
+    for dataset, lengths in [(train_data, CHUNK_LENGTHS[:8]), (valid_data, CHUNK_LENGTHS[8:])]:
+        batches = [inputs.numpy() for inputs, _ in dataset]
+        assert len(batches) == len(lengths)
+        assert sorted(batch.shape[1] for batch in batches) == sorted(n - 1 for n in lengths)
+        assert all(np.count_nonzero(batch) == batch.size for batch in batches)
+
+
+def test_batches_are_padded_within_their_bucket(corpus_cache):
+    (tokens, offsets), _ = split_chunks(corpus_cache)
+    dataset = make_bucketed_dataset(tokens, offsets, batch_size=2, boundaries=BOUNDARIES)
+    edges = (0,) + BOUNDARIES + (np.inf,)
+
+    num_batches = 0
+    for inputs, _ in dataset:
+        lengths = np.count_nonzero(inputs.numpy(), axis=1)
+        bucket = np.searchsorted(edges, lengths.max(), side='right') - 1
+        assert inputs.shape[1] == lengths.max()
+        assert edges[bucket] <= lengths.min() and lengths.max() < edges[bucket + 1]
+        num_batches += 1
+    # Input lengths 2, 4, 6 | 8, 11 | 19, 24 | 39: one full batch in each of the first three buckets
+    assert num_batches == 3